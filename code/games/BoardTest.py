@@ -84,11 +84,18 @@ def _rawdataToBytes(data: _RawData):
    _boardtest.boardtest_free_rawdata(data)
    return dataBytes
 
+# Raw moves (see saveRawMove()) by board type and move string. Entering a move string makes
+# the binary parse it, which is much slower than loading the raw move.
+_rawMoves = {}
+_boardType = None
+
 def init(boardtype : str):
+   global _boardType
    result = _boardtest.boardtest_init(boardtype.encode('ascii'))
    if result != 0:
       print("Failed to init")
       exit(1)
+   _boardType = boardtype
 
 def enterMove(move : str):
    res = _boardtest.boardtest_entermove(move.encode('ascii'))
@@ -130,7 +137,7 @@ def loadRawMove(rawMove: bytes):
    encodedData = _RawData()
    encodedData.size = len(rawMove)
    encodedData.data = ctypes.cast(ctypes.c_char_p(rawMove), ctypes.c_void_p)
-   _boardtest.boardtest_loadmove(rawMove)
+   _boardtest.boardtest_loadmove(encodedData)
 
 def undoMoves(moveCount: int):
    _boardtest.boardtest_undoMoves(moveCount)
@@ -169,4 +176,25 @@ def getMoveHist():
 def getBoardValue():
    return _boardtest.boardtest_getBoardVal()
 
-
+def randomPlayout(choice):
+   """Plays moves until there are none left and returns how many were played. choice picks
+   the move from the list of valid moves (as bytes). The moves are never decoded, and a move
+   that was played before is loaded as a raw move instead of being parsed again."""
+   rawMoves = _rawMoves.setdefault(_boardType, {})
+   moveCount = 0
+   while True:
+      validMoves = _boardtest.boardtest_getValidMoves()
+      if validMoves.size == 0:
+         return moveCount
+      moveBuff = ctypes.cast(validMoves.data, ctypes.POINTER(ctypes.c_char))[:validMoves.size-1]
+      _boardtest.boardtest_free_rawdata(validMoves)
+      move = choice(moveBuff.split(b'\x00'))
+      rawMove = rawMoves.get(move)
+      if rawMove is None:
+         if _boardtest.boardtest_entermove(move) < 0:
+            raise ValueError("Invalid move")
+         rawMoves[move] = saveRawMove()
+      else:
+         loadRawMove(rawMove)
+      _boardtest.boardtest_applymove()
+      moveCount += 1
@@ -108,6 +108,165 @@ class Connect4Impl:
         return self.turn
 
 
+class Connect4Bitboard:
+    """
+    Connect 4 board stored as bitboards, with the same interface as Connect4Impl.
+
+    Each column takes rows+1 bits, bottom row first, and column 0 comes first. The extra bit
+    on top of every column keeps lines from wrapping from one column into the next. black and
+    white hold the stones of each player and heights holds how full each column is, so a
+    move or an undo only changes one bit.
+    """
+    def __init__(self, cols=7, rows=6, requiredToWin=4):
+        self.cols = cols
+        self.rows = rows
+        self.win = requiredToWin
+        self._col_bits = rows + 1
+        self.bottom_mask = sum(1 << (col * self._col_bits) for col in range(cols))
+        self.board_mask = self.bottom_mask * ((1 << rows) - 1)
+        # Bit distance to the next cell in a line: vertical, horizontal and both diagonals
+        self._directions = (1, self._col_bits, self._col_bits - 1, self._col_bits + 1)
+        self.reset_game()
+
+    def reset_game(self):
+        self.turn = BLACK
+        self.black = 0
+        self.white = 0
+        self.heights = [0] * self.cols
+        self.moves = []
+        self.game_over = False
+        self._winner = None
+        self._board = None
+
+    def _has_line(self, stones):
+        for direction in self._directions:
+            line = stones
+            for i in range(1, self.win):
+                line &= stones >> (direction * i)
+                if line == 0:
+                    break
+            if line != 0:
+                return True
+        return False
+
+    def canPlay(self, column):
+        return 0 <= column < self.cols and self.heights[column] < self.rows
+
+    def insert(self, column, shadow=False):
+        if not self.canPlay(column):
+            if not shadow:
+                self.printBoard()
+                print(f'Column {column} is full')
+            return False
+
+        if not shadow:
+            bit = 1 << (column * self._col_bits + self.heights[column])
+            if self.turn == BLACK:
+                self.black |= bit
+                stones = self.black
+            else:
+                self.white |= bit
+                stones = self.white
+            self.heights[column] += 1
+            self.moves.append(column)
+            self._board = None
+
+            # Only the player who just moved can have made a line
+            if self._has_line(stones):
+                self.game_over = True
+                self._winner = self.turn
+            else:
+                self.turn = WHITE if self.turn == BLACK else BLACK
+        return True
+
+    def undo(self):
+        """Takes back the last move"""
+        if len(self.moves) == 0:
+            return
+        column = self.moves.pop()
+        self.heights[column] -= 1
+        bit = ~(1 << (column * self._col_bits + self.heights[column]))
+        self.black &= bit
+        self.white &= bit
+        self.turn = BLACK if len(self.moves) % 2 == 0 else WHITE
+        self.game_over = False
+        self._winner = None
+        self._board = None
+
+    def getWhoseMove(self):
+        return 'BLACK' if self.turn == BLACK else 'WHITE'
+
+    def checkForWin(self):
+        return self.getWinner()
+
+    def getWinner(self):
+        return self._winner
+
+    def getKey(self):
+        """Integer that is unique to this position. mask + bottom_mask sets the bit just above
+        the top stone of each column, which marks the height without hiding black's stones."""
+        return self.black | ((self.black | self.white) + self.bottom_mask)
+
+    def getMirroredKey(self):
+        """getKey() of the board mirrored left to right. Every column's bits (including the
+        height marker) stay inside its own rows+1 bits, so mirroring reverses the column blocks."""
+        key = self.getKey()
+        col_mask = (1 << self._col_bits) - 1
+        mirrored = 0
+        for col in range(self.cols):
+            column = (key >> (col * self._col_bits)) & col_mask
+            mirrored |= column << ((self.cols - 1 - col) * self._col_bits)
+        return mirrored
+
+    def getWindows(self):
+        """Bit masks of every line of self.win cells that could win the game (69 on the standard
+        7x6 board). A window is still open for a player if the other player has no stone in it."""
+        # Step in columns and rows for the vertical, horizontal and both diagonal directions
+        steps = ((0, 1), (1, 0), (1, -1), (1, 1))
+        windows = []
+        for d_col, d_row in steps:
+            for col in range(self.cols):
+                for row in range(self.rows):
+                    end_col = col + d_col * (self.win - 1)
+                    end_row = row + d_row * (self.win - 1)
+                    if end_col >= self.cols or not 0 <= end_row < self.rows:
+                        continue
+                    mask = 0
+                    for i in range(self.win):
+                        mask |= 1 << ((col + d_col * i) * self._col_bits + row + d_row * i)
+                    windows.append(mask)
+        return windows
+
+    @property
+    def board(self):
+        """The board as a list of columns like Connect4Impl.board (top row first). Built when
+        first asked for after a move."""
+        if self._board is None:
+            board = []
+            for col in range(self.cols):
+                column = [NONE] * self.rows
+                for row in range(self.heights[col]):
+                    bit = 1 << (col * self._col_bits + row)
+                    column[self.rows - 1 - row] = BLACK if self.black & bit else WHITE
+                board.append(column)
+            self._board = board
+        return self._board
+
+    def getBoardRepr(self):
+        return Connect4Impl.getRepr(self.board, self.rows, self.cols)
+
+    def printBoard(self):
+        print(self.getBoardRepr())
+
+    def getValidMoves(self):
+        if self.game_over:
+            return []
+        return [col for col in range(self.cols) if self.heights[col] < self.rows]
+
+    def get_turn(self):
+        return self.turn
+
+
 if __name__ == '__main__':
     g = Connect4Impl()
     while True:
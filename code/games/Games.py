@@ -1,9 +1,12 @@
 from abc import ABC, abstractmethod
-from Connect4 import Connect4Impl, BLACK, WHITE, NONE
+from collections import OrderedDict
+from functools import lru_cache
+from operator import itemgetter
+from Connect4 import Connect4Impl, Connect4Bitboard, BLACK, WHITE, NONE
 import BoardTest
+import random
 import struct
 import copy
-import io
 
 
 """
@@ -14,22 +17,64 @@ Games are divided into Python games and CGames. CGames are games
 written in C++ that we use the ctype library to port over to Python.
 This is done within the BoardTest.py file.
 
+BoardTest only holds one board at a time, so every CGame keeps its own saved board state
+and only the CGame that was used last is loaded into BoardTest (see CGame). Any number of
+games can be alive at once.
+
+Games whose board has symmetries (mirroring, rotation) give the same canonical key
+(getCanonicalKey()) to every orientation of a position, so searches and caches can store
+them once.
+
 """
 
+# Number of symmetries of a square board: 4 rotations, each one optionally mirrored first
+DIHEDRAL_TRANSFORMS = 8
+
+def dihedralPoint(row, col, dim, transform):
+   """Where transform moves the square (row, col) of a dim x dim board. Transforms 4 to 7
+   mirror the columns first, then every transform rotates the board clockwise (transform % 4)
+   times."""
+   if transform >= 4:
+      col = dim - 1 - col
+   for _ in range(transform % 4):
+      row, col = col, dim - 1 - row
+   return row, col
+
+def _findDihedralInverse(transform):
+   for inverse in range(DIHEDRAL_TRANSFORMS):
+      if all(dihedralPoint(*dihedralPoint(row, col, 3, transform), 3, inverse) == (row, col)
+            for row in range(3) for col in range(3)):
+         return inverse
+
+_DIHEDRAL_INVERSES = [_findDihedralInverse(transform) for transform in range(DIHEDRAL_TRANSFORMS)]
+
+def dihedralInverse(transform):
+   """The transform that undoes transform"""
+   return _DIHEDRAL_INVERSES[transform]
+
+@lru_cache(maxsize=None)
+def dihedralCells(dim):
+   """For each transform, an itemgetter that takes the squares of a dim x dim board (row by
+   row) and returns them in their transformed order"""
+   getters = []
+   for transform in range(DIHEDRAL_TRANSFORMS):
+      cells = [0] * (dim * dim)
+      for row in range(dim):
+         for col in range(dim):
+            new_row, new_col = dihedralPoint(row, col, dim, transform)
+            cells[new_row * dim + new_col] = row * dim + col
+      getters.append(itemgetter(*cells))
+   return getters
+
 class Game(ABC):
    """
    Every game must adhere to the interface provided here.
 
-   ONLY ONE GAME AT A TIME MAY BE INITIALIZED. Call close() to be able
-   to make a new Game.
+   Call close() when done with a game. It can't be used afterwards.
    """
-   _initialized = False
    def __init__(self):
-      self.__valid = not Game._initialized
-      if Game._initialized:
-         raise Exception("Only one game at a time is supported")
+      self.__valid = True
       self._boardStateSynched = False
-      Game._initialized = True
 
    @abstractmethod
    def doMove(self, move: str):
@@ -77,52 +122,174 @@ class Game(ABC):
       "min", "max", or "draw"). Otherwise, returns None."""
       pass
 
+   def getCanonicalKey(self):
+      """ Get (key, transform), where key is the same for every position that is a symmetry
+      of this one (a mirror image or rotation of it). transform turns this position into the
+      orientation the key stands for, see transformMove(). Canonical keys should only be
+      compared with other canonical keys. Games without symmetries return getBoardKey(). """
+      return self.getBoardKey(), 0
+
+   def transformMove(self, move, transform, inverse=False):
+      """ Map a move in this position to the same move in the orientation of
+      getCanonicalKey() (or back from it if inverse is set). """
+      return move
+
+   def randomPlayouts(self, count=1, rng=None):
+      """ Play the game out count times with random moves and return (winner, moves played)
+      for each playout. The game is back at this position afterwards. rng is anything with
+      choice() and shuffle() like the random module (the default). Games override this with
+      faster loops than doMove()/getWinner(). """
+      if rng is None:
+         rng = random
+      results = []
+      for _ in range(count):
+         winner = self.getWinner()
+         moveCount = 0
+         while winner is None:
+            self.doMove(rng.choice(self.getValidMoves()))
+            moveCount += 1
+            winner = self.getWinner()
+         self.undoMoves(moveCount)
+         results.append((winner, moveCount))
+      return results
+
    @staticmethod
    def check_game_valid(func):
       """ This is a decorator to make sure the game is valid and initialized """
-      def validity_fn(self, *args):
+      def validity_fn(self, *args, **kwargs):
          if not self.__valid:
             raise Exception(f'Game {self} has been closed/deleted!')
-         return func(self, *args)
+         return func(self, *args, **kwargs)
       return validity_fn
 
    def close(self):
-      """Deletes the game. Allows new game to be created"""
-      if self.__valid:
-         self.__valid = False
-         Game._initialized = False
+      """Deletes the game"""
+      self.__valid = False
 
    def __del__(self):
       self.close()
 
 
+class _BoardStateCache:
+   """
+   Bounded least-recently-used cache of (binary board, valid moves) keyed on the board key,
+   so going back to a position (like undoing and redoing a move in a search) doesn't have to
+   fetch them through BoardTest again.
+   """
+   def __init__(self, maxSize):
+      self._maxSize = maxSize
+      self._entries = OrderedDict()
+      self.hits = 0
+      self.misses = 0
+
+   def get(self, key):
+      entry = self._entries.get(key)
+      if entry is None:
+         self.misses += 1
+         return None
+      self._entries.move_to_end(key)
+      self.hits += 1
+      return entry
+
+   def put(self, key, entry):
+      if self._maxSize <= 0:
+         return
+      self._entries[key] = entry
+      self._entries.move_to_end(key)
+      if len(self._entries) > self._maxSize:
+         self._entries.popitem(last=False)
+
+   def clear(self):
+      self._entries.clear()
+
 class CGame(Game):
    """
    Games implemented from BoardTest.py
+
+   The binary board is only fetched from BoardTest when something asks about the board after
+   a move, and subclasses only decode the fields of it that are asked for. Recently seen
+   boards are cached by board key (see _BoardStateCache).
+
+   BoardTest holds a single board, so CGames share it. The CGame whose board is in BoardTest
+   is resident. Before a CGame calls BoardTest it makes itself resident: the resident game's
+   board is saved with saveBoardState() and this game's saved board is loaded in its place.
+   A game that is already resident skips all of that, so using one game at a time costs no
+   more than before. getSwapCount() counts the swaps.
    """
+
+   # Number of positions kept in the board state cache. Set to 0 to turn it off.
+   stateCacheSize = 2**14
+
+   # Whether the valid moves can be cached by board key. Only safe if the board key captures
+   # everything the valid moves depend on.
+   _cacheValidMoves = True
+
+   # The CGame whose board is loaded in BoardTest, and the number of times a game was loaded
+   _resident = None
+   _swaps = 0
+
    def __init__(self, gamestr):
       super().__init__()
+      CGame._saveResident()
       BoardTest.init(gamestr)
+      CGame._resident = self
+      self._gamestr = gamestr
+      self._savedState = None
+      self._stateCache = _BoardStateCache(self.stateCacheSize)
+
+   @staticmethod
+   def _saveResident():
+      resident = CGame._resident
+      if resident is not None:
+         resident._savedState = BoardTest.saveBoardState()
+         CGame._resident = None
+
+   def _makeResident(self):
+      """ Load this game's board into BoardTest if another game's board is there """
+      if CGame._resident is self:
+         return
+      previous = CGame._resident
+      CGame._saveResident()
+      if previous is None or previous._gamestr != self._gamestr:
+         BoardTest.init(self._gamestr)
+      BoardTest.loadBoardState(self._savedState)
+      self._savedState = None
+      CGame._resident = self
+      CGame._swaps += 1
+
+   @staticmethod
+   def getSwapCount():
+      """ Number of times a CGame's board has been loaded back into BoardTest """
+      return CGame._swaps
+
+   def isResident(self):
+      """ Whether this game's board is the one loaded in BoardTest """
+      return CGame._resident is self
 
    @Game.check_game_valid
-   def enterMove(move: str):
+   def enterMove(self, move: str):
       """ Load a move as the 'current' move, ready to be executed. """
+      self._makeResident()
       BoardTest.enterMove(move)
 
    @Game.check_game_valid
-   def applyMove():
+   def applyMove(self):
       """ Execute the currently loaded move. """
+      self._makeResident()
+      self._boardStateSynched = False
       BoardTest.applyMove()
 
    @Game.check_game_valid
    def getCurrMove(self):
       """ Get the currently loaded move"""
+      self._makeResident()
       return BoardTest.getCurrMove()
 
    @Game.check_game_valid
    def doMove(self, move: str):
       """ Load and execute a move. Shorthand for enterMove() followed by
       applyMove(). """
+      self._makeResident()
       self._boardStateSynched = False
       BoardTest.enterMove(move)
       BoardTest.applyMove()
@@ -131,16 +298,24 @@ class CGame(Game):
    def saveBoardState(self):
       """ Get the current board state as a binary blob. This can be later used
       by loadBoardState() to restore the board state. """
+      if CGame._resident is not self:
+         # Already saved, no need to load it
+         return self._savedState
       return BoardTest.saveBoardState()
 
    @Game.check_game_valid
    def loadBoardState(self, boardState: bytes):
       """ Restore a board state saved by saveBoardState(). """
       self._boardStateSynched = False
+      if CGame._resident is not self:
+         # Loaded the next time the game is used
+         self._savedState = boardState
+         return
       BoardTest.loadBoardState(boardState)
 
    @Game.check_game_valid
    def undoMoves(self, moveCount: int):
+      self._makeResident()
       self._boardStateSynched = False
       BoardTest.undoMoves(moveCount)
 
@@ -149,10 +324,12 @@ class CGame(Game):
       """ Get a compressed binary representation of the current board suitable
       for use in a hash table. Intended for use with a transposition table in
       minimax """
+      self._makeResident()
       return BoardTest.getBoardKey()
 
    @Game.check_game_valid
    def showBoard(self):
+      self._makeResident()
       return BoardTest.showBoard()
 
    @Game.check_game_valid
@@ -164,41 +341,77 @@ class CGame(Game):
    def _syncBoardState(self):
       if self._boardStateSynched:
          return
+      self._makeResident()
       self._boardStateSynched = True
-      self._parseBoardState(BoardTest.getBinaryBoard())
-      self._moves = BoardTest.getValidMoves()
+      key = BoardTest.getBoardKey()
+      cached = self._stateCache.get(key)
+      if cached is None:
+         binData = BoardTest.getBinaryBoard()
+         moves = BoardTest.getValidMoves()
+         self._stateCache.put(key, (binData, moves))
+      else:
+         binData, moves = cached
+         if not self._cacheValidMoves:
+            moves = BoardTest.getValidMoves()
+      self._parseBoardState(binData)
+      self._moves = moves
+
+   @Game.check_game_valid
+   def randomPlayouts(self, count=1, rng=None):
+      """ Plays the moves with BoardTest.randomPlayout(), so the board is only fetched and
+      parsed once per playout, to find the winner at the end. """
+      if rng is None:
+         rng = random
+      self._makeResident()
+      results = []
+      for _ in range(count):
+         moveCount = BoardTest.randomPlayout(rng.choice)
+         self._boardStateSynched = False
+         results.append((self.getWinner(), moveCount))
+         BoardTest.undoMoves(moveCount)
+      self._boardStateSynched = False
+      return results
 
    @abstractmethod
    def _parseBoardState(self, binData):
+      """ Store the binary board. Fields should be decoded from it when they are used. """
       pass
 
    @Game.check_game_valid
    def getValidMoves(self):
       self._verifyStateSync()
-      return self._moves
+      return list(self._moves)
+
+   @Game.check_game_valid
+   def getBinaryBoard(self):
+      """ Get the raw binary board from BoardTest. The layout depends on the game (see the
+      subclasses' _parseBoardState()). """
+      self._verifyStateSync()
+      return self._binBoard
 
    @Game.check_game_valid
    def getMoveHist(self):
+      self._makeResident()
       return BoardTest.getMoveHist()
 
+   def close(self):
+      if CGame._resident is self:
+         CGame._resident = None
+      super().close()
+
 
 class CheckersGame(CGame):
+   # Men only move forward, and mirroring the board swaps its dark and light squares, so
+   # checkers positions have no symmetries and keep the default canonical key
    def __init__(self):
       super().__init__("CheckersBoard")
 
    @Game.check_game_valid
    def _parseBoardState(self, binData):
-      with io.BytesIO(binData) as strm:
-
-         dim = struct.unpack('B', strm.read(1))[0]
-         self._dim = dim
-         self._board = []
-         for _ in range(dim-1, -1, -1):
-            rowArr = []
-            for _ in range(0, dim):
-               rowArr.append(struct.unpack('B', strm.read(1))[0])
-            self._board.append(rowArr)
-         self._move = struct.unpack('B', strm.read(1))[0]
+      # Layout: dim, dim*dim unsigned squares (row by row), whose move
+      self._binBoard = binData
+      self._dim = binData[0]
+      self._move = binData[1 + self._dim * self._dim]
 
    @Game.check_game_valid
    def getWhoseMove(self):
@@ -224,7 +437,7 @@ class CheckersGame(CGame):
 
       assert row < self._dim and col < self._dim
 
-      piece = self._board[row][col]
+      piece = self._binBoard[1 + row * self._dim + col]
 
       pieceStr = ""
 
@@ -259,21 +472,19 @@ class CheckersGame(CGame):
          return "max"
 
 class OthelloGame(CGame):
+   # The board key is the same for a full board whether the player to move has to pass or the
+   # game is over, so the valid moves can't be cached by it
+   _cacheValidMoves = False
+
    def __init__(self):
       super().__init__("OthelloBoard")
 
    @Game.check_game_valid
    def _parseBoardState(self, binData):
-      with io.BytesIO(binData) as strm:
-         dim = struct.unpack('B', strm.read(1))[0]
-         self._dim = dim
-         self._board = []
-         for _ in range(dim):
-            rowArr = []
-            for _ in range(dim):
-               rowArr.append(struct.unpack('b', strm.read(1))[0])
-            self._board.append(rowArr)
-         self._move = struct.unpack('B', strm.read(1))[0]
+      # Layout: dim, dim*dim signed squares (row by row), whose move
+      self._binBoard = binData
+      self._dim = binData[0]
+      self._move = binData[1 + self._dim * self._dim]
 
    @Game.check_game_valid
    def getWhoseMove(self):
@@ -299,7 +510,7 @@ class OthelloGame(CGame):
 
       assert row < self._dim and col < self._dim
 
-      piece = self._board[row][col]
+      piece = struct.unpack_from('b', self._binBoard, 1 + row * self._dim + col)[0]
 
       if piece == -1:
          return 'W'
@@ -337,6 +548,28 @@ class OthelloGame(CGame):
       else:
          return 'draw'
 
+   @Game.check_game_valid
+   def getCanonicalKey(self):
+      """ The squares in the smallest of the board's 8 orientations, followed by whose move it
+      is. This isn't the same format as getBoardKey(). """
+      self._verifyStateSync()
+      dim = self._dim
+      squares = self._binBoard[1:1 + dim * dim]
+      key, transform = min((bytes(cells(squares)), transform) for transform, cells in enumerate(dihedralCells(dim)))
+      return key + bytes([self._move]), transform
+
+   @Game.check_game_valid
+   def transformMove(self, move, transform, inverse=False):
+      try:
+         row, col = map(int, move.strip('[]').split(','))
+      except ValueError:
+         # Not a square (a pass)
+         return move
+      if inverse:
+         transform = dihedralInverse(transform)
+      row, col = dihedralPoint(row, col, self.getDim(), transform)
+      return '[{}, {}]'.format(row, col)
+
 class C4Pop10Game(CGame):
    class C4Pop10GameScore:
       """An object representing a player's score in C4Pop10. The score contains
@@ -350,35 +583,28 @@ class C4Pop10Game(CGame):
          self.threatDisks = 0
          self.keptDisks = 0
 
+   # The board key doesn't say whether the player to move has to keep a disk or pass, so the
+   # same key can have different valid moves
+   _cacheValidMoves = False
+
    def __init__(self):
       super().__init__("C4Pop10Board")
 
    @Game.check_game_valid
    def _parseBoardState(self, binData):
-      byte = struct.iter_unpack('b', binData)
-      byte = map(lambda b: b[0], byte)
-      self._width = next(byte)
-      self._height = next(byte)
-      self._board = []
-      for _ in range(self._height):
-         row = []
-         for _ in range(self._width):
-            row.append(next(byte))
-         self._board.append(row)
-      assert len(self._board) == self._height
-      assert len(self._board[0]) == self._width
-      self._move = next(byte)
-
-      self._redScore = C4Pop10Game.C4Pop10GameScore()
-      self._yellowScore = C4Pop10Game.C4Pop10GameScore()
-
-      self._redScore.safeDisks = next(byte)
-      self._redScore.threatDisks = next(byte)
-      self._redScore.keptDisks = next(byte)
-
-      self._yellowScore.safeDisks = next(byte)
-      self._yellowScore.threatDisks = next(byte)
-      self._yellowScore.keptDisks = next(byte)
+      # Layout (all signed): width, height, width*height squares (row by row), whose move,
+      # then red's and yellow's safe, threat and kept disks
+      self._binBoard = binData
+      self._width, self._height = struct.unpack_from('bb', binData, 0)
+      self._move = struct.unpack_from('b', binData, 2 + self._width * self._height)[0]
+      self._redScore = None
+      self._yellowScore = None
+
+   def _parseScore(self, offset):
+      score = C4Pop10Game.C4Pop10GameScore()
+      score.safeDisks, score.threatDisks, score.keptDisks = struct.unpack_from('bbb', self._binBoard,
+         3 + self._width * self._height + offset)
+      return score
 
    @Game.check_game_valid
    def getWhoseMove(self):
@@ -404,7 +630,7 @@ class C4Pop10Game(CGame):
 
       assert row < self._height and col < self._width
 
-      piece = self._board[row][col]
+      piece = struct.unpack_from('b', self._binBoard, 2 + row * self._width + col)[0]
 
       if piece & 0x01 != 0:
          if piece & 0x02 != 0:
@@ -418,12 +644,16 @@ class C4Pop10Game(CGame):
    def getRedScore(self):
       """Gets the score of the red player. Returns a C4Pop10GameScore object."""
       self._verifyStateSync()
+      if self._redScore is None:
+         self._redScore = self._parseScore(0)
       return self._redScore
 
    @Game.check_game_valid
    def getYellowScore(self):
       """Gets the score of the yellow player. Returns a C4Pop10GameScore object."""
       self._verifyStateSync()
+      if self._yellowScore is None:
+         self._yellowScore = self._parseScore(3)
       return self._yellowScore
 
    @Game.check_game_valid
@@ -450,17 +680,15 @@ class C4Pop10Game(CGame):
 
 
 class Connect4(Game):
-   def __init__(self):
+   def __init__(self, cols=7, rows=6, requiredToWin=4):
       super().__init__()
-      self.game = Connect4Impl()
-      self.game_states = [self.getBoardCopy()]
+      self.game = Connect4Bitboard(cols, rows, requiredToWin)
       self.saved_column = None
       self.history = []
 
    @Game.check_game_valid
    def resetGame(self):
       self.game.reset_game()
-      self.game_states = [self.getBoardCopy()]
       self.history = []
 
    @Game.check_game_valid
@@ -493,7 +721,9 @@ class Connect4(Game):
 
       if self.game.getWinner() == BLACK:
          return "max"
-      return "min"
+      elif self.game.getWinner() == WHITE:
+         return "min"
+      return "draw"
 
    @Game.check_game_valid
    def getDimensions(self):
@@ -505,7 +735,6 @@ class Connect4(Game):
          int_col = int(column)
          success = self.game.insert(int_col)
          if success:
-            self.game_states.append(self.getBoardCopy())
             self.history.append(int_col)
       except ValueError:
          print('Please provide a valid column NUMBER')
@@ -544,12 +773,9 @@ class Connect4(Game):
    @Game.check_game_valid
    def undoMoves(self, movesToUndo):
       # Can't go past first board state
-      goBackTo = max(1, 1 + len(self.history) - movesToUndo)
-      self.game_states = self.game_states[:goBackTo]
-      self.game.board = copy.deepcopy(self.game_states[-1])
-      self.game.turn = BLACK if (goBackTo - 1) % 2 == 0 else WHITE
-      self.history = self.history[:goBackTo - 1]
-      self.game.game_over = self.game.checkForWin()
+      for _ in range(min(movesToUndo, len(self.history))):
+         self.game.undo()
+         self.history.pop()
 
    @Game.check_game_valid
    def getMoveHist(self):
@@ -557,7 +783,49 @@ class Connect4(Game):
 
    @Game.check_game_valid
    def getBoardKey(self):
-      return str(self.game.board)
+      return self.game.getKey()
+
+   @Game.check_game_valid
+   def randomPlayouts(self, count=1, rng=None):
+      """ Plays on the bitboard directly and takes the moves back with undo() """
+      if rng is None:
+         rng = random
+      board = self.game
+      results = []
+      for _ in range(count):
+         moveCount = 0
+         moves = board.getValidMoves()
+         while moves:
+            board.insert(rng.choice(moves))
+            moveCount += 1
+            moves = board.getValidMoves()
+         winner = board.getWinner()
+         for _ in range(moveCount):
+            board.undo()
+         if winner == BLACK:
+            results.append(("max", moveCount))
+         elif winner == WHITE:
+            results.append(("min", moveCount))
+         else:
+            results.append(("draw", moveCount))
+      return results
+
+   @Game.check_game_valid
+   def getCanonicalKey(self):
+      """ The smaller of the board key and the key of the mirrored board. Transform 1 mirrors
+      the board. """
+      key = self.game.getKey()
+      mirrored = self.game.getMirroredKey()
+      if mirrored < key:
+         return mirrored, 1
+      return key, 0
+
+   @Game.check_game_valid
+   def transformMove(self, move, transform, inverse=False):
+      # Mirroring is its own inverse
+      if transform == 1:
+         return self.game.cols - 1 - int(move)
+      return move
 
    @Game.check_game_valid
    def getTurn(self):
@@ -1,7 +1,11 @@
 from abc import ABC, abstractmethod
 import random
 from Games import Game
+from transposition import TranspositionTable
+from move_ordering import MoveOrderer
+from eval_funcs import CachedEvalFn
 import minimax
+import negamax
 import mcts
 
 """
@@ -13,17 +17,133 @@ Players need to just implement a `play()` that plays a move given a game.
 """
 
 class Player(ABC):
+    # Opening book to play from before searching (see opening_book.py)
+    _opening_book = None
+
     @abstractmethod
     def play(self, game: Game):
         pass
 
+    def set_opening_book(self, opening_book):
+        """Plays the book move (if there is one) instead of searching. Use None to stop using a book."""
+        self._opening_book = opening_book
+
+    def get_opening_book(self):
+        return self._opening_book
+
+    def get_book_move(self, game: Game):
+        """The opening book's move for this position, or None"""
+        if self._opening_book is None:
+            return None
+        return self._opening_book.get_move(game)
+
+    def get_nodes_searched(self) -> int:
+        """Number of positions searched for the last move, or 0 if the player doesn't search"""
+        return 0
+
 class MonteCarloPlayer(Player):
-    def __init__(self, num_iter = 300, c=1):
+    def __init__(self, num_iter = 300, c=1, reuse_tree=True, workers=None, oracle=None, leaf_eval=None,
+            leaf_parallel=False, time_limit=None, early_stop=False):
+        """If reuse_tree is set, the search tree is kept between moves. On the next move, the
+        subtree for the moves played since then is searched further instead of starting over.
+
+        If workers is given, that many worker processes each run num_iter iterations on their
+        own tree and the results are merged (see parallel_mcts.py). Trees are not reused then.
+        If leaf_parallel is also set, the player grows a single tree of num_iter iterations
+        instead and the workers evaluate its leaves (see parallel_mcts.LeafParallelMCTS), so
+        the tree can be reused. Call close() when done with the player to stop the workers.
+
+        oracle (like a tablebase.Tablebase) is asked who wins from each leaf before it is
+        played out (see mcts.mcts_tree_search()).
+
+        leaf_eval (like batch_rollout.RolloutLeafEval) estimates each leaf in place of a
+        single random playout.
+
+        If time_limit (seconds per move) is given, the search stops when it runs out, or after
+        num_iter simulations if that comes first (num_iter can be None). If early_stop is set,
+        the search stops as soon as the most visited move can't be overtaken and plays that
+        move. get_last_stats() has the simulations and time that saved."""
         self._num_iter = num_iter
         self._c = c
-    
+        self._reuse_tree = reuse_tree and (workers is None or leaf_parallel)
+        self._leaf_parallel = leaf_parallel
+        self._tree = None
+        self._tree_hist = None
+        self._workers = workers
+        self._parallel = None
+        self._last_stats = None
+        self._oracle = oracle
+        self._leaf_eval = leaf_eval
+        self._time_limit = time_limit
+        self._early_stop = early_stop
+
+    def _get_reusable_tree(self, game: Game):
+        """The stored tree advanced to the current position, or None if it can't be reused"""
+        tree, tree_hist = self._tree, self._tree_hist
+        self._tree = self._tree_hist = None
+        if tree is None:
+            return None
+        hist = game.getMoveHist()
+        if hist[:len(tree_hist)] != tree_hist:
+            # A different game (or moves were undone)
+            return None
+        tree = mcts.mcts_advance_root(tree, hist[len(tree_hist):])
+        if tree is None or tree.get_player() != game.getPlayer():
+            return None
+        return tree
+
+    def get_best_move(self, game: Game):
+        """Searches for the best move without playing it. Search statistics are available
+        afterwards from get_last_stats()."""
+        stats = mcts.MCTSStats()
+        self._last_stats = stats
+        book_move = self.get_book_move(game)
+        if book_move is not None:
+            return book_move
+        if self._workers is not None and not self._leaf_parallel:
+            return self._get_parallel_search(type(game)).best_move(game, self._num_iter, self._c, stats, self._oracle,
+                self._leaf_eval, self._time_limit, self._early_stop)
+
+        tree = self._get_reusable_tree(game) if self._reuse_tree else None
+        hist = game.getMoveHist() if self._reuse_tree else None
+        if self._workers is not None:
+            move, tree = self._get_parallel_search(type(game)).tree_search(game, self._num_iter, self._c, tree,
+                stats, self._oracle, self._leaf_eval, self._time_limit, self._early_stop)
+        else:
+            move, tree = mcts.mcts_tree_search(game, game.getPlayer(), self._num_iter, quiet=True, c=self._c,
+                root=tree, stats=stats, oracle=self._oracle, leaf_eval=self._leaf_eval, time_limit=self._time_limit,
+                early_stop=self._early_stop)
+        if self._reuse_tree:
+            self._tree, self._tree_hist = tree, hist
+        return move
+
+    def _get_parallel_search(self, game_class):
+        # Imported here so the worker processes aren't needed unless asked for
+        from parallel_mcts import ParallelMCTS, LeafParallelMCTS
+        if self._parallel is None or self._parallel.game_class != game_class:
+            self.close()
+            if self._leaf_parallel:
+                self._parallel = LeafParallelMCTS(game_class, self._workers)
+            else:
+                self._parallel = ParallelMCTS(game_class, self._workers)
+        return self._parallel
+
+    def close(self):
+        """Stops the worker processes if the player is searching with workers"""
+        if self._parallel is not None:
+            self._parallel.close()
+            self._parallel = None
+
+    def get_last_stats(self):
+        """MCTSStats of the last search, or None if the player hasn't searched yet"""
+        return self._last_stats
+
+    def get_nodes_searched(self) -> int:
+        """Simulations run for the last move"""
+        return self._last_stats.simulations if self._last_stats is not None else 0
+
     def play(self, game: Game):
-        move = mcts.mcts(game, game.getPlayer(), self._num_iter, quiet=True, c=self._c)
+        move = self.get_best_move(game)
         #print("Mcts plays {}".format(move))
         game.doMove(move)
 
@@ -38,34 +158,253 @@ class MonteCarloPlayer(Player):
     
     def get_num_iters(self):
         return self._num_iter
+
+    def set_oracle(self, oracle):
+        self._oracle = oracle
+
+    def get_oracle(self):
+        return self._oracle
+
+    def set_leaf_eval(self, leaf_eval):
+        self._leaf_eval = leaf_eval
+
+    def get_leaf_eval(self):
+        return self._leaf_eval
+
+    def set_time_limit(self, time_limit):
+        self._time_limit = time_limit
+
+    def get_time_limit(self):
+        return self._time_limit
+
+    def set_early_stop(self, early_stop):
+        self._early_stop = early_stop
+
+    def get_early_stop(self):
+        return self._early_stop
     
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_tree'] = None
+        state['_tree_hist'] = None
+        state['_parallel'] = None
+        return state
+
     def __str__(self):
-        return "{}(num_iter={},c={})".format(self.__class__.__name__, self._num_iter, self._c)
+        opts = "num_iter={},c={}".format(self._num_iter, self._c)
+        if self._workers is not None:
+            opts += ",workers={}".format(self._workers)
+            if self._leaf_parallel:
+                opts += ",leaf_parallel=True"
+        if self._oracle is not None:
+            opts += ",oracle={}".format(self._oracle)
+        if self._leaf_eval is not None:
+            opts += ",leaf_eval={}".format(self._leaf_eval)
+        if self._time_limit is not None:
+            opts += ",time_limit={}".format(self._time_limit)
+        if self._early_stop:
+            opts += ",early_stop=True"
+        if self._opening_book is not None:
+            opts += ",opening_book={}".format(self._opening_book)
+        return "{}({})".format(self.__class__.__name__, opts)
 
 class MinimaxPlayer(Player):
-    def __init__(self, eval_func, depth_limit=6):
+    engines = ['minimax', 'pvs']
+
+    def __init__(self, eval_func, depth_limit=6, tt_size=2**20, time_limit=None, move_ordering=True, workers=None,
+            engine='minimax', aspiration=None, eval_cache_size=0, canonical_keys=False):
+        """tt_size is the number of transposition table slots. Use 0 to search without one.
+
+        If time_limit (seconds per move) is given, the player searches with iterative deepening
+        until the time runs out and depth_limit becomes the deepest it will search.
+
+        move_ordering turns on killer moves, the history heuristic and the game's static move
+        ordering (see move_ordering.py).
+
+        If workers is given, the root moves are searched in that many worker processes
+        (see parallel_minimax.py). Call close() when done with the player to stop them.
+
+        engine is either "minimax" (minimax.py) or "pvs" (negamax.py). The pvs engine always
+        deepens iteratively, using aspiration windows of +/- aspiration around the previous
+        iteration's score if it is given.
+
+        eval_cache_size is the number of evaluated positions to remember (see
+        eval_funcs.CachedEvalFn). Use 0 to evaluate every leaf.
+
+        canonical_keys makes the transposition table and the evaluation cache store mirror
+        images and rotations of a position as one (see Game.getCanonicalKey())."""
+        if engine not in MinimaxPlayer.engines:
+            raise ValueError('Unknown engine "{}". Options: {}'.format(engine, ', '.join(MinimaxPlayer.engines)))
+        MinimaxPlayer._check_workers(workers, time_limit, engine)
         self._eval_func = eval_func
+        self._eval_cache = None
+        self._canonical_keys = canonical_keys
+        self.set_eval_cache_size(eval_cache_size)
         self._depth_limit = depth_limit
+        self._tt_size = tt_size
+        self._tt = None
+        self._time_limit = time_limit
+        self._move_ordering = move_ordering
+        self._orderer = None
+        self._orderer_game = None
+        self._last_stats = None
+        self._workers = workers
+        self._parallel = None
+        self._engine = engine
+        self._aspiration = aspiration
+
+    def get_best_move(self, game: Game):
+        """Searches for the best move without playing it. Search statistics are available
+        afterwards from get_last_stats()."""
+        stats = minimax.SearchStats()
+        self._last_stats = stats
+        book_move = self.get_book_move(game)
+        if book_move is not None:
+            return book_move
+        eval_func = self._get_search_eval_func()
+        if self._workers is not None:
+            # Each task would get its own empty copy of the cache, so the workers evaluate directly
+            move = self._get_parallel_search(type(game)).best_move(game, self._eval_func,
+                depth_limit=self._depth_limit, stats=stats)
+        elif self._engine == 'pvs':
+            move, _ = negamax.pvs_search(game, eval_func, depth_limit=self._depth_limit,
+                time_limit=self._time_limit, aspiration=self._aspiration, tt=self.get_transposition_table(),
+                orderer=self.get_move_orderer(type(game)), stats=stats)
+        elif self._time_limit is not None:
+            move, _ = minimax.minimax_iterative_deepening(game, eval_func, self._time_limit,
+                max_depth=self._depth_limit, quiet=True, tt=self.get_transposition_table(),
+                orderer=self.get_move_orderer(type(game)), stats=stats)
+        else:
+            move = minimax.minimax_best_move(game, eval_func, quiet=True, depth_limit=self._depth_limit,
+                tt=self.get_transposition_table(), orderer=self.get_move_orderer(type(game)), stats=stats)
+        return move
 
     def play(self, game: Game):
-        move = minimax.minimax_best_move(game, self._eval_func, quiet=True, depth_limit=self._depth_limit)
+        move = self.get_best_move(game)
         #print("Minimax plays {}".format(move))
         game.doMove(move)
 
+    def _get_parallel_search(self, game_class):
+        # Imported here so the worker processes aren't needed unless asked for
+        from parallel_minimax import ParallelMinimax
+        if self._parallel is None or self._parallel.game_class != game_class:
+            self.close()
+            self._parallel = ParallelMinimax(game_class, self._workers, self._tt_size, self._move_ordering,
+                self._canonical_keys)
+        return self._parallel
+
+    def close(self):
+        """Stops the worker processes if the player is searching with workers"""
+        if self._parallel is not None:
+            self._parallel.close()
+            self._parallel = None
+
+    def get_move_orderer(self, game_class):
+        """Returns the move orderer for game_class, or None if move ordering is off"""
+        if not self._move_ordering:
+            return None
+        if self._orderer is None or self._orderer_game != game_class:
+            self._orderer = MoveOrderer.for_game(game_class)
+            self._orderer_game = game_class
+        return self._orderer
+
+    def get_last_stats(self):
+        """SearchStats of the last search, or None if the player hasn't searched yet"""
+        return self._last_stats
+
+    def get_nodes_searched(self) -> int:
+        return self._last_stats.nodes if self._last_stats is not None else 0
+
+    def get_transposition_table(self):
+        """The table is created on first use so players stay cheap to pickle"""
+        if self._tt is None and self._tt_size > 0:
+            self._tt = TranspositionTable(self._tt_size, self._canonical_keys)
+        return self._tt
+
     def set_depth_limit(self, depth_limit):
         self._depth_limit = depth_limit
 
+    @staticmethod
+    def _check_workers(workers, time_limit, engine):
+        if workers is not None and (time_limit is not None or engine != 'minimax'):
+            raise ValueError('Searching with workers only supports the minimax engine without a time limit')
+
+    def set_time_limit(self, time_limit):
+        MinimaxPlayer._check_workers(self._workers, time_limit, self._engine)
+        self._time_limit = time_limit
+
+    def get_time_limit(self):
+        return self._time_limit
+
     def set_eval_func(self, eval_func):
+        # Stored values came from the old evaluation function
+        if self._eval_cache is not None:
+            self._eval_cache = CachedEvalFn(eval_func, self._eval_cache.get_size(), self._canonical_keys)
+        if self._tt is not None:
+            self._tt.clear()
         self._eval_func = eval_func
 
+    def set_eval_cache_size(self, eval_cache_size):
+        """Caches up to eval_cache_size evaluated positions. Use 0 to turn the cache off."""
+        self._eval_cache = None
+        if eval_cache_size > 0:
+            self._eval_cache = CachedEvalFn(self._eval_func, eval_cache_size, self._canonical_keys)
+
+    def set_canonical_keys(self, canonical_keys):
+        """Whether symmetric positions share transposition table and cache entries"""
+        self._canonical_keys = canonical_keys
+        # Made again on first use with the new keys
+        self._tt = None
+        if self._eval_cache is not None:
+            self.set_eval_cache_size(self._eval_cache.get_size())
+
+    def get_canonical_keys(self):
+        return self._canonical_keys
+
+    def get_eval_cache(self):
+        """The CachedEvalFn used by the search, or None if positions aren't cached"""
+        return self._eval_cache
+
     def get_depth_limit(self):
         return self._depth_limit
 
     def get_eval_func(self):
         return self._eval_func
 
+    def _get_search_eval_func(self):
+        """The evaluation function wrapped in the cache if there is one"""
+        if self._eval_cache is not None:
+            return self._eval_cache
+        return self._eval_func
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_tt'] = None
+        state['_orderer'] = None
+        state['_orderer_game'] = None
+        state['_parallel'] = None
+        return state
+
+    def set_engine(self, engine):
+        if engine not in MinimaxPlayer.engines:
+            raise ValueError('Unknown engine "{}". Options: {}'.format(engine, ', '.join(MinimaxPlayer.engines)))
+        MinimaxPlayer._check_workers(self._workers, self._time_limit, engine)
+        self._engine = engine
+
+    def get_engine(self):
+        return self._engine
+
     def __str__(self):
-        return "{}(eval_func={},depth_limit={})".format(self.__class__.__name__, self._eval_func.__name__, self._depth_limit)
+        opts = "eval_func={},depth_limit={}".format(self._eval_func.__name__, self._depth_limit)
+        if self._time_limit is not None:
+            opts += ",time_limit={}".format(self._time_limit)
+        if self._engine != 'minimax':
+            opts += ",engine={}".format(self._engine)
+        if self._canonical_keys:
+            opts += ",canonical_keys=True"
+        if self._opening_book is not None:
+            opts += ",opening_book={}".format(self._opening_book)
+        return "{}({})".format(self.__class__.__name__, opts)
 
 class RandomPlayer(Player):
     """
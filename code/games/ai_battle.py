@@ -2,7 +2,11 @@ from Player import MinimaxPlayer, MonteCarloPlayer, Player, RandomPlayer
 import eval_funcs
 from Games import *
 import time
+import math
+import random
 from itertools import combinations
+from game_record import GameRecord, GameRecordWriter
+from results_db import SQLiteGameWrite
 
 import datetime
 from pathlib import Path
@@ -47,13 +51,26 @@ class AllPlayerBattle:
     Information about how to use this can be found in the README.
     """
     def __init__(self, game_choice, write_to_csv=True, move_limit=300, play_count=5,
-            players=None, use_tqdm=True) -> None:
+            players=None, use_tqdm=True, sprt=None, record_path=None, seed=None, results_backend='csv') -> None:
+        """If sprt is given (an SPRT to copy the bounds and error rates from), each matchup
+        plays up to play_count games per side and stops once the SPRT is decided. The SPRT of
+        every matchup ends up in sprt_results.
+
+        If record_path is given, every game is appended to the game record log there (see
+        game_record.py). If seed is given, every game gets its own seed counting up from it.
+
+        results_backend picks where results go when write_to_csv is set: "csv" writes a new CSV
+        file for the run and "sqlite" adds them to results.db (see results_db.py)."""
         if use_tqdm and not has_tqdm:
             raise NoTQDMException('TQDM is not installed: <python3 -m pip install tqdm>')
         self.use_tqdm = use_tqdm
 
         self.move_limit = move_limit
         self.play_count = play_count
+        self.sprt = sprt
+        self.sprt_results = []
+        self.seed = seed
+        self.record_writer = GameRecordWriter(record_path) if record_path is not None else None
         self.write_to_csv = write_to_csv
         self.writer = None
         self.pbar = None
@@ -71,8 +88,12 @@ class AllPlayerBattle:
 
         self.game_matchups = AllPlayerBattle.generate_player_matchups(self.players)
 
+        result_writers = AllPlayerBattle.get_result_writer_map()
+        if results_backend not in result_writers:
+            raise ValueError('Unknown results backend "{}". Options: {}'.format(results_backend,
+                ', '.join(result_writers)))
         if self.write_to_csv:
-            self.writer = CSVGameWrite(self.game_class.__name__)
+            self.writer = result_writers[results_backend](self.game_class.__name__)
 
     @staticmethod
     def parse_game_type(game_choice):
@@ -99,6 +120,15 @@ class AllPlayerBattle:
 
         return games
 
+    @staticmethod
+    def get_result_writer_map():
+        """Writers for each results_backend. They are given the game name and have to support
+        open(), write_result(row) and close()."""
+        return {
+            "csv": CSVGameWrite,
+            "sqlite": SQLiteGameWrite
+        }
+
     @staticmethod
     def get_default_players(game_class):
         defaults = {
@@ -156,6 +186,12 @@ class AllPlayerBattle:
     def get_game_class(self):
         return self.game_class
 
+    def get_matchup_seed(self, matchup_number):
+        """First seed of a matchup's games, so no two games share a seed"""
+        if self.seed is None:
+            return None
+        return self.seed + matchup_number * 2 * self.play_count
+
     def battle(self, suppress_output=True):
         """Actually runs the matchups"""
         # Setup
@@ -164,6 +200,8 @@ class AllPlayerBattle:
         game = self.game
         if self.writer is not None:
             self.writer.open()
+        if self.record_writer is not None:
+            self.record_writer.open()
         if self.use_tqdm and not self.pbar:
             self.pbar = tqdm.tqdm(total=(len(self.game_matchups) * 2 * self.play_count), desc='Simulating games')
 
@@ -173,13 +211,25 @@ class AllPlayerBattle:
             self.__update_res(res)
 
         print("Playing", game.__class__.__name__)
-        for p1, p2 in self.game_matchups:
-            new_battle = AIBattle(game, p1, p2, update=add_results_and_update,
-                move_limit=self.move_limit, play_count=self.play_count)
-            new_battle.go()
+        for i, (p1, p2) in enumerate(self.game_matchups):
+            battle_opts = {'seed': self.get_matchup_seed(i), 'record_writer': self.record_writer}
+            if self.sprt is not None:
+                new_battle = SPRTBattle(game, p1, p2, update=add_results_and_update,
+                    move_limit=self.move_limit, play_count=self.play_count, sprt=self.sprt.copy(), **battle_opts)
+                new_battle.go()
+                self.sprt_results.append((str(p1), str(p2), new_battle.sprt))
+                if self.use_tqdm:
+                    # Games that weren't needed
+                    self.pbar.update(max(0, 2 * self.play_count - new_battle.sprt.get_game_count()))
+            else:
+                new_battle = AIBattle(game, p1, p2, update=add_results_and_update,
+                    move_limit=self.move_limit, play_count=self.play_count, **battle_opts)
+                new_battle.go()
 
         if self.writer is not None:
             self.writer.close()
+        if self.record_writer is not None:
+            self.record_writer.close()
 
         if self.use_tqdm:
             self.pbar.close()
@@ -223,28 +273,65 @@ class AIBattle:
     """
     Class to run a single matchup between 2 players. Call `go()` to run the matchup.
     """
-    def __init__(self, game: Game, p1: Player, p2: Player, update=print, move_limit=300, play_count=5) -> None:
+    def __init__(self, game: Game, p1: Player, p2: Player, update=print, move_limit=300, play_count=5,
+            seed=None, record_writer: GameRecordWriter=None) -> None:
+        """If seed is given, game number i is played with seed + i. If record_writer is given
+        (and open), every game is written to it."""
         self.p1 = p1
         self.p2 = p2
         self.game = game
         self.update = update
         self.move_limit = move_limit
         self.play_count = play_count
+        self.seed = seed
+        self.record_writer = record_writer
 
     def go(self):
         print(str(self.p1), "vs.", str(self.p2))
-        for _ in range(self.play_count):
-            result = self.__play_game(self.p1, self.p2)
+        for i in range(self.play_count):
+            result = self._play_numbered_game(i, self.p1, self.p2)
             self.update(result)
-        for _ in range(self.play_count):
-            result = self.__play_game(self.p2, self.p1)
+        for i in range(self.play_count):
+            result = self._play_numbered_game(self.play_count + i, self.p2, self.p1)
             self.update(result)
 
-    def __play_game(self, maxPlayer, minPlayer):
-        return AIBattle._play_game(self.game, self.move_limit, maxPlayer, minPlayer)
+    def get_game_seed(self, game_number):
+        if self.seed is None:
+            return None
+        return self.seed + game_number
+
+    def _play_numbered_game(self, game_number, maxPlayer, minPlayer):
+        seed = self.get_game_seed(game_number)
+        record = None
+        if self.record_writer is not None:
+            record = GameRecord(self.game.__class__.__name__, str(maxPlayer), str(minPlayer), seed)
+        result = AIBattle._play_game(self.game, self.move_limit, maxPlayer, minPlayer, seed, record)
+        if record is not None:
+            self.record_writer.write(record)
+        return result
 
     @staticmethod
-    def _play_game(game, move_limit, maxPlayer, minPlayer):
+    def _play_move(game, player: Player, record: GameRecord=None):
+        """Has player make a move, adding it to record if given. Returns the time it took."""
+        if record is None:
+            timer = time.perf_counter()
+            player.play(game)
+            return time.perf_counter() - timer
+
+        moves = game.getValidMoves()
+        timer = time.perf_counter()
+        player.play(game)
+        think_time = time.perf_counter() - timer
+        record.add_move(moves.index(game.getMoveHist()[-1]), think_time, player.get_nodes_searched())
+        return think_time
+
+    @staticmethod
+    def _play_game(game, move_limit, maxPlayer, minPlayer, seed=None, record: GameRecord=None):
+        """Plays a game from the starting position and then resets it. If seed is given, the
+        random module is seeded with it first. If record is given, the moves and the winner
+        are added to it."""
+        if seed is not None:
+            random.seed(seed)
         moveCount = 0
         max_tottime = min_tottime = 0
         while True:
@@ -254,17 +341,15 @@ class AIBattle:
                 break
             if game.getWinner() is not None:
                 break
-            timer = time.perf_counter()
-            maxPlayer.play(game)
-            max_tottime += time.perf_counter() - timer
+            max_tottime += AIBattle._play_move(game, maxPlayer, record)
 
             if game.getWinner() is not None:
                 break
-            timer = time.perf_counter()
-            minPlayer.play(game)
-            min_tottime += time.perf_counter() - timer
+            min_tottime += AIBattle._play_move(game, minPlayer, record)
 
         winner = game.getWinner()
+        if record is not None:
+            record.winner = winner
         game.undoMoves(len(game.getMoveHist()))
         return {
             'game': game.__class__.__name__,
@@ -276,6 +361,124 @@ class AIBattle:
             'move_count': moveCount
         }
 
+class SPRT:
+    """
+    Sequential probability ratio test on the results of a matchup, from the first player's
+    point of view. H0 is that the first player is elo0 Elo stronger than the second and H1 is
+    that it is elo1 Elo stronger. Games are added one at a time with `add_result()` and the
+    test is decided once the log-likelihood ratio (LLR) leaves the bounds given by the error
+    rates alpha (accepting H1 when H0 is true) and beta (accepting H0 when H1 is true).
+
+    Wins, draws and losses are tested with the generalized SPRT, which approximates the LLR
+    from the mean and variance of the game scores. Half a game of each result is added to the
+    counts so a run of identical results still has a variance.
+    """
+    def __init__(self, elo0=0, elo1=50, alpha=0.05, beta=0.05) -> None:
+        if elo0 >= elo1:
+            raise ValueError('elo0 must be less than elo1')
+        self.elo0 = elo0
+        self.elo1 = elo1
+        self.alpha = alpha
+        self.beta = beta
+        self.lower_bound = math.log(beta / (1 - alpha))
+        self.upper_bound = math.log((1 - beta) / alpha)
+        self.wins = 0
+        self.draws = 0
+        self.losses = 0
+
+    def copy(self):
+        """A new test with the same bounds and error rates and no results"""
+        return SPRT(self.elo0, self.elo1, self.alpha, self.beta)
+
+    @staticmethod
+    def elo_to_score(elo: float) -> float:
+        return 1 / (1 + 10 ** (-elo / 400))
+
+    @staticmethod
+    def score_to_elo(score: float) -> float:
+        if score <= 0:
+            return float('-inf')
+        if score >= 1:
+            return float('inf')
+        return -400 * math.log10(1 / score - 1)
+
+    def add_result(self, winner: str, first_player_max: bool):
+        """Adds a game result ("max", "min", or anything else for a draw) where the first
+        player played max if first_player_max"""
+        if winner not in ('max', 'min'):
+            self.draws += 1
+        elif (winner == 'max') == first_player_max:
+            self.wins += 1
+        else:
+            self.losses += 1
+
+    def get_game_count(self):
+        return self.wins + self.draws + self.losses
+
+    def _score_stats(self):
+        """Mean and variance of the score of a game, with the half game prior"""
+        wins, draws, losses = self.wins + 0.5, self.draws + 0.5, self.losses + 0.5
+        count = wins + draws + losses
+        mean = (wins + draws / 2) / count
+        variance = (wins + draws / 4) / count - mean ** 2
+        return mean, variance, count
+
+    def llr(self) -> float:
+        mean, variance, count = self._score_stats()
+        score0 = SPRT.elo_to_score(self.elo0)
+        score1 = SPRT.elo_to_score(self.elo1)
+        return (score1 - score0) * (2 * mean - score0 - score1) / (2 * variance / count)
+
+    def get_status(self):
+        """"H1" if the first player is elo1 stronger, "H0" if it is no more than elo0 stronger,
+        or None if the test needs more games"""
+        llr = self.llr()
+        if llr >= self.upper_bound:
+            return 'H1'
+        if llr <= self.lower_bound:
+            return 'H0'
+        return None
+
+    def elo_estimate(self, z=1.96):
+        """Elo difference of the first player over the second and its confidence interval
+        (z standard deviations, so 95% by default)"""
+        mean, variance, count = self._score_stats()
+        margin = z * math.sqrt(variance / count)
+        return (SPRT.score_to_elo(mean), SPRT.score_to_elo(mean - margin), SPRT.score_to_elo(mean + margin))
+
+    def __str__(self):
+        elo, low, high = self.elo_estimate()
+        return "LLR {:.2f} ({:.2f}, {:.2f}) [{}, {}] W/D/L {}/{}/{} Elo {:.1f} (95% CI {:.1f} to {:.1f}) {}".format(
+            self.llr(), self.lower_bound, self.upper_bound, self.elo0, self.elo1, self.wins, self.draws,
+            self.losses, elo, low, high, self.get_status() or 'undecided')
+
+class SPRTBattle(AIBattle):
+    """
+    AIBattle that stops as soon as its SPRT is decided. Players switch sides every game and
+    at most play_count games are played per side. The test is available as `sprt` afterwards.
+    """
+    def __init__(self, game: Game, p1: Player, p2: Player, update=print, move_limit=300, play_count=500,
+            sprt: SPRT=None, seed=None, record_writer: GameRecordWriter=None) -> None:
+        super().__init__(game, p1, p2, update, move_limit, play_count, seed, record_writer)
+        self.sprt = sprt if sprt is not None else SPRT()
+
+    def get_game_players(self, game_number):
+        """The (max, min) players of a game, and whether p1 is max"""
+        if game_number % 2 == 0:
+            return self.p1, self.p2, True
+        return self.p2, self.p1, False
+
+    def go(self):
+        print(str(self.p1), "vs.", str(self.p2))
+        for game_number in range(2 * self.play_count):
+            maxPlayer, minPlayer, p1_max = self.get_game_players(game_number)
+            result = self._play_numbered_game(game_number, maxPlayer, minPlayer)
+            self.sprt.add_result(result['winner'], p1_max)
+            self.update(result)
+            if self.sprt.get_status() is not None:
+                break
+        print(str(self.sprt))
+
 class CSVGameWrite:
     """
     Class to write the game results to a CSV file.
@@ -0,0 +1,233 @@
+import numpy as np
+import random
+from functools import lru_cache
+from Games import Game, Connect4
+from Connect4 import Connect4Bitboard, BLACK
+
+try:
+    from tictactoe import TicTacToeGame
+except ModuleNotFoundError:
+    TicTacToeGame = None
+
+"""
+
+This file contains batch rollouts: many random games played out from one position at the
+same time, with NumPy arrays holding a board per game.
+
+Every game starts from the same position and plays one move per ply, so the player to move
+is the same in all of them. Each ply picks a random move for every game, plays it and checks
+for wins as whole-array operations, then drops the games that are over.
+
+Connect 4 games are kept as bitboards (see Connect4.Connect4Bitboard) and tic tac toe games
+as a 9 bit mask per player. Other games fall back to Game.randomPlayouts().
+
+Each ply of a batch costs a few dozen NumPy calls however many games it holds, so a batch
+has a fixed cost of about 0.25ms for tic tac toe and 0.85ms for Connect 4, against about
+0.05ms and 0.08ms per serial rollout. Fewer rollouts than the break-even count of the game
+are played one by one instead.
+
+"""
+
+def _outcome_counts(winner, count):
+    """(max wins, min wins, draws) of count games that all had winner"""
+    if winner == 'max':
+        return count, 0, 0
+    elif winner == 'min':
+        return 0, count, 0
+    return 0, 0, count
+
+def _playout_counts(game: Game, count):
+    max_wins = min_wins = 0
+    for winner, _ in game.randomPlayouts(count):
+        if winner == 'max':
+            max_wins += 1
+        elif winner == 'min':
+            min_wins += 1
+    return max_wins, min_wins, count - max_wins - min_wins
+
+def _nth_set_bit_table(bits):
+    """Table of the n'th set bit of every bits-bit mask, indexed by [mask, n]"""
+    return np.array([[bit for bit in range(bits) if mask >> bit & 1] + [0] * (bits - bin(mask).count('1'))
+        for mask in range(1 << bits)], dtype=np.int64)
+
+def _has_line(stones, line_shifts):
+    """Which bitboards in stones have a line (see _Connect4Tables.line_shifts)"""
+    found = None
+    for shifts in line_shifts:
+        runs = stones
+        for shift in shifts:
+            runs = runs & (runs >> shift)
+        found = runs if found is None else found | runs
+    return found != 0
+
+class _Connect4Tables:
+    """
+    Lookup tables for playing Connect 4 boards of one size as arrays. Squares are indexed by
+    their bit in the bitboard. Every game's column heights are packed into one number, with
+    height_bits bits per column.
+    """
+    def __init__(self, board: Connect4Bitboard) -> None:
+        cols, rows, col_bits = board.cols, board.rows, board._col_bits
+        self.height_bits = rows.bit_length()
+        self.height_shifts = np.arange(cols, dtype=np.uint64) * np.uint64(self.height_bits)
+        self.height_mask = np.uint64((1 << self.height_bits) - 1)
+        self.col_starts = np.arange(cols, dtype=np.uint64) * np.uint64(col_bits)
+        # Open columns are a mask with a bit per column
+        self.col_flags = 1 << np.arange(cols, dtype=np.int64)
+        self.open_count = np.array([bin(mask).count('1') for mask in range(1 << cols)], dtype=np.int64)
+        self.nth_open = _nth_set_bit_table(cols)
+        # A line of board.win stones is found by and-ing the stones with themselves shifted
+        # along the line. Each step doubles the length of the runs found, until the last step
+        # tops them up to board.win.
+        steps = []
+        length = 1
+        while length < board.win:
+            step = min(length, board.win - length)
+            steps.append(step)
+            length += step
+        self.line_shifts = [[np.uint64(direction * step) for step in steps] for direction in board._directions]
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def get(cols, rows, win):
+        return _Connect4Tables(Connect4Bitboard(cols, rows, win))
+
+    def pack_heights(self, heights):
+        return sum(height << (col * self.height_bits) for col, height in enumerate(heights))
+
+def _connect4_fits(board: Connect4Bitboard):
+    """Whether the board fits in a 64 bit bitboard, with few enough columns for a table of
+    every set of open columns"""
+    return board.cols * board._col_bits <= 64 and board.cols <= 12
+
+def connect4_rollout_counts(game: Connect4, count, rng: np.random.Generator):
+    """(max wins, min wins, draws) of count random games played out from the game's position"""
+    winner = game.getWinner()
+    if winner is not None:
+        return _outcome_counts(winner, count)
+    board = game.game
+    if not _connect4_fits(board):
+        return _playout_counts(game, count)
+
+    tables = _Connect4Tables.get(board.cols, board.rows, board.win)
+    if board.turn == BLACK:
+        mover, waiting = board.black, board.white
+    else:
+        mover, waiting = board.white, board.black
+    mover_is_max = board.turn == BLACK
+    mover = np.full(count, mover, dtype=np.uint64)
+    waiting = np.full(count, waiting, dtype=np.uint64)
+    heights = np.full(count, tables.pack_heights(board.heights), dtype=np.uint64)
+    open_cols = np.full(count, sum(1 << col for col in range(board.cols) if board.canPlay(col)), dtype=np.int64)
+    max_wins = min_wins = 0
+    # Every game has the same number of stones, so they all fill the board on the same ply.
+    # The games still going then are draws.
+    for _ in range(board.cols * board.rows - sum(board.heights)):
+        pick = (rng.random(len(mover)) * tables.open_count[open_cols]).astype(np.int64)
+        cols = tables.nth_open[open_cols, pick]
+        shifts = tables.height_shifts[cols]
+        rows = (heights >> shifts) & tables.height_mask
+        squares = tables.col_starts[cols] + rows
+        mover |= np.left_shift(np.uint64(1), squares)
+        heights += np.left_shift(np.uint64(1), shifts)
+        open_cols -= (rows == board.rows - 1) * tables.col_flags[cols]
+
+        won = _has_line(mover, tables.line_shifts)
+        wins = int(won.sum())
+        if mover_is_max:
+            max_wins += wins
+        else:
+            min_wins += wins
+        if wins != 0:
+            playing = ~won
+            mover, waiting, heights, open_cols = mover[playing], waiting[playing], heights[playing], open_cols[playing]
+            if len(mover) == 0:
+                break
+        mover, waiting = waiting, mover
+        mover_is_max = not mover_is_max
+    return max_wins, min_wins, count - max_wins - min_wins
+
+# Tic tac toe squares are bit (move - 1) of a 9 bit mask. Tables indexed by a mask: whether it
+# holds a line, how many squares it has, and its n'th square.
+_TTT_LINES = [sum(1 << square for square in line) for line in
+    ((0, 1, 2), (3, 4, 5), (6, 7, 8), (0, 3, 6), (1, 4, 7), (2, 5, 8), (0, 4, 8), (2, 4, 6))]
+_TTT_HAS_LINE = np.array([any(mask & line == line for line in _TTT_LINES) for mask in range(512)])
+_TTT_SQUARE_COUNT = np.array([bin(mask).count('1') for mask in range(512)], dtype=np.int64)
+_TTT_NTH_SQUARE = _nth_set_bit_table(9)
+
+def tictactoe_rollout_counts(game, count, rng: np.random.Generator):
+    """(max wins, min wins, draws) of count random games played out from the game's position"""
+    winner = game.getWinner()
+    if winner is not None:
+        return _outcome_counts(winner, count)
+    key = game.getBoardKey()
+    x_mask = sum(1 << square for square, spot in enumerate(key) if spot == 'X')
+    o_mask = sum(1 << square for square, spot in enumerate(key) if spot == 'O')
+    mover_is_max = game.getPlayer() == 'max'
+    mover = np.full(count, x_mask if mover_is_max else o_mask, dtype=np.int64)
+    waiting = np.full(count, o_mask if mover_is_max else x_mask, dtype=np.int64)
+    max_wins = min_wins = 0
+    # Nobody has won, so every game has an empty square until the board fills up
+    while len(mover) != 0:
+        empty = 511 & ~(mover | waiting)
+        num_empty = _TTT_SQUARE_COUNT[empty]
+        if num_empty[0] == 0:
+            break
+        pick = (rng.random(len(mover)) * num_empty).astype(np.int64)
+        mover |= np.left_shift(1, _TTT_NTH_SQUARE[empty, pick])
+
+        won = _TTT_HAS_LINE[mover]
+        if mover_is_max:
+            max_wins += int(won.sum())
+        else:
+            min_wins += int(won.sum())
+        playing = ~won
+        mover, waiting = waiting[playing], mover[playing]
+        mover_is_max = not mover_is_max
+    return max_wins, min_wins, count - max_wins - min_wins
+
+# Fewest rollouts that are quicker to play as arrays than one by one
+_MIN_CONNECT4_BATCH = 16
+_MIN_TICTACTOE_BATCH = 8
+
+def has_batch_rollouts(game: Game, count=None):
+    """Whether rollout_counts() plays the game's rollouts as arrays instead of one by one (for
+    count rollouts if it is given)"""
+    if isinstance(game, Connect4):
+        return _connect4_fits(game.game) and (count is None or count >= _MIN_CONNECT4_BATCH)
+    return (TicTacToeGame is not None and isinstance(game, TicTacToeGame)
+        and (count is None or count >= _MIN_TICTACTOE_BATCH))
+
+def rollout_counts(game: Game, count, rng: np.random.Generator=None):
+    """(max wins, min wins, draws) of count random games played out from the game's position.
+    The game is left where it was.
+
+    If no generator is given, one is seeded from the random module so random.seed() repeats
+    the rollouts."""
+    if not has_batch_rollouts(game, count):
+        return _playout_counts(game, count)
+    if rng is None:
+        rng = np.random.default_rng(random.getrandbits(64))
+    if isinstance(game, Connect4):
+        return connect4_rollout_counts(game, count, rng)
+    if TicTacToeGame is not None and isinstance(game, TicTacToeGame):
+        return tictactoe_rollout_counts(game, count, rng)
+    return _playout_counts(game, count)
+
+class RolloutLeafEval:
+    """
+    MCTS leaf evaluator (see mcts.mcts_tree_search()) that plays `rollouts` random games from
+    the leaf with rollout_counts() and returns the fractions of them won by max and min.
+
+    The rollouts are seeded from the random module, which the parallel_mcts workers seed for
+    every task, so random.seed() repeats a search.
+    """
+    def __init__(self, rollouts=1000) -> None:
+        self.rollouts = rollouts
+
+    def __call__(self, game: Game):
+        max_wins, min_wins, _ = rollout_counts(game, self.rollouts)
+        return max_wins / self.rollouts, min_wins / self.rollouts
+
+    def __str__(self):
+        return "rollouts{}".format(self.rollouts)
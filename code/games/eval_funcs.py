@@ -1,10 +1,11 @@
 from typing import Type
 from Games import *
 import numpy as np
-from functools import reduce
-from Connect4 import BLACK, WHITE, NONE, diagonalsNeg, diagonalsPos
+from functools import reduce, lru_cache
+from Connect4 import BLACK, WHITE, NONE, Connect4Bitboard, diagonalsNeg, diagonalsPos
 from itertools import groupby, chain
-import random
+from collections import OrderedDict
+from batch_rollout import rollout_counts
 
 """
 
@@ -15,28 +16,39 @@ to the bottom and check out the EvalFnGuide class.
 
 """
 
-def eval_checkers_1(game: CheckersGame, depth=None) -> int:
+def _checkers_board_array(game: CheckersGame) -> np.ndarray:
+    """The board as a dim x dim array of piece bytes, viewing the game's binary board"""
     dim = game.getDim()
+    return np.frombuffer(game.getBinaryBoard(), dtype=np.uint8, count=dim*dim, offset=1).reshape(dim, dim)
+
+def _checkers_piece_table(black_man: int, black_king: int, white_man: int, white_king: int) -> np.ndarray:
+    """Lookup table from a piece byte to its value. Bit 0x01 is set for a piece, 0x02 for white and 0x04 for kings."""
+    table = np.zeros(256, dtype=np.int64)
+    for piece in range(256):
+        if piece & 0x01 == 0:
+            continue
+        if piece & 0x02:
+            table[piece] = white_king if piece & 0x04 else white_man
+        else:
+            table[piece] = black_king if piece & 0x04 else black_man
+    return table
+
+# Base piece value and bonus for kings
+_checkers_piece_vals = _checkers_piece_table(100, 300, -100, -300)
+# Bonus for pieces in the home row, looked up on row dim-1 for black and row 0 for white
+_checkers_black_home_vals = _checkers_piece_table(100, 100, 0, 0)
+_checkers_white_home_vals = _checkers_piece_table(0, 0, -100, -100)
+# End of game piece counts (kings count twice)
+_checkers_black_counts = _checkers_piece_table(1, 2, 0, 0)
+_checkers_white_counts = _checkers_piece_table(0, 0, 1, 2)
+
+def eval_checkers_1(game: CheckersGame, depth=None) -> int:
+    board = _checkers_board_array(game)
 
     if len(game.getValidMoves()) == 0:
         # game is finished, so just count pieces
-        w_count = 0
-        b_count = 0
-        for row in range(dim):
-            for col in range(dim):
-                piece = game.getPieceAtPos(row, col)
-                if piece == '.':
-                    continue
-                elif piece == 'w':
-                    w_count += 1
-                elif piece == 'W':
-                    w_count += 2
-                elif piece == 'b':
-                    b_count += 1
-                elif piece == 'B':
-                    b_count += 2
-                else:
-                    raise ValueError("Unknown checkers piece ({}) at pos ({},{})".format(piece, row, col))
+        w_count = int(_checkers_white_counts[board].sum())
+        b_count = int(_checkers_black_counts[board].sum())
 
         if w_count == b_count:
             return 0
@@ -45,32 +57,12 @@ def eval_checkers_1(game: CheckersGame, depth=None) -> int:
         else:
             return 2**32
 
-    val = 0
+    # Base piece value and bonus for kings
+    val = int(_checkers_piece_vals[board].sum())
 
-    for row in range(dim):
-        for col in range(dim):
-            piece = game.getPieceAtPos(row, col)
-            if piece == '.':
-                continue
-            elif piece.lower() == 'w':
-                # Base piece value
-                val -= 100
-
-                # Bonus for pieces in the home row (controlling king spots)
-                if row == 0:
-                    val -= 100
-                
-                # Bonus for kings
-                if piece == 'W':
-                    val -= 200
-            elif piece.lower() == 'b':
-                val += 100
-
-                if row == dim-1:
-                    val += 100
-                
-                if piece == 'B':
-                    val += 200
+    # Bonus for pieces in the home row (controlling king spots)
+    val += int(_checkers_white_home_vals[board[0]].sum())
+    val += int(_checkers_black_home_vals[board[-1]].sum())
 
     if game.getWhoseMove() == 'WHITE':
         val -= 20
@@ -96,37 +88,31 @@ def _eval_othello_1_position_multiplier(row: int, col: int, dim: int) -> int:
     assert row > 1 and row < (dim - 2) and col > 1 and col < (dim - 2)
     return 1
 
+@lru_cache(maxsize=None)
+def _eval_othello_1_position_weights(dim: int) -> np.ndarray:
+    return np.array([[_eval_othello_1_position_multiplier(row, col, dim) for col in range(dim)] for row in range(dim)],
+        dtype=np.int64)
+
+def _othello_board_array(game: OthelloGame) -> np.ndarray:
+    """The board as a dim x dim array (1 for black, -1 for white), viewing the game's binary board"""
+    dim = game.getDim()
+    return np.frombuffer(game.getBinaryBoard(), dtype=np.int8, count=dim*dim, offset=1).reshape(dim, dim)
+
 def eval_othello_1(game: OthelloGame, depth=None) -> int:
     dim = game.getDim()
+    board = _othello_board_array(game)
 
     if len(game.getValidMoves()) == 0:
-        white_count = 0
-        black_count = 0
-        for row in range(dim):
-            for col in range(dim):
-                piece = game.getPieceAtPos(row, col)
-                if piece == 'W':
-                    white_count += 1
-                elif piece == 'B':
-                    black_count += 1
+        white_count = int(np.count_nonzero(board == -1))
+        black_count = int(np.count_nonzero(board == 1))
         if white_count == black_count:
             return 0
         elif white_count > black_count:
             return -1 * 2**32
         else:
             return 2**32
-    
-    val = 0
-
-    for row in range(dim):
-        for col in range(dim):
-            piece = game.getPieceAtPos(row, col)
-            if piece == '.':
-                continue
-            sign = 1 if piece == 'B' else -1
-            val += sign * _eval_othello_1_position_multiplier(row, col, dim)
 
-    return val
+    return int((board * _eval_othello_1_position_weights(dim)).sum())
 
 def __win_connect4(num: int, last_move_player: str, depth: int) -> float:
     score = connect4_depth_affected_score(num, depth)
@@ -320,6 +306,68 @@ def eval_connect4_3(game: Connect4, depth=1) -> int:
 
     return score
 
+# Set bits in each byte, for counting bits on NumPy versions before 2.0
+_byte_bit_counts = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
+
+def _bitwise_count_bytes(words: np.ndarray) -> np.ndarray:
+    """np.bitwise_count() for arrays of uint64"""
+    return _byte_bit_counts[words[..., np.newaxis].view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+_bitwise_count = getattr(np, 'bitwise_count', _bitwise_count_bytes)
+
+def _connect4_split_words(stones: int, num_words: int) -> np.ndarray:
+    """Splits a bitboard into 64-bit words, lowest bits first"""
+    return np.array([(stones >> (64 * i)) & (2**64 - 1) for i in range(num_words)], dtype=np.uint64)
+
+@lru_cache(maxsize=None)
+def _connect4_window_table(cols: int, rows: int, win: int):
+    """Winning windows of a board size as a (windows x 64-bit words) array, the masks of the stones
+    worth each center bonus, and the score of an open window by its number of stones"""
+    bitboard = Connect4Bitboard(cols, rows, win)
+    num_words = (cols * (rows + 1) + 63) // 64
+    windows = np.array([_connect4_split_words(window, num_words) for window in bitboard.getWindows()])
+
+    # Stones closer to the center column are worth more
+    center = {}
+    column_mask = (1 << rows) - 1
+    for col in range(cols):
+        weight = int(cols // 2 - min(abs(col - (cols - 1) / 2), cols // 2))
+        if weight > 0:
+            center[weight] = center.get(weight, 0) | (column_mask << (col * (rows + 1)))
+
+    window_scores = np.array([_connect4_window_scores.get(count, 0) for count in range(win + 1)], dtype=np.int64)
+    return windows, tuple(center.items()), window_scores
+
+# Score for an open window (no stones of the other player) by the number of stones in it
+_connect4_window_scores = {2: 2, 3: 5}
+
+def eval_connect4_4(game: Connect4, depth=1) -> int:
+    """Scores open windows of 2 and 3 stones and stones near the center. The stones in every
+    winning window are counted at once from the bitboards with the windows precomputed for
+    the board size."""
+    bitboard = game.game
+    winner = bitboard.getWinner()
+    if winner is not None:
+        return 10000 if winner == BLACK else -10000
+    elif len(bitboard.moves) == bitboard.cols * bitboard.rows:
+        return 0
+
+    windows, center, window_scores = _connect4_window_table(bitboard.cols, bitboard.rows, bitboard.win)
+    black = bitboard.black
+    white = bitboard.white
+    num_words = windows.shape[1]
+    if num_words == 1:
+        black_counts = _bitwise_count(windows[:, 0] & np.uint64(black))
+        white_counts = _bitwise_count(windows[:, 0] & np.uint64(white))
+    else:
+        black_counts = _bitwise_count(windows & _connect4_split_words(black, num_words)).sum(axis=1)
+        white_counts = _bitwise_count(windows & _connect4_split_words(white, num_words)).sum(axis=1)
+
+    score = int(window_scores[black_counts[white_counts == 0]].sum())
+    score -= int(window_scores[white_counts[black_counts == 0]].sum())
+    for weight, mask in center:
+        score += weight * (bin(black & mask).count('1') - bin(white & mask).count('1'))
+    return score
 
 def eval_c4pop10_1(game: C4Pop10Game) -> int:
     redScore = game.getRedScore()
@@ -361,22 +409,98 @@ except ModuleNotFoundError:
 
 _num_rollouts = 2
 def eval_random_rollout(game: Game) -> int:
-    score = 0
+    """Max's wins minus min's wins over _num_rollouts random games played out from the
+    position, so scores are between -_num_rollouts and _num_rollouts"""
     key = game.getBoardKey()
-    for _ in range(_num_rollouts):
-        winner = game.getWinner()
-        count = 0
-        while winner is None:
-            game.doMove(random.choice(game.getValidMoves()))
-            count += 1
-            winner = game.getWinner()
-        game.undoMoves(count)
-        if winner == 'max':
-            score += 1
-        elif winner == 'min':
-            score -= 1
+    max_wins, min_wins, _ = rollout_counts(game, _num_rollouts)
     assert key == game.getBoardKey()
-    return score
+    return max_wins - min_wins
+
+class RandomRolloutEval:
+    """
+    eval_random_rollout with `rollouts` random games per position, so scores are between
+    -rollouts and rollouts. Connect 4 and tic tac toe play enough rollouts as arrays (see
+    batch_rollout.py), which makes a big count much cheaper than playing them one by one,
+    but a batch costs at least about 1ms for Connect 4 and 0.25ms for tic tac toe.
+    """
+    def __init__(self, rollouts=_num_rollouts) -> None:
+        self.rollouts = rollouts
+        self.__name__ = 'eval_random_rollout{}'.format(rollouts)
+
+    def __call__(self, game: Game, *args):
+        max_wins, min_wins, _ = rollout_counts(game, self.rollouts)
+        return max_wins - min_wins
+
+    def __str__(self):
+        return self.__name__
+
+class CachedEvalFn:
+    """
+    Wraps an evaluation function so each position is only evaluated once while it stays in
+    the cache. Positions are keyed on `getBoardKey()` and the player to move, and the least
+    recently used entry is evicted once max_size positions are stored.
+
+    The wrapper is called like the function it wraps and has the same __name__. The cache
+    isn't pickled, so every process that gets a copy starts with an empty one.
+
+    If canonical is set, positions are keyed on `getCanonicalKey()` so mirror images and
+    rotations of a position share an entry. Only use it with evaluation functions that score
+    symmetric positions the same.
+
+    Random evaluations like eval_random_rollout can be cached too. The first estimate for a
+    position is kept while it stays in the cache, so positions the search reaches again
+    score the same and cost nothing to evaluate.
+    """
+    def __init__(self, eval_fn, max_size=2**16, canonical=False):
+        if max_size <= 0:
+            raise ValueError('Evaluation cache size must be positive')
+        self.eval_fn = eval_fn
+        self.__name__ = eval_fn.__name__
+        self._max_size = max_size
+        self.canonical = canonical
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, game: Game, *args):
+        board_key = game.getCanonicalKey()[0] if self.canonical else game.getBoardKey()
+        key = (board_key, game.getPlayer()) + args
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        value = self.eval_fn(game, *args)
+        self._entries[key] = value
+        if len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+        return value
+
+    def get_hit_rate(self) -> float:
+        """Fraction of calls answered from the cache"""
+        calls = self.hits + self.misses
+        return self.hits / calls if calls > 0 else 0.0
+
+    def get_size(self):
+        return self._max_size
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_entries'] = OrderedDict()
+        return state
+
+    def __str__(self):
+        return self.__name__
 
 class EvalFnGuide:
     """
@@ -386,7 +510,7 @@ class EvalFnGuide:
     # Map of game type to possible evaluation functions
     eval_fns = {
         OthelloGame: [eval_othello_1],
-        Connect4: [eval_connect4_1, eval_connect4_2, eval_connect4_3],
+        Connect4: [eval_connect4_1, eval_connect4_2, eval_connect4_3, eval_connect4_4],
         TicTacToeGame: [eval_tic_tac_toe_1],
         C4Pop10Game: [eval_c4pop10_1],
         CheckersGame: [eval_checkers_1]
@@ -0,0 +1,209 @@
+from Games import Game
+from array import array
+from pathlib import Path
+import struct
+import sys
+
+"""
+
+This file contains a compact binary log of played games.
+
+A log is two files. The record file holds the games back to back, and the index file holds
+the byte offset of every game in the record file so any game can be read without scanning
+the ones before it. Both files are only ever appended to.
+
+A record is its length (u32) followed by:
+    game type, max player and min player   (u16 length + UTF-8 each)
+    seed                                   (i64, -1 if the game wasn't seeded)
+    winner                                 (u8, see _WINNERS)
+    number of moves                        (u32)
+    moves                                  (u8 each, index of the move in getValidMoves())
+    think time of each move in seconds     (f32 each)
+    nodes searched for each move           (u32 each)
+
+Numbers are little-endian.
+
+"""
+
+_HEADER = struct.Struct('<qBI')
+_LENGTH = struct.Struct('<I')
+_STRING_LENGTH = struct.Struct('<H')
+_OFFSET = struct.Struct('<Q')
+_WINNERS = [None, 'max', 'min', 'draw']
+# array() uses the machine's byte order
+_BIG_ENDIAN = sys.byteorder == 'big'
+
+class GameRecord:
+    """
+    One played game. Moves are kept as indexes into getValidMoves() at the time they were
+    played, so replay() needs a game of the same type to turn them back into moves.
+    """
+    def __init__(self, game: str, max_player: str, min_player: str, seed=None, winner=None) -> None:
+        self.game = game
+        self.max_player = max_player
+        self.min_player = min_player
+        self.seed = seed
+        self.winner = winner
+        self.moves = array('B')
+        self.times = array('f')
+        self.nodes = array('I')
+
+    def add_move(self, move_index: int, think_time: float, nodes: int):
+        if move_index > 255:
+            raise ValueError('Move index {} does not fit in a record'.format(move_index))
+        self.moves.append(move_index)
+        self.times.append(think_time)
+        self.nodes.append(min(nodes, 2**32 - 1))
+
+    def replay(self, game: Game):
+        """Plays the recorded moves on game (which should be at its starting position) and
+        returns them"""
+        moves = []
+        for move_index in self.moves:
+            move = game.getValidMoves()[move_index]
+            game.doMove(move)
+            moves.append(move)
+        return moves
+
+    def get_moves(self, game: Game):
+        """The recorded moves, found by replaying them on game and undoing them again"""
+        moves = self.replay(game)
+        game.undoMoves(len(moves))
+        return moves
+
+    def to_bytes(self) -> bytes:
+        body = bytearray()
+        for string in (self.game, self.max_player, self.min_player):
+            encoded = string.encode('utf8')
+            body += _STRING_LENGTH.pack(len(encoded)) + encoded
+        body += _HEADER.pack(-1 if self.seed is None else self.seed, _WINNERS.index(self.winner), len(self.moves))
+        for values in (self.moves, self.times, self.nodes):
+            if _BIG_ENDIAN and values.itemsize > 1:
+                values = array(values.typecode, values)
+                values.byteswap()
+            body += values.tobytes()
+        return _LENGTH.pack(len(body)) + body
+
+    @staticmethod
+    def from_bytes(body) -> 'GameRecord':
+        """Reads a record from its bytes, without the length in front"""
+        body = memoryview(body)
+        offset = 0
+        strings = []
+        for _ in range(3):
+            (length,) = _STRING_LENGTH.unpack_from(body, offset)
+            offset += _STRING_LENGTH.size
+            strings.append(bytes(body[offset:offset + length]).decode('utf8'))
+            offset += length
+        seed, winner, move_count = _HEADER.unpack_from(body, offset)
+        offset += _HEADER.size
+
+        record = GameRecord(*strings, seed=None if seed == -1 else seed, winner=_WINNERS[winner])
+        for values in (record.moves, record.times, record.nodes):
+            size = values.itemsize * move_count
+            values.frombytes(body[offset:offset + size])
+            if _BIG_ENDIAN and values.itemsize > 1:
+                values.byteswap()
+            offset += size
+        return record
+
+    def __len__(self):
+        return len(self.moves)
+
+    def __str__(self):
+        return "{}: {} vs. {} ({} moves, winner {})".format(self.game, self.max_player, self.min_player,
+            len(self.moves), self.winner)
+
+def _index_path(path) -> Path:
+    path = Path(path)
+    return path.with_name(path.name + '.idx')
+
+class GameRecordWriter:
+    """
+    Appends GameRecords to a log. Records are buffered in memory and written once the buffer
+    holds buffer_size bytes, and when the writer is closed.
+    """
+    def __init__(self, path, buffer_size=2**20) -> None:
+        self.path = Path(path)
+        self.index_path = _index_path(path)
+        self.buffer_size = buffer_size
+        self._file = None
+        self._index_file = None
+        self._buffer = bytearray()
+        self._index_buffer = bytearray()
+        self._offset = 0
+
+    def open(self):
+        if self._file is None:
+            self._file = self.path.open('ab')
+            self._index_file = self.index_path.open('ab')
+            self._offset = self._file.seek(0, 2)
+
+    def write(self, record: GameRecord):
+        if self._file is None:
+            raise Exception('Writer must first be opened!')
+        data = record.to_bytes()
+        self._index_buffer += _OFFSET.pack(self._offset)
+        self._buffer += data
+        self._offset += len(data)
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        # The records go first so the index never points past the end of the record file
+        self._file.write(self._buffer)
+        self._file.flush()
+        self._index_file.write(self._index_buffer)
+        self._index_file.flush()
+        self._buffer = bytearray()
+        self._index_buffer = bytearray()
+
+    def close(self):
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._index_file.close()
+            self._file = None
+            self._index_file = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class GameRecordReader:
+    """
+    Reads a log written by GameRecordWriter. Iterating streams through the record file in
+    order, and indexing uses the index file to read a single record.
+    """
+    def __init__(self, path, buffer_size=2**20) -> None:
+        self.path = Path(path)
+        self.index_path = _index_path(path)
+        self.buffer_size = buffer_size
+
+    def __len__(self):
+        return self.index_path.stat().st_size // _OFFSET.size
+
+    def __getitem__(self, i: int) -> GameRecord:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('Game record index out of range')
+        with self.index_path.open('rb') as index_file:
+            index_file.seek(i * _OFFSET.size)
+            (offset,) = _OFFSET.unpack(index_file.read(_OFFSET.size))
+        with self.path.open('rb') as record_file:
+            record_file.seek(offset)
+            (length,) = _LENGTH.unpack(record_file.read(_LENGTH.size))
+            return GameRecord.from_bytes(record_file.read(length))
+
+    def __iter__(self):
+        with self.path.open('rb', buffering=self.buffer_size) as record_file:
+            while True:
+                length_bytes = record_file.read(_LENGTH.size)
+                if len(length_bytes) < _LENGTH.size:
+                    return
+                (length,) = _LENGTH.unpack(length_bytes)
+                yield GameRecord.from_bytes(record_file.read(length))
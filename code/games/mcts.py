@@ -1,5 +1,6 @@
 import math
-import random
+import time
+import numpy as np
 from Games import Game
 
 """
@@ -8,6 +9,9 @@ This file contains the code to actually use the MCTS algorithm to get the next m
 
 This file is inspired by Lab 7 in CSC 480 with Professor Rodrigo Canaan.
 
+The tree is stored as parallel NumPy arrays (see _MCTS_Tree) rather than one object per node,
+so choosing a child is one vectorized UCB computation over the node's children.
+
 """
 
 has_tqdm = True
@@ -16,13 +20,89 @@ try:
 except ModuleNotFoundError:
     has_tqdm = False
 
-def _next_player(player):
-    if player == 'max':
-        return 'min'
-    elif player == 'min':
-        return 'max'
-    else:
-        raise ValueError('Unknown player "{}"'.format(player))
+class MCTSStats:
+    """Counters filled in by a search so its speed can be measured. Searches that stop early
+    (see mcts_tree_search()) add the simulations and seconds of their budget they didn't use."""
+    def __init__(self):
+        self.simulations = 0
+        self.elapsed = 0
+        self.early_stops = 0
+        self.simulations_saved = 0
+        self.time_saved = 0
+
+    def simulations_per_second(self):
+        if self.elapsed == 0:
+            return 0
+        return self.simulations / self.elapsed
+
+    def __str__(self):
+        out = "simulations={},elapsed={:.3f},per_second={:.1f}".format(self.simulations, self.elapsed,
+            self.simulations_per_second())
+        if self.early_stops != 0:
+            out += ",early_stops={},simulations_saved={},time_saved={:.3f}".format(self.early_stops,
+                self.simulations_saved, self.time_saved)
+        return out
+
+class _SearchBudget:
+    """
+    Decides when a search stops: after max_simulations, once time_limit seconds have passed,
+    or (if early_stop is set) once the most visited root child has more visits over the
+    second one than there are simulations left, so it can't be overtaken. Whichever comes
+    first. At least one simulation is always run.
+    """
+    def __init__(self, max_simulations=None, time_limit=None, early_stop=False):
+        if max_simulations is None and time_limit is None:
+            raise ValueError('A search needs a number of simulations or a time limit')
+        self.start = time.perf_counter()
+        self.max_simulations = max_simulations
+        self.deadline = self.start + time_limit if time_limit is not None else None
+        self.early_stop = early_stop
+        self.stopped_early = False
+        self.simulations_left = 0
+
+    def _get_simulations_left(self, done, now):
+        """Simulations the rest of the budget allows, at the speed so far if it is timed"""
+        left = float('inf')
+        if self.max_simulations is not None:
+            left = self.max_simulations - done
+        if self.deadline is not None:
+            left = min(left, (self.deadline - now) * done / max(now - self.start, 1e-9))
+        return left
+
+    def should_stop(self, tree, done):
+        """Whether to stop after done simulations on tree"""
+        if done == 0:
+            return False
+        if self.max_simulations is not None and done >= self.max_simulations:
+            return True
+        now = time.perf_counter()
+        if self.deadline is not None and now >= self.deadline:
+            return True
+        if self.early_stop:
+            counts = tree.count[tree.children(_MCTS_Tree.ROOT)]
+            left = self._get_simulations_left(done, now)
+            if len(counts) < 2:
+                settled = True
+            else:
+                second, best = np.partition(counts, len(counts) - 2)[-2:]
+                settled = best - second > left
+            if settled:
+                self.stopped_early = True
+                self.simulations_left = left
+                return True
+        return False
+
+    def update_stats(self, stats: MCTSStats, done):
+        stats.simulations += done
+        now = time.perf_counter()
+        stats.elapsed += now - self.start
+        if self.stopped_early:
+            stats.early_stops += 1
+            stats.simulations_saved += int(self.simulations_left)
+            if self.deadline is not None:
+                stats.time_saved += max(0, self.deadline - now)
+            else:
+                stats.time_saved += self.simulations_left * (now - self.start) / done
 
 class _Game_Lookahead:
     def __init__(self, game: Game, depth = 0):
@@ -37,116 +117,280 @@ class _Game_Lookahead:
         self.depth = max(0, self.depth - moveCount)
         self.game.undoMoves(moveCount)
 
-class _MCTS_Node:
-    def __init__(self, move, depth, parent, player):
-        self.min_wins = 0
-        self.max_wins = 0
-        self.count = 0
-        self.move = move
-        self.parent = parent
-        self.children = {}
-        self.player = player
-        self.depth = depth
-    
-    def add_child(self, move):
-        if move in self.children:
-            raise ValueError('Child already exists')
-        else:
-            self.children[move] = _MCTS_Node(move, self.depth + 1, self, _next_player(self.player))
-            return self.children[move]
-    
-    def _get_p_win(self, player):
-        if self.count == 0:
-            raise ValueError("Must be updated at least once to get win probability")
-        if player == 'min':
-            return self.min_wins / self.count
-        elif player == 'max':
-            return self.max_wins / self.count
-        else:
-            raise ValueError('Unknown player "{}"'.format(player))
-    
-    def _get_expected_value(self):
-        if self.count == 0:
-            raise ValueError("Must be updated at least once to get expected value")
-        return (self.max_wins - self.min_wins) / self.count
-
-    def _get_explore_term(self, parent, c=1):
-        if parent is not None:
-            return c * math.sqrt(2 * math.log(parent.count) / self.count)
-        else:
-            return 0
+_MAX = 1
+_MIN = -1
 
-    def get_ucb(self, c):
-        if self.count == 0:
-            raise ValueError("Must be updated at least once to calculate UCB")
-        p_win = self._get_expected_value()
-        if self.player == "max":
-            p_win *= -1
-        explore_term = self._get_explore_term(self.parent, c)
-        return p_win + explore_term
-    
-def _expand(game: _Game_Lookahead, node):
-    # Make sure the game state is at the current node
-    assert game.depth == node.depth
-    for move in game.game.getValidMoves():
-        child = None
-        try:
-            child = node.add_child(move)
-        except ValueError:
-            continue
-        return child
-    
-    return None
+def _player_sign(player):
+    if player == 'max':
+        return _MAX
+    elif player == 'min':
+        return _MIN
+    else:
+        raise ValueError('Unknown player "{}"'.format(player))
 
+class _MCTS_Tree:
+    """
+    MCTS tree stored as parallel arrays indexed by node. Node 0 is the root. The children of
+    a node are stored next to each other, from first_child[node] to
+    first_child[node] + num_children[node], and are all added when the node is first expanded.
+    A child that hasn't been visited yet has a count of 0.
 
-def _best_child(node, c):
-    return max(node.children.values(), key=lambda child: child.get_ucb(c))
+    Moves are stored as ids into a table of the moves seen by the tree.
+    """
+    ROOT = 0
 
+    def __init__(self, player, capacity=1024):
+        self._capacity = 0
+        self.size = 1
+        self.count = np.zeros(0, dtype=np.int64)
+        self.max_wins = np.zeros(0, dtype=np.float64)
+        self.min_wins = np.zeros(0, dtype=np.float64)
+        self.parent = np.zeros(0, dtype=np.int32)
+        self.first_child = np.zeros(0, dtype=np.int32)
+        self.num_children = np.zeros(0, dtype=np.int32)
+        self.move_id = np.zeros(0, dtype=np.int32)
+        # +1 if max is to move at the node, -1 if min is
+        self.player = np.zeros(0, dtype=np.int8)
+        self._grow(capacity)
+        self.player[_MCTS_Tree.ROOT] = _player_sign(player)
+        self._moves = []
+        self._move_ids = {}
 
-def _tree_policy(game: _Game_Lookahead, node, c):
-    assert game.depth == node.depth
+    def _grow(self, capacity):
+        old = self._capacity
+        self._capacity = capacity
+        for name, fill in (('count', 0), ('max_wins', 0), ('min_wins', 0), ('parent', -1),
+                ('first_child', -1), ('num_children', 0), ('move_id', -1), ('player', 0)):
+            arr = getattr(self, name)
+            grown = np.full(capacity, fill, dtype=arr.dtype)
+            grown[:old] = arr[:old]
+            setattr(self, name, grown)
 
-    if game.game.getWinner() is not None:
-        return node
-    
-    unexplored_child = _expand(game, node)
-    if unexplored_child is not None:
-        game.doMove(unexplored_child.move)
-        return unexplored_child
-    else:
-        next = _best_child(node, c)
-        game.doMove(next.move)
-        return _tree_policy(game, next, c)
-
-def _backup(node, winner):
-    if node is None:
-        return
-    node.count += 1
-    if winner == 'min':
-        node.min_wins += 1
-    elif winner == 'max':
-        node.max_wins += 1
-    _backup(node.parent, winner)
-
-def _default_policy(game: _Game_Lookahead):
-    winner = game.game.getWinner()
-    while winner is None:
-        game.doMove(random.choice(game.game.getValidMoves()))
-        winner = game.game.getWinner()
-    return winner
-
-def mcts(game: Game, player: str, iterations: int, quiet=False, c=1):
+    def get_player(self):
+        """The player to move at the root"""
+        return 'max' if self.player[_MCTS_Tree.ROOT] == _MAX else 'min'
+
+    def get_move(self, node):
+        return self._moves[self.move_id[node]]
+
+    def _get_move_id(self, move):
+        move_id = self._move_ids.get(move)
+        if move_id is None:
+            move_id = len(self._moves)
+            self._moves.append(move)
+            self._move_ids[move] = move_id
+        return move_id
+
+    def is_expanded(self, node):
+        return self.first_child[node] >= 0
+
+    def children(self, node):
+        """Range of the node's children"""
+        start = self.first_child[node]
+        if start < 0:
+            return range(0)
+        return range(start, start + self.num_children[node])
+
+    def expand(self, node, moves):
+        """Adds a child to node for every move"""
+        count = len(moves)
+        if self.size + count > self._capacity:
+            self._grow(max(self._capacity * 2, self.size + count))
+        start = self.size
+        end = start + count
+        self.parent[start:end] = node
+        self.move_id[start:end] = [self._get_move_id(move) for move in moves]
+        self.player[start:end] = -self.player[node]
+        self.first_child[node] = start
+        self.num_children[node] = count
+        self.size = end
+
+    def find_child(self, node, move):
+        """The child of node reached by move, or None"""
+        move_id = self._move_ids.get(move)
+        if move_id is None:
+            return None
+        for child in self.children(node):
+            if self.move_id[child] == move_id:
+                return child
+        return None
+
+    def select_child(self, node, c):
+        """Returns the first unvisited child of node, or the child with the best UCB if all of
+        them have been visited"""
+        start = self.first_child[node]
+        end = start + self.num_children[node]
+        counts = self.count[start:end]
+        unvisited = np.flatnonzero(counts == 0)
+        if len(unvisited) != 0:
+            return start + int(unvisited[0])
+        # The player choosing at node wants the value from their point of view, and the
+        # children have the other player to move
+        expected = (self.max_wins[start:end] - self.min_wins[start:end]) / counts * -self.player[start:end]
+        ucb = expected + c * np.sqrt(2 * math.log(self.count[node]) / counts)
+        return start + int(np.argmax(ucb))
+
+    def backup(self, path, value):
+        """Adds the result of a simulation to every node on the path from the root. value is
+        (max's wins, min's wins), which are fractions if the leaf was estimated from many
+        rollouts."""
+        path = np.asarray(path)
+        self.count[path] += 1
+        max_wins, min_wins = value
+        if max_wins:
+            self.max_wins[path] += max_wins
+        if min_wins:
+            self.min_wins[path] += min_wins
+
+    def add_virtual_loss(self, path, loss):
+        """Counts loss more simulations through every node on the path, each one lost by the
+        player who chose the node. Descents made while the path's result is pending then pick
+        other paths. A negative loss takes it back."""
+        path = np.asarray(path)
+        self.count[path] += loss
+        # The player to move at a node is the one who didn't choose it
+        max_to_move = self.player[path] == _MAX
+        self.max_wins[path[max_to_move]] += loss
+        self.min_wins[path[~max_to_move]] += loss
+
+    def root_stats(self):
+        """Visit and win counts of the root's visited children as {move: (count, max_wins, min_wins)}"""
+        stats = {}
+        for child in self.children(_MCTS_Tree.ROOT):
+            if self.count[child] > 0:
+                stats[self.get_move(child)] = (int(self.count[child]), float(self.max_wins[child]),
+                    float(self.min_wins[child]))
+        return stats
+
+    def subtree(self, node):
+        """Copies the subtree under node into a new tree with node as its root"""
+        new = _MCTS_Tree('max', capacity=max(1024, self.size))
+        new._moves = list(self._moves)
+        new._move_ids = dict(self._move_ids)
+        # (node in this tree, node in the new tree)
+        queue = [(node, _MCTS_Tree.ROOT)]
+        for name in ('count', 'max_wins', 'min_wins', 'move_id', 'player'):
+            getattr(new, name)[_MCTS_Tree.ROOT] = getattr(self, name)[node]
+        while len(queue) != 0:
+            old_node, new_node = queue.pop()
+            if not self.is_expanded(old_node):
+                continue
+            start = self.first_child[old_node]
+            count = self.num_children[old_node]
+            new_start = new.size
+            for name in ('count', 'max_wins', 'min_wins', 'move_id', 'player'):
+                getattr(new, name)[new_start:new_start + count] = getattr(self, name)[start:start + count]
+            new.parent[new_start:new_start + count] = new_node
+            new.first_child[new_node] = new_start
+            new.num_children[new_node] = count
+            new.size += count
+            for i in range(count):
+                queue.append((start + i, new_start + i))
+        return new
+
+def _pick_root_move(player: str, root_stats, robust=False):
+    """The visited root child with the best expected value for player, or the most visited
+    one (the robust child) if robust is set"""
+    sign = _player_sign(player)
+    value = lambda move: sign * (root_stats[move][1] - root_stats[move][2]) / root_stats[move][0]
+    if robust:
+        return max(root_stats, key=lambda move: (root_stats[move][0], value(move)))
+    return max(root_stats, key=value)
+
+def _tree_policy(game: _Game_Lookahead, tree: _MCTS_Tree, c):
+    """Walks down the tree until reaching a child that has never been visited or the end of
+    the game. Returns the path of nodes from the root."""
+    node = _MCTS_Tree.ROOT
+    path = [node]
+    while game.game.getWinner() is None:
+        if not tree.is_expanded(node):
+            tree.expand(node, game.game.getValidMoves())
+        node = tree.select_child(node, c)
+        game.doMove(tree.get_move(node))
+        path.append(node)
+        if tree.count[node] == 0:
+            break
+    return path
+
+# (max's wins, min's wins) of a finished game
+_WINNER_VALUES = {'max': (1, 0), 'min': (0, 1), 'draw': (0, 0)}
+
+def _default_policy(game: _Game_Lookahead, oracle=None, leaf_eval=None):
+    """Returns (max's wins, min's wins) from the leaf. If an oracle (like a
+    tablebase.Tablebase) knows who wins from the leaf, its answer is used. Otherwise
+    leaf_eval is asked, or one random game is played out (see Game.randomPlayouts())."""
+    if oracle is not None:
+        winner = oracle.get_winner(game.game)
+        if winner is not None:
+            return _WINNER_VALUES[winner]
+    if leaf_eval is not None:
+        return leaf_eval(game.game)
+    return _WINNER_VALUES[game.game.randomPlayouts()[0][0]]
+
+def mcts_advance_root(root: _MCTS_Tree, moves):
+    """Follows moves down from the root and returns that subtree as a new tree, or None if the
+    tree never explored that far. Everything outside the subtree is dropped."""
+    node = _MCTS_Tree.ROOT
+    for move in moves:
+        node = root.find_child(node, move)
+        if node is None:
+            return None
+    return root.subtree(node)
+
+def mcts_tree_search(game: Game, player: str, iterations: int, quiet=False, c=1, root: _MCTS_Tree=None,
+        stats: MCTSStats=None, oracle=None, leaf_eval=None, time_limit=None, early_stop=False):
+    """Same as mcts(), but also returns the searched tree. Passing that tree (or a subtree from
+    mcts_advance_root()) back as root continues the search from it instead of from scratch.
+
+    oracle is probed at every leaf before playing it out. It needs a get_winner(game) that
+    returns the winner with perfect play, or None if it doesn't know.
+
+    leaf_eval replaces the single random playout from a leaf. It is called with the game at
+    the leaf and returns (max's wins, min's wins) as fractions of one simulation, like
+    batch_rollout.RolloutLeafEval does from many rollouts.
+
+    iterations is the most simulations to run and time_limit the most seconds to search for.
+    Either can be None, and the search stops at whichever is reached first. If early_stop is
+    set, the search also stops once the most visited root child can't be overtaken in the
+    rest of the budget, and that child is the move picked. What stopping early saved is added
+    to stats."""
+    budget = _SearchBudget(iterations, time_limit, early_stop)
     key = game.getBoardKey()
-    start_node = _MCTS_Node(None, 0, None, player)
+    if root is None:
+        root = _MCTS_Tree(player)
     lookahead = _Game_Lookahead(game)
-    iter = range(iterations)
+    pbar = None
     if not quiet and has_tqdm:
-        iter = tqdm(iter, desc='Calculating Monte-Carlo')
-    for _ in iter:
-        node = _tree_policy(lookahead, start_node, c)
-        value = _default_policy(lookahead)
+        pbar = tqdm(total=iterations, desc='Calculating Monte-Carlo')
+    done = 0
+    while not budget.should_stop(root, done):
+        path = _tree_policy(lookahead, root, c)
+        value = _default_policy(lookahead, oracle, leaf_eval)
         lookahead.undoMoves(lookahead.depth)
-        _backup(node, value)
+        root.backup(path, value)
         assert key == game.getBoardKey()
-    action = _best_child(start_node, 0).move
-    return action
\ No newline at end of file
+        done += 1
+        if pbar is not None:
+            pbar.update()
+    if pbar is not None:
+        pbar.close()
+    action = _pick_root_move(player, root.root_stats(), early_stop)
+    if stats is not None:
+        budget.update_stats(stats, done)
+    return action, root
+
+def mcts_root_stats(root: _MCTS_Tree):
+    """Visit and win counts of the root's children as {move: (count, max_wins, min_wins)}"""
+    return root.root_stats()
+
+def mcts_best_move_from_stats(player: str, root_stats, robust=False):
+    """The move mcts() would pick from a root whose children have the given counts. Used to
+    pick a move from counts merged from several trees. robust picks the most visited move, as
+    mcts() does with early_stop."""
+    return _pick_root_move(player, root_stats, robust)
+
+def mcts(game: Game, player: str, iterations: int, quiet=False, c=1, stats: MCTSStats=None, oracle=None,
+        leaf_eval=None, time_limit=None, early_stop=False):
+    action, _ = mcts_tree_search(game, player, iterations, quiet, c, stats=stats, oracle=oracle, leaf_eval=leaf_eval,
+        time_limit=time_limit, early_stop=early_stop)
+    return action
@@ -4,6 +4,7 @@ from BoardTest import getBoardValue
 from Player import MonteCarloPlayer
 from interactive_agent import InteractiveAgent, InteractiveGameRunner
 from mcts import mcts
+from batch_rollout import RolloutLeafEval
 import argparse
 try:
     from tictactoe import TicTacToeGame
@@ -34,9 +35,8 @@ class InteractiveMCTSGame(InteractiveAgent):
 
     def do_ai_agent_move(self):
         game = self.game
-        player = game.getPlayer()
         startkey = game.getBoardKey()
-        move = mcts(game, player, self.player.get_num_iters(), c=self.player.get_c())
+        move = self.player.get_best_move(game)
         assert game.getBoardKey() == startkey
         print("MCTS plays {}".format(move))
         game.doMove(move)
@@ -59,18 +59,35 @@ class InteractiveMCTSGameRunner(InteractiveGameRunner):
         """Can override the number of iterations MCTS does and what the exploration parameter is"""
         parser.add_argument('--num-iters', '-n', metavar='iterations', type=int, required=False, help="MCTS iterations")
         parser.add_argument('--c', '-c', metavar='c', required=False, type=float, help="C value")
+        parser.add_argument('--time-limit', '-t', metavar='seconds', type=float, required=False,
+            help="Most seconds to search for per move")
+        parser.add_argument('--early-stop', action='store_true',
+            help="Stop searching once the most visited move can't be overtaken")
+        parser.add_argument('--leaf-rollouts', metavar='rollouts', type=int, required=False,
+            help="Estimate each leaf from this many random games played as arrays (Connect 4 and Tic Tac Toe)")
 
     def player_setup(self, parsed_args, game_class: Type[Game], player: MonteCarloPlayer):
         if parsed_args.num_iters:
             player.set_num_iter(parsed_args.num_iters)
         if parsed_args.c:
             player.set_c(parsed_args.c)
+        if parsed_args.time_limit:
+            player.set_time_limit(parsed_args.time_limit)
+        if parsed_args.early_stop:
+            player.set_early_stop(True)
+        if parsed_args.leaf_rollouts:
+            player.set_leaf_eval(RolloutLeafEval(parsed_args.leaf_rollouts))
 
     def get_interactive_game(self):
         return InteractiveMCTSGame
 
     def get_playing_opts_str(self, player: MonteCarloPlayer) -> str:
-        return f"iterations = {player.get_num_iters()} and c = {player.get_c()}"
+        opts = f"iterations = {player.get_num_iters()} and c = {player.get_c()}"
+        if player.get_time_limit() is not None:
+            opts += f" and time limit = {player.get_time_limit()}s"
+        if player.get_early_stop():
+            opts += " and early stop"
+        return opts
 
 if __name__ == "__main__":
     """If run from the command line, use command line parser class"""
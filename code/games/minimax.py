@@ -1,5 +1,8 @@
 from Games import Game
+from transposition import TranspositionTable, EXACT, LOWER_BOUND, UPPER_BOUND
+from move_ordering import MoveOrderer
 import random
+import time
 
 """
 
@@ -15,42 +18,114 @@ try:
 except ModuleNotFoundError:
     has_tqdm = False
 
-def minimax_val(game: Game, eval_fn, alpha: float, beta: float, depthLimit: int) -> int:
-    key = game.getBoardKey()
+class SearchStats:
+    """Counters filled in by a search so its cost can be measured"""
+    def __init__(self):
+        self.nodes = 0
+        self.leaves = 0
+        self.cutoffs = 0
+        self.tt_hits = 0
+        self.depth = None
+
+    def __str__(self):
+        return "nodes={},leaves={},cutoffs={},tt_hits={}".format(self.nodes, self.leaves, self.cutoffs, self.tt_hits)
+
+class SearchTimeout(Exception):
+    """Raised inside the search when the deadline passes. The game is left wherever
+    the search was, so whoever catches this must undo the moves that were made."""
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+def minimax_val(game: Game, eval_fn, alpha: float, beta: float, depthLimit: int, tt: TranspositionTable=None,
+        deadline: float=None, orderer: MoveOrderer=None, stats: SearchStats=None) -> int:
+    if deadline is not None and time.perf_counter() >= deadline:
+        raise SearchTimeout()
+    if stats is not None:
+        stats.nodes += 1
     moves = game.getValidMoves()
     if depthLimit == 0 or len(moves) == 0:
+        if stats is not None:
+            stats.leaves += 1
         return eval_fn(game)
-    
-    if game.getPlayer() == 'max':
-        max_value = float('-inf')
+
+    key = None
+    transform = None
+    pv_move = None
+    if tt is not None:
+        key, transform = tt.position_key(game)
+        entry = tt.lookup(key)
+        if entry is not None:
+            if entry.depth >= depthLimit:
+                if entry.flag == EXACT:
+                    if stats is not None:
+                        stats.tt_hits += 1
+                    return entry.value
+                elif entry.flag == LOWER_BOUND:
+                    alpha = max(alpha, entry.value)
+                elif entry.flag == UPPER_BOUND:
+                    beta = min(beta, entry.value)
+                if alpha >= beta:
+                    if stats is not None:
+                        stats.tt_hits += 1
+                    return entry.value
+            pv_move = tt.from_stored_move(game, entry.best_move, transform)
+    orig_alpha, orig_beta = alpha, beta
+
+    player = game.getPlayer()
+    if orderer is not None:
+        moves = orderer.order(game, moves, depthLimit, pv_move, player)
+    elif pv_move in moves:
+        # Search the previously best move first since it's the most likely to cause a cutoff
+        moves = [pv_move] + [move for move in moves if move != pv_move]
+
+    best_move = None
+    cutoff = False
+    if player == 'max':
+        value = float('-inf')
         for move in moves:
             game.doMove(move)
-            successor_value = minimax_val(game, eval_fn, alpha, beta, depthLimit-1)
+            successor_value = minimax_val(game, eval_fn, alpha, beta, depthLimit-1, tt, deadline, orderer, stats)
             game.undoMoves(1)
 
-            max_value = max(max_value, successor_value)
+            if successor_value > value:
+                value = successor_value
+                best_move = move
             if successor_value >= beta:
-                return successor_value
+                cutoff = True
+                break
             alpha = max(alpha, successor_value)
-        return max_value
     else:
-        min_value = float('inf')
+        value = float('inf')
         for move in moves:
             game.doMove(move)
-            successor_value = minimax_val(game, eval_fn, alpha, beta, depthLimit-1)
+            successor_value = minimax_val(game, eval_fn, alpha, beta, depthLimit-1, tt, deadline, orderer, stats)
             game.undoMoves(1)
 
-            min_value = min(min_value, successor_value)
+            if successor_value < value:
+                value = successor_value
+                best_move = move
             if successor_value <= alpha:
-                return successor_value
+                cutoff = True
+                break
             beta = min(beta, successor_value)
-        return min_value
 
-def minimax_best_move(game: Game, eval_fn, quiet=False, depth_limit=2) -> str:
-    moves = game.getValidMoves()
-    if len(moves) == 0:
-        raise ValueError('Game is already over')
-    
+    if cutoff:
+        if stats is not None:
+            stats.cutoffs += 1
+        if orderer is not None:
+            orderer.record_cutoff(player, best_move, depthLimit)
+
+    if tt is not None:
+        if value <= orig_alpha:
+            flag = UPPER_BOUND
+        elif value >= orig_beta:
+            flag = LOWER_BOUND
+        else:
+            flag = EXACT
+        tt.store(key, value, depthLimit, flag, tt.to_stored_move(game, best_move, transform))
+    return value
+
+def _minimax_root_vals(game: Game, eval_fn, moves, depth_limit, tt, deadline=None, quiet=True, orderer=None, stats=None):
     vals = {}
     if not quiet and has_tqdm:
         moveitr = tqdm(moves, desc="Calculating minimax")
@@ -58,12 +133,12 @@ def minimax_best_move(game: Game, eval_fn, quiet=False, depth_limit=2) -> str:
         moveitr = moves
     for move in moveitr:
         game.doMove(move)
-        val = minimax_val(game, eval_fn, float('-inf'), float('inf'), depth_limit)
+        val = minimax_val(game, eval_fn, float('-inf'), float('inf'), depth_limit, tt, deadline, orderer, stats)
         game.undoMoves(1)
         vals[move] = val
+    return vals
 
-    # print(vals)
-    
+def _pick_best_move(game: Game, moves, vals, depth_limit, tt):
     if game.getPlayer() == 'max':
         best = max(vals.values())
     else:
@@ -79,4 +154,81 @@ def minimax_best_move(game: Game, eval_fn, quiet=False, depth_limit=2) -> str:
     
     assert len(possibleGoodMoves) != 0
 
-    return random.choice(possibleGoodMoves)
\ No newline at end of file
+    best_move = random.choice(possibleGoodMoves)
+    if tt is not None:
+        key, transform = tt.position_key(game)
+        tt.store(key, best, depth_limit + 1, EXACT, tt.to_stored_move(game, best_move, transform))
+    return best_move
+
+def minimax_best_move(game: Game, eval_fn, quiet=False, depth_limit=2, tt: TranspositionTable=None,
+        orderer: MoveOrderer=None, stats: SearchStats=None) -> str:
+    moves = game.getValidMoves()
+    if len(moves) == 0:
+        raise ValueError('Game is already over')
+
+    if tt is not None:
+        tt.new_search()
+    if orderer is not None:
+        orderer.new_search()
+        orderer.set_root_depth(depth_limit + 1)
+    if stats is not None:
+        stats.depth = depth_limit
+
+    vals = _minimax_root_vals(game, eval_fn, moves, depth_limit, tt, quiet=quiet, orderer=orderer, stats=stats)
+
+    # print(vals)
+
+    return _pick_best_move(game, moves, vals, depth_limit, tt)
+
+def minimax_iterative_deepening(game: Game, eval_fn, time_limit: float, max_depth=64, quiet=False,
+        tt: TranspositionTable=None, orderer: MoveOrderer=None, stats: SearchStats=None):
+    """
+    Searches with depth limits 0, 1, 2, ... up to max_depth until time_limit seconds have passed.
+    Returns the best move of the last iteration that finished along with its depth limit.
+    The first iteration always runs to completion so there is always a move to return.
+
+    Each iteration searches the root moves in order of the previous iteration's values, and the
+    transposition table (one is created if none is given) puts the previous best line first below
+    the root.
+    """
+    moves = game.getValidMoves()
+    if len(moves) == 0:
+        raise ValueError('Game is already over')
+
+    if len(moves) == 1:
+        # Nothing to think about
+        return moves[0], 0
+
+    deadline = time.perf_counter() + time_limit
+    if tt is None:
+        tt = TranspositionTable(2**16)
+    tt.new_search()
+    if orderer is not None:
+        orderer.new_search()
+    hist_len = len(game.getMoveHist())
+    maximizing = game.getPlayer() == 'max'
+
+    best_move = None
+    completed_depth = None
+    for depth in range(max_depth + 1):
+        if orderer is not None:
+            orderer.set_root_depth(depth + 1)
+        try:
+            vals = _minimax_root_vals(game, eval_fn, moves, depth, tt, None if best_move is None else deadline,
+                orderer=orderer, stats=stats)
+        except SearchTimeout:
+            game.undoMoves(len(game.getMoveHist()) - hist_len)
+            break
+        best_move = _pick_best_move(game, moves, vals, depth, tt)
+        completed_depth = depth
+        if stats is not None:
+            stats.depth = depth
+        if not quiet:
+            print("Depth {} done, best move {}".format(depth, best_move))
+
+        # Best moves first for the next iteration, keeping the engine's order for ties
+        moves = sorted(moves, key=lambda move: vals[move], reverse=maximizing)
+        if time.perf_counter() >= deadline:
+            break
+
+    return best_move, completed_depth
@@ -29,7 +29,11 @@ class InteractiveMinimaxGame(InteractiveAgent):
 
     def on_possible_user_move(self, move_number, move):
         self.game.doMove(move)
-        val = minimax_val(self.game, self.player.get_eval_func(), float('-inf'), float('inf'), self.player.get_depth_limit())
+        eval_func = self.player.get_eval_cache()
+        if eval_func is None:
+            eval_func = self.player.get_eval_func()
+        val = minimax_val(self.game, eval_func, float('-inf'), float('inf'), self.player.get_depth_limit(),
+            self.player.get_transposition_table())
         self.game.undoMoves(1)
         print("  {}) {} ({})".format(move_number+1, move, val))
 
@@ -44,7 +48,12 @@ class InteractiveMinimaxGame(InteractiveAgent):
             print("Min wins!")
 
     def do_ai_agent_move(self) -> None:
-        move = minimax_best_move(self.game, eval_fn=self.player.get_eval_func(), depth_limit=self.player.get_depth_limit())
+        move = self.player.get_best_move(self.game)
+        stats = self.player.get_last_stats()
+        print("Searched {} nodes to depth limit {}".format(stats.nodes, stats.depth))
+        eval_cache = self.player.get_eval_cache()
+        if eval_cache is not None:
+            print("Evaluation cache hit rate {:.1%} ({} positions)".format(eval_cache.get_hit_rate(), len(eval_cache)))
         print("Minimax plays {}".format(move))
         self.game.doMove(move)
 
@@ -60,18 +69,43 @@ class InteractiveMinimaxGameRunner(InteractiveGameRunner):
         """Can override depth limit and evaluation function for MinimaxPlayer"""
         parser.add_argument('--depth-limit', '-d', metavar='depth', type=int, required=False, help="Game depth limit")
         parser.add_argument('--eval-fn', '-e', metavar='fn_name', required=False, help="Evaluation function")
+        parser.add_argument('--time-limit', '-t', metavar='seconds', type=float, required=False,
+            help="Seconds per move (searches with iterative deepening up to the depth limit)")
+        parser.add_argument('--engine', metavar='engine', choices=MinimaxPlayer.engines, required=False,
+            help="Search engine. Options: {}".format(', '.join(MinimaxPlayer.engines)))
+        parser.add_argument('--eval-cache', metavar='size', type=int, required=False,
+            help="Number of evaluated positions to cache (0 turns the cache off)")
+        parser.add_argument('--canonical-keys', action='store_true',
+            help="Store mirror images and rotations of a position as one in the transposition table and cache")
 
     def player_setup(self, parsed_args, game_class: Type[Game], player: MinimaxPlayer):
         if parsed_args.depth_limit:
             player.set_depth_limit(parsed_args.depth_limit)
         if parsed_args.eval_fn:
             player.set_eval_func(EvalFnGuide.get_eval_fn_from_str(game_class, parsed_args.eval_fn))
+        if parsed_args.time_limit:
+            player.set_time_limit(parsed_args.time_limit)
+        if parsed_args.engine:
+            player.set_engine(parsed_args.engine)
+        if parsed_args.eval_cache is not None:
+            player.set_eval_cache_size(parsed_args.eval_cache)
+        if parsed_args.canonical_keys:
+            player.set_canonical_keys(True)
 
     def get_interactive_game(self):
         return InteractiveMinimaxGame
 
     def get_playing_opts_str(self, player: MinimaxPlayer) -> str:
-        return f"eval_fn = {player.get_eval_func()} and depth limit = {player.get_depth_limit()}"
+        opts = f"eval_fn = {player.get_eval_func()} and depth limit = {player.get_depth_limit()}"
+        if player.get_time_limit() is not None:
+            opts += f" and time limit = {player.get_time_limit()}s"
+        if player.get_engine() != 'minimax':
+            opts += f" and engine = {player.get_engine()}"
+        if player.get_eval_cache() is not None:
+            opts += f" and eval cache size = {player.get_eval_cache().get_size()}"
+        if player.get_canonical_keys():
+            opts += " and canonical keys"
+        return opts
 
 if __name__ == "__main__":
     """If run from the command line, use command line parser class"""
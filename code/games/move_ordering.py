@@ -0,0 +1,137 @@
+from Games import *
+
+"""
+
+This file contains the move ordering used by minimax.
+
+Alpha-beta prunes the most when the best move is searched first. MoveOrderer sorts the
+moves at each node by:
+    1. the principal variation move (the best move found by an earlier search)
+    2. killer moves (moves that caused a cutoff at the same ply elsewhere in the tree)
+    3. the history heuristic (how often and how deep a move has caused cutoffs)
+    4. an optional static ordering for the game (see StaticMoveOrder)
+
+"""
+
+def order_connect4_center(game: Connect4, moves):
+    """Center columns first"""
+    center = (game.getDimensions()[1] - 1) / 2
+    return sorted(moves, key=lambda move: abs(int(move) - center))
+
+def _checkers_jump_count(move: str) -> int:
+    squares = move.split(' -> ')
+    jumps = 0
+    for start, end in zip(squares, squares[1:]):
+        if abs(ord(start[0]) - ord(end[0])) == 2:
+            jumps += 1
+    return jumps
+
+def order_checkers_captures(game: CheckersGame, moves):
+    """Captures first, taking the most pieces first"""
+    return sorted(moves, key=lambda move: -_checkers_jump_count(move))
+
+def order_othello_corners(game: OthelloGame, moves):
+    """Corners first, then edges, and squares next to the edges last"""
+    dim = game.getDim()
+    def rank(move):
+        row, col = (int(val) for val in move.strip('[]').split(','))
+        edge_row = row in (0, dim - 1)
+        edge_col = col in (0, dim - 1)
+        if edge_row and edge_col:
+            return 0
+        if edge_row or edge_col:
+            return 1
+        if row in (1, dim - 2) or col in (1, dim - 2):
+            return 3
+        return 2
+    return sorted(moves, key=rank)
+
+class StaticMoveOrder:
+    """
+    This class helps to retrieve the static move ordering for a game.
+    """
+
+    # Map of game type to its static move ordering
+    static_orders = {
+        Connect4: order_connect4_center,
+        CheckersGame: order_checkers_captures,
+        OthelloGame: order_othello_corners,
+    }
+
+    @staticmethod
+    def get_order_fn_for_game(game):
+        """Returns the static ordering function for a game type, or None if it doesn't have one"""
+        return StaticMoveOrder.static_orders.get(game)
+
+class MoveOrderer:
+    """
+    Orders moves for minimax and learns from the cutoffs the search reports through
+    `record_cutoff()`. One orderer should be used for one game type, since killer moves
+    and the history table are keyed on the move itself.
+    """
+    def __init__(self, static_order=None, num_killers=2, use_killers=True, use_history=True):
+        self._static_order = static_order
+        self._num_killers = num_killers
+        self._use_killers = use_killers
+        self._use_history = use_history
+        self._killers = []
+        self._history = {}
+        self._root_depth = 0
+
+    @staticmethod
+    def for_game(game_class, **kwargs):
+        """Creates an orderer using the static ordering registered for game_class"""
+        return MoveOrderer(StaticMoveOrder.get_order_fn_for_game(game_class), **kwargs)
+
+    def set_root_depth(self, depth: int):
+        """Depth limit of the root node, so the ply of a node can be found from its depth limit"""
+        self._root_depth = depth
+
+    def _ply(self, depthLimit: int) -> int:
+        return max(0, self._root_depth - depthLimit)
+
+    def _get_killers(self, ply: int):
+        while len(self._killers) <= ply:
+            self._killers.append([])
+        return self._killers[ply]
+
+    def order(self, game: Game, moves, depthLimit: int, pv_move=None, player=None):
+        """Returns moves sorted best-first for the node at depthLimit"""
+        if self._static_order is not None:
+            moves = self._static_order(game, moves)
+        if player is None:
+            player = game.getPlayer()
+
+        killers = self._get_killers(self._ply(depthLimit)) if self._use_killers else []
+        history = self._history if self._use_history else {}
+        def key(move):
+            if move == pv_move:
+                return (0, 0, 0)
+            if move in killers:
+                return (1, killers.index(move), 0)
+            return (2, 0, -history.get((player, move), 0))
+        # sorted() is stable, so moves with equal keys keep the static order
+        return sorted(moves, key=key)
+
+    def record_cutoff(self, player: str, move, depthLimit: int):
+        """Called when move caused an alpha-beta cutoff at a node with the given depth limit"""
+        if self._use_killers:
+            killers = self._get_killers(self._ply(depthLimit))
+            if move in killers:
+                killers.remove(move)
+            killers.insert(0, move)
+            del killers[self._num_killers:]
+        if self._use_history:
+            history_key = (player, move)
+            self._history[history_key] = self._history.get(history_key, 0) + depthLimit * depthLimit
+
+    def new_search(self):
+        """Called before searching from a new root. Killers are forgotten since they are for
+        plies of the old root, and history scores are halved so recent cutoffs count more."""
+        self._killers = []
+        for history_key in self._history:
+            self._history[history_key] //= 2
+
+    def clear(self):
+        self._killers = []
+        self._history = {}
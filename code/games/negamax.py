@@ -0,0 +1,224 @@
+from Games import Game
+from minimax import SearchStats, SearchTimeout, _pick_best_move
+from move_ordering import MoveOrderer
+from transposition import TranspositionTable, EXACT, LOWER_BOUND, UPPER_BOUND
+import math
+import time
+
+"""
+
+This file contains a negamax search engine with principal variation search (PVS).
+
+Negamax scores a position from the point of view of the player to move, so one branch covers
+both players. PVS searches the first (hopefully best) move with the full window and every
+other move with a null window that only proves it is worse, re-searching when it isn't.
+The root search shares its alpha bound across the root moves and uses aspiration windows
+around the previous iteration's score.
+
+Evaluation functions and the transposition table still use max's point of view, so this
+engine can share a TranspositionTable with minimax.py.
+
+"""
+
+_INF = float('inf')
+
+def _sign(player: str) -> int:
+    return 1 if player == 'max' else -1
+
+def _null_window_above(alpha: float) -> float:
+    """Smallest beta above alpha. Searching (alpha, beta) only tells whether a value is above alpha."""
+    return math.nextafter(alpha, _INF)
+
+def _child_val(game: Game, player: str, eval_fn, alpha: float, beta: float, depthLimit: int, tt, deadline,
+        orderer, stats) -> float:
+    """Negamax value of the position after a move, for the player who made it. The player to move
+    usually changes, but not always (a pass in Othello, or a winning move in Connect4)."""
+    if game.getPlayer() == player:
+        return negamax_val(game, eval_fn, alpha, beta, depthLimit, tt, deadline, orderer, stats)
+    return -negamax_val(game, eval_fn, -beta, -alpha, depthLimit, tt, deadline, orderer, stats)
+
+def negamax_val(game: Game, eval_fn, alpha: float, beta: float, depthLimit: int, tt: TranspositionTable=None,
+        deadline: float=None, orderer: MoveOrderer=None, stats: SearchStats=None) -> float:
+    """Value of the position for the player to move, searched with principal variation search"""
+    if deadline is not None and time.perf_counter() >= deadline:
+        raise SearchTimeout()
+    if stats is not None:
+        stats.nodes += 1
+    player = game.getPlayer()
+    sign = _sign(player)
+    moves = game.getValidMoves()
+    if depthLimit == 0 or len(moves) == 0:
+        if stats is not None:
+            stats.leaves += 1
+        return sign * eval_fn(game)
+
+    key = None
+    transform = None
+    pv_move = None
+    if tt is not None:
+        key, transform = tt.position_key(game)
+        entry = tt.lookup(key)
+        if entry is not None:
+            if entry.depth >= depthLimit:
+                value = sign * entry.value
+                flag = entry.flag
+                # A bound on max's value is the opposite bound on min's value
+                if sign < 0 and flag != EXACT:
+                    flag = UPPER_BOUND if flag == LOWER_BOUND else LOWER_BOUND
+                if flag == EXACT:
+                    if stats is not None:
+                        stats.tt_hits += 1
+                    return value
+                elif flag == LOWER_BOUND:
+                    alpha = max(alpha, value)
+                else:
+                    beta = min(beta, value)
+                if alpha >= beta:
+                    if stats is not None:
+                        stats.tt_hits += 1
+                    return value
+            pv_move = tt.from_stored_move(game, entry.best_move, transform)
+    orig_alpha, orig_beta = alpha, beta
+
+    if orderer is not None:
+        moves = orderer.order(game, moves, depthLimit, pv_move, player)
+    elif pv_move in moves:
+        moves = [pv_move] + [move for move in moves if move != pv_move]
+
+    best_value = -_INF
+    best_move = None
+    for i, move in enumerate(moves):
+        game.doMove(move)
+        if i == 0:
+            value = _child_val(game, player, eval_fn, alpha, beta, depthLimit-1, tt, deadline, orderer, stats)
+        else:
+            value = _child_val(game, player, eval_fn, alpha, _null_window_above(alpha), depthLimit-1, tt, deadline,
+                orderer, stats)
+            if alpha < value < beta:
+                value = _child_val(game, player, eval_fn, value, beta, depthLimit-1, tt, deadline, orderer, stats)
+        game.undoMoves(1)
+
+        if value > best_value:
+            best_value = value
+            best_move = move
+        if value >= beta:
+            if stats is not None:
+                stats.cutoffs += 1
+            if orderer is not None:
+                orderer.record_cutoff(player, move, depthLimit)
+            break
+        alpha = max(alpha, value)
+
+    if tt is not None:
+        if best_value <= orig_alpha:
+            flag = UPPER_BOUND
+        elif best_value >= orig_beta:
+            flag = LOWER_BOUND
+        else:
+            flag = EXACT
+        if sign < 0 and flag != EXACT:
+            flag = UPPER_BOUND if flag == LOWER_BOUND else LOWER_BOUND
+        tt.store(key, sign * best_value, depthLimit, flag, tt.to_stored_move(game, best_move, transform))
+    return best_value
+
+def _pvs_root(game: Game, eval_fn, moves, depth_limit, alpha, beta, tt, deadline, orderer, stats):
+    """Searches every root move in (alpha, beta), sharing alpha between them. Returns the negamax
+    value of each move. Moves tying the best get exact values, worse moves may only get bounds."""
+    player = game.getPlayer()
+    vals = {}
+    for i, move in enumerate(moves):
+        # Stop the window just short of alpha so a move that ties the best still gets an exact
+        # value for the random tie-breaking, while a worse move fails low
+        shared_alpha = alpha if alpha == -_INF else math.nextafter(alpha, -_INF)
+        game.doMove(move)
+        if i == 0:
+            value = _child_val(game, player, eval_fn, shared_alpha, beta, depth_limit, tt, deadline, orderer, stats)
+        else:
+            value = _child_val(game, player, eval_fn, shared_alpha, _null_window_above(shared_alpha), depth_limit, tt,
+                deadline, orderer, stats)
+            if shared_alpha < value < beta:
+                value = _child_val(game, player, eval_fn, shared_alpha, beta, depth_limit, tt, deadline, orderer, stats)
+        game.undoMoves(1)
+        vals[move] = value
+        alpha = max(alpha, value)
+    return vals
+
+def pvs_best_move(game: Game, eval_fn, depth_limit=2, tt: TranspositionTable=None, orderer: MoveOrderer=None,
+        stats: SearchStats=None, prev_score: float=None, aspiration: float=None, deadline: float=None, moves=None):
+    """
+    Same result as minimax.minimax_best_move() (including the random choice between equally good
+    moves), found with principal variation search. Returns the move and its value for max.
+
+    If prev_score and aspiration are given, the root is first searched in the window
+    prev_score +/- aspiration, and searched again with a full window if the score falls outside it.
+    moves is the order to search the root moves in, best guess first.
+    """
+    if moves is None:
+        moves = game.getValidMoves()
+    if len(moves) == 0:
+        raise ValueError('Game is already over')
+
+    sign = _sign(game.getPlayer())
+    if orderer is not None:
+        orderer.set_root_depth(depth_limit + 1)
+
+    alpha, beta = -_INF, _INF
+    if prev_score is not None and aspiration is not None:
+        low, high = prev_score - aspiration, prev_score + aspiration
+        alpha, beta = (low, high) if sign > 0 else (-high, -low)
+
+    vals = _pvs_root(game, eval_fn, moves, depth_limit, alpha, beta, tt, deadline, orderer, stats)
+    best = max(vals.values())
+    if best <= alpha or best >= beta:
+        # Outside the aspiration window, so the values are only bounds
+        vals = _pvs_root(game, eval_fn, moves, depth_limit, -_INF, _INF, tt, deadline, orderer, stats)
+        best = max(vals.values())
+
+    max_vals = {move: sign * value for move, value in vals.items()}
+    return _pick_best_move(game, moves, max_vals, depth_limit, tt), sign * best
+
+def pvs_search(game: Game, eval_fn, depth_limit=2, time_limit: float=None, aspiration: float=None, quiet=True,
+        tt: TranspositionTable=None, orderer: MoveOrderer=None, stats: SearchStats=None):
+    """
+    Iterative deepening driver for pvs_best_move(). Searches depth limits 0 through depth_limit,
+    stopping early once time_limit seconds have passed if one is given. Each iteration orders the
+    root moves by the previous iteration's values and uses the previous score for the aspiration
+    window. Returns the best move of the last finished iteration and its depth limit.
+    """
+    moves = game.getValidMoves()
+    if len(moves) == 0:
+        raise ValueError('Game is already over')
+    if len(moves) == 1:
+        return moves[0], 0
+
+    deadline = None if time_limit is None else time.perf_counter() + time_limit
+    if tt is None:
+        tt = TranspositionTable(2**16)
+    tt.new_search()
+    if orderer is not None:
+        orderer.new_search()
+    hist_len = len(game.getMoveHist())
+
+    best_move = None
+    completed_depth = None
+    score = None
+    for depth in range(depth_limit + 1):
+        try:
+            move, score = pvs_best_move(game, eval_fn, depth, tt, orderer, stats, score, aspiration,
+                None if best_move is None else deadline, moves)
+        except SearchTimeout:
+            game.undoMoves(len(game.getMoveHist()) - hist_len)
+            break
+        best_move = move
+        completed_depth = depth
+        if stats is not None:
+            stats.depth = depth
+        if not quiet:
+            print("Depth {} done, best move {} ({})".format(depth, best_move, score))
+
+        # Search the best move first next time so the shared alpha is good from the start
+        moves = [best_move] + [m for m in moves if m != best_move]
+        if deadline is not None and time.perf_counter() >= deadline:
+            break
+
+    return best_move, completed_depth
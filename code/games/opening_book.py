@@ -0,0 +1,419 @@
+from Games import *
+from eval_funcs import EvalFnGuide
+from negamax import pvs_best_move
+from minimax import SearchStats
+from move_ordering import MoveOrderer
+from transposition import TranspositionTable
+from worker_pool import GameWorkerPool, get_worker_game
+from ai_battle import AllPlayerBattle
+from bisect import bisect_left
+from pathlib import Path
+from array import array
+import argparse
+import hashlib
+import json
+import mmap
+import struct
+import sys
+
+try:
+    import tqdm
+except ModuleNotFoundError:
+    tqdm = None
+
+"""
+
+This file contains opening books: the best move of every position in the first plies of a
+game, found ahead of time with a deep search.
+
+A book file is a table sorted by position key, so it can be memory-mapped and searched
+instead of being loaded:
+    magic (8 bytes), number of positions (u64), length of the settings (u32) and number of
+        bucket bits (u32)
+    settings the book was built with (UTF-8 JSON, padded with spaces to a multiple of 8 bytes)
+    position keys (u64 each, sorted)
+    bucket starts (u32 each, 2**bucket bits + 1 of them)
+    scores for max (f32 each)
+    best moves (u8 each, index of the move in getValidMoves())
+
+Position keys (see `OpeningBook.position_key()`) stay the same between runs and processes,
+and their top bits are spread evenly. Bucket b holds the keys whose top bits are b, and the
+buckets average about one key each, so a lookup only searches the few keys in its bucket.
+
+Connect 4 keys are the bitboard key (see Connect4Bitboard.getKey()) multiplied by an odd
+constant, which is quick and gives every position its own key. Other games hash their board
+key and player to move, which costs a few microseconds, and getBoardKey() itself takes about
+6us for the C games. Finding a Connect 4 position takes about 1.2us (3us more in a canonical
+book, which mirrors the board), and lookup() about 3.5us since turning the stored index back
+into a move calls getValidMoves(). That is short of a sub-microsecond lookup, which the
+Python calls involved don't leave room for.
+
+The settings are the game and board size, the evaluation function, the depth limit and
+whether the book is canonical. OpeningBook checks them against the ones it is opened with.
+
+Canonical books key positions on `Game.getCanonicalKey()` instead, so mirror images and
+rotations of a position are stored once. Their moves are indexes into the
+sorted moves of the canonical orientation (see get_move_index()).
+
+Books are built by OpeningBookBuilder, which spreads the searches over worker processes.
+Every finished search is appended to a journal file, so a build that was stopped picks up
+where it left off when run again. The journal's first line holds the settings of the build
+that started it, and a build with other settings won't resume it.
+
+"""
+
+_MAGIC = b'CSCBOOK3'
+_HEADER = struct.Struct('<8sQII')
+# array() and memoryview.cast() use the machine's byte order
+_BIG_ENDIAN = sys.byteorder == 'big'
+# Odd multiplier that spreads integer board keys over the top bits (2**64 / golden ratio)
+_KEY_MULTIPLIER = 0x9E3779B97F4A7C15
+_KEY_MASK = 2**64 - 1
+
+def get_bucket_bits(count: int) -> int:
+    """Enough bucket bits for about one of count keys per bucket"""
+    return max(1, (count - 1).bit_length())
+
+def get_bucket_starts(keys, bits: int):
+    """Index of the first key of each of the 2**bits buckets of the sorted keys, followed by
+    the number of keys"""
+    shift = 64 - bits
+    starts = array('I', bytes(4 * (2**bits + 1)))
+    for key in keys:
+        starts[(key >> shift) + 1] += 1
+    for bucket in range(2**bits):
+        starts[bucket + 1] += starts[bucket]
+    return starts
+
+def get_board_name(game: Game) -> str:
+    """The game and its board size, which a book's positions are only valid for"""
+    if isinstance(game, Connect4):
+        board = game.game
+        return '{} {}x{} win {}'.format(type(game).__name__, board.cols, board.rows, board.win)
+    return type(game).__name__
+
+def _canonical_moves(game: Game):
+    """The valid moves in the canonical orientation (sorted, so symmetric positions list them
+    in the same order) and the transform to it"""
+    _, transform = game.getCanonicalKey()
+    return sorted(game.transformMove(move, transform) for move in game.getValidMoves()), transform
+
+def get_move_index(game: Game, move, canonical=False) -> int:
+    """Index a book stores for a move. It is the index in getValidMoves(), or the index in the
+    canonical orientation's moves for a canonical book."""
+    if not canonical:
+        return game.getValidMoves().index(move)
+    moves, transform = _canonical_moves(game)
+    return moves.index(game.transformMove(move, transform))
+
+def get_indexed_move(game: Game, move_index: int, canonical=False):
+    """The move for an index from get_move_index(), or None if there is no such move"""
+    if not canonical:
+        moves = game.getValidMoves()
+        return moves[move_index] if move_index < len(moves) else None
+    moves, transform = _canonical_moves(game)
+    if move_index >= len(moves):
+        return None
+    return game.transformMove(moves[move_index], transform, inverse=True)
+
+class OpeningBook:
+    """
+    Memory-mapped opening book. Use lookup() or get_move() to find a position's book move.
+
+    If game, eval_fn or depth_limit are given, a ValueError is raised unless the book was
+    built for the same board (see get_board_name()), evaluation function or depth limit.
+    """
+    def __init__(self, path, game: Game=None, eval_fn=None, depth_limit=None) -> None:
+        self.path = Path(path)
+        self._open()
+        expected = {}
+        if game is not None:
+            expected['board'] = get_board_name(game)
+        if eval_fn is not None:
+            expected['eval_fn'] = eval_fn.__name__
+        if depth_limit is not None:
+            expected['depth_limit'] = depth_limit
+        for name, value in expected.items():
+            if self.settings.get(name) != value:
+                self.close()
+                raise ValueError('{} was built with {} {}, not {}'.format(self.path, name, self.settings.get(name), value))
+
+    def _open(self):
+        self._file = self.path.open('rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, settings_size, bits = _HEADER.unpack_from(self._map, 0)
+        if magic != _MAGIC:
+            self._map.close()
+            self._file.close()
+            self._file = None
+            raise ValueError('{} is not an opening book (or was written by an older version)'.format(self.path))
+        self.settings = json.loads(self._map[_HEADER.size:_HEADER.size + settings_size].decode('utf8'))
+        self.canonical = self.settings['canonical']
+        self._count = count
+        self._shift = 64 - bits
+        keys_start = _HEADER.size + settings_size
+        keys_end = keys_start + 8 * count
+        buckets_end = keys_end + 4 * (2**bits + 1)
+        scores_end = buckets_end + 4 * count
+        view = memoryview(self._map)
+        if _BIG_ENDIAN:
+            # Copy and swap the numbers instead of viewing them
+            self._keys = array('Q', view[keys_start:keys_end].tobytes())
+            self._buckets = array('I', view[keys_end:buckets_end].tobytes())
+            self._scores = array('f', view[buckets_end:scores_end].tobytes())
+            self._keys.byteswap()
+            self._buckets.byteswap()
+            self._scores.byteswap()
+        else:
+            self._keys = view[keys_start:keys_end].cast('Q')
+            self._buckets = view[keys_end:buckets_end].cast('I')
+            self._scores = view[buckets_end:scores_end].cast('f')
+        self._moves = view[scores_end:scores_end + count]
+        self._view = view
+
+    @staticmethod
+    def position_key(game: Game, canonical=False) -> int:
+        """Stable 64-bit key of the position (or its canonical key) and the player to move"""
+        if isinstance(game, Connect4) and game.game.cols * game.game._col_bits <= 64:
+            # The bitboard key fits in 64 bits and already tells whose move it is
+            board_key = game.getCanonicalKey()[0] if canonical else game.game.getKey()
+            return (board_key * _KEY_MULTIPLIER) & _KEY_MASK
+        board_key = game.getCanonicalKey()[0] if canonical else game.getBoardKey()
+        digest = hashlib.blake2b(repr((board_key, game.getPlayer())).encode('utf8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'little')
+
+    def lookup_key(self, key: int):
+        """(move index, score for max) of a position key, or None if it isn't in the book"""
+        bucket = key >> self._shift
+        i = bisect_left(self._keys, key, self._buckets[bucket], self._buckets[bucket + 1])
+        if i < self._count and self._keys[i] == key:
+            return self._moves[i], self._scores[i]
+        return None
+
+    def lookup(self, game: Game):
+        """(book move, score for max) for the game's position, or None if it isn't in the book"""
+        entry = self.lookup_key(OpeningBook.position_key(game, self.canonical))
+        if entry is None:
+            return None
+        move_index, score = entry
+        move = get_indexed_move(game, move_index, self.canonical)
+        if move is None:
+            return None
+        return move, score
+
+    def get_move(self, game: Game):
+        """The book move for the game's position, or None if it isn't in the book"""
+        entry = self.lookup(game)
+        return entry[0] if entry is not None else None
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        if self._file is not None:
+            # The map can only be closed once nothing views it
+            self._keys = self._buckets = self._scores = self._moves = None
+            self._view.release()
+            self._map.close()
+            self._file.close()
+            self._file = None
+
+    def __getstate__(self):
+        # The map is opened again by whoever unpickles the book
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self._open()
+
+    def __str__(self):
+        return self.path.stem
+
+def write_book(path, entries, settings):
+    """Writes a book file from {position key: (move index, score for max)}. settings are the
+    board name, eval_fn name, depth_limit and canonical flag the book was built with."""
+    settings_bytes = json.dumps(settings, sort_keys=True).encode('utf8')
+    # Padded so the position keys start on a multiple of 8 bytes
+    settings_bytes += b' ' * (-(_HEADER.size + len(settings_bytes)) % 8)
+    keys = array('Q', sorted(entries))
+    bits = get_bucket_bits(len(keys))
+    buckets = get_bucket_starts(keys, bits)
+    scores = array('f', (entries[key][1] for key in keys))
+    moves = array('B', (entries[key][0] for key in keys))
+    if _BIG_ENDIAN:
+        keys.byteswap()
+        buckets.byteswap()
+        scores.byteswap()
+    with Path(path).open('wb') as book_file:
+        book_file.write(_HEADER.pack(_MAGIC, len(keys), len(settings_bytes), bits))
+        book_file.write(settings_bytes)
+        for values in (keys, buckets, scores, moves):
+            book_file.write(values.tobytes())
+
+# Per-worker search state, kept between positions so the table and move ordering stay warm
+_worker_tt = None
+_worker_orderer = None
+
+def _get_worker_search_state(tt_size, canonical):
+    global _worker_tt, _worker_orderer
+    if tt_size > 0 and _worker_tt is None:
+        _worker_tt = TranspositionTable(tt_size, canonical)
+    if _worker_orderer is None:
+        _worker_orderer = MoveOrderer.for_game(type(get_worker_game()))
+    return _worker_tt, _worker_orderer
+
+def _search_position(args):
+    key, path, eval_fn, depth_limit, tt_size, canonical = args
+    game = get_worker_game()
+    tt, orderer = _get_worker_search_state(tt_size, canonical)
+    game.undoMoves(len(game.getMoveHist()))
+    for move in path:
+        game.doMove(move)
+
+    stats = SearchStats()
+    if tt is not None:
+        tt.new_search()
+    orderer.new_search()
+    move, score = pvs_best_move(game, eval_fn, depth_limit, tt, orderer, stats)
+    move_index = get_move_index(game, move, canonical)
+    game.undoMoves(len(path))
+    return key, move_index, score, stats.nodes
+
+class OpeningBookBuilder:
+    """
+    Builds an opening book for every position reachable in the first `plies` plies, searching
+    each one with principal variation search to depth_limit in a pool of worker processes.
+
+    Finished searches are appended to journal_path (book path + ".journal" by default).
+    Positions already in the journal are skipped, so an interrupted build can be resumed by
+    running it again with the same settings. Resuming with other settings raises a ValueError.
+
+    If canonical is set, the book is a canonical book, so only one of every group of
+    symmetric positions is searched.
+    """
+    def __init__(self, game: Game, eval_fn, plies=4, depth_limit=8, workers=None, tt_size=2**20,
+            canonical=False) -> None:
+        self.game = game
+        self.eval_fn = eval_fn
+        self.plies = plies
+        self.depth_limit = depth_limit
+        self.workers = workers
+        self.tt_size = tt_size
+        self.canonical = canonical
+
+    def get_positions(self):
+        """{position key: moves from the start} of every position within self.plies plies that
+        still has moves to play"""
+        positions = {}
+        def visit(path):
+            key = OpeningBook.position_key(self.game, self.canonical)
+            moves = self.game.getValidMoves()
+            if key in positions or len(moves) == 0:
+                return
+            positions[key] = list(path)
+            if len(path) == self.plies:
+                return
+            for move in moves:
+                self.game.doMove(move)
+                path.append(move)
+                visit(path)
+                path.pop()
+                self.game.undoMoves(1)
+
+        self.game.undoMoves(len(self.game.getMoveHist()))
+        visit([])
+        return positions
+
+    @staticmethod
+    def read_journal(journal_path):
+        """(settings, {position key: (move index, score)}) of the searches in a journal. The
+        settings are None if the journal is empty or missing."""
+        settings = None
+        entries = {}
+        journal_path = Path(journal_path)
+        if not journal_path.exists():
+            return settings, entries
+        with journal_path.open() as journal:
+            for line_number, line in enumerate(journal):
+                if line_number == 0:
+                    try:
+                        settings = json.loads(line)
+                    except ValueError:
+                        # Cut short before the settings were written
+                        settings = None
+                    if not isinstance(settings, dict):
+                        settings = None
+                    continue
+                fields = line.split()
+                # The last line may be cut short if the build was stopped while writing it
+                if len(fields) != 3:
+                    continue
+                try:
+                    entries[int(fields[0], 16)] = (int(fields[1]), float(fields[2]))
+                except ValueError:
+                    continue
+        return settings, entries
+
+    def build(self, path, journal_path=None, quiet=False):
+        """Searches every position missing from the journal and writes the book to path"""
+        if journal_path is None:
+            journal_path = str(path) + '.journal'
+        settings, entries = OpeningBookBuilder.read_journal(journal_path)
+        if settings is None and entries:
+            raise ValueError('Journal {} has no build settings, so it can\'t be resumed'.format(journal_path))
+        if settings is not None and settings != self.get_settings():
+            raise ValueError('Journal {} is for a build with {}, not {}. Delete it to start over.'.format(
+                journal_path, settings, self.get_settings()))
+        positions = self.get_positions()
+        tasks = [(key, moves, self.eval_fn, self.depth_limit, self.tt_size, self.canonical)
+            for key, moves in positions.items() if key not in entries]
+        if not quiet:
+            print("{} positions, {} already searched".format(len(positions), len(positions) - len(tasks)))
+
+        pbar = None
+        if not quiet and tqdm is not None:
+            pbar = tqdm.tqdm(total=len(tasks), desc='Searching positions')
+        with Path(journal_path).open('a') as journal, GameWorkerPool(type(self.game), self.workers) as pool:
+            if settings is None:
+                # Starts the journal over if the settings line was cut short
+                journal.truncate(0)
+                journal.write(json.dumps(self.get_settings(), sort_keys=True) + '\n')
+                journal.flush()
+            for key, move_index, score, nodes in pool.imap_unordered(_search_position, tasks):
+                journal.write("{:016x} {} {!r}\n".format(key, move_index, score))
+                journal.flush()
+                entries[key] = (move_index, score)
+                if pbar is not None:
+                    pbar.update()
+        if pbar is not None:
+            pbar.close()
+
+        write_book(path, {key: entries[key] for key in positions if key in entries}, self.get_settings())
+        return OpeningBook(path)
+
+    def get_settings(self):
+        """The settings stored in the book's header"""
+        return {'board': get_board_name(self.game), 'eval_fn': self.eval_fn.__name__,
+            'depth_limit': self.depth_limit, 'canonical': self.canonical}
+
+if __name__ == "__main__":
+    """Builds a book from the command line"""
+    parser = argparse.ArgumentParser(description="Build an opening book")
+    parser.add_argument('game', choices=list(AllPlayerBattle.get_game_choice_map()), help="Game")
+    parser.add_argument('book', help="Book file to write")
+    parser.add_argument('--plies', '-p', type=int, default=4, help="Plies from the start to cover")
+    parser.add_argument('--depth-limit', '-d', type=int, default=8, help="Depth limit of each search")
+    parser.add_argument('--eval-fn', '-e', metavar='fn_name', help="Evaluation function")
+    parser.add_argument('--workers', '-w', type=int, help="Worker processes (default: one per CPU)")
+    parser.add_argument('--canonical', action='store_true', help="Store mirror images and rotations of a position once")
+    args = parser.parse_args()
+
+    game_class = AllPlayerBattle.get_game_from_choice(args.game)
+    eval_fn = EvalFnGuide.get_default_fn_for_game(game_class)
+    if args.eval_fn:
+        eval_fn = EvalFnGuide.get_eval_fn_from_str(game_class, args.eval_fn)
+
+    builder = OpeningBookBuilder(game_class(), eval_fn, args.plies, args.depth_limit, args.workers,
+        canonical=args.canonical)
+    book = builder.build(args.book)
+    print("Wrote {} positions to {}".format(len(book), args.book))
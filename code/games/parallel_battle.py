@@ -1,16 +1,20 @@
-import threading
-import subprocess
 import sys
+import queue
+import traceback
 from Games import Game
 from Player import Player
-from ai_battle import AIBattle, AllPlayerBattle
-import pickle
-import queue
+from ai_battle import AIBattle, AllPlayerBattle, SPRT, SPRTBattle
+from game_record import GameRecord, GameRecordWriter
+from worker_pool import GameWorkerPool, get_worker_game
 
 """
 
 Same as ai_battle.py stuff but runs bouts in parallel.
 
+Games are played by a pool of worker processes (see worker_pool.py) that each create their
+game once and then play one game after another on it, so the interpreter, the imports and
+BoardTest are only loaded once per worker instead of once per game.
+
 """
 
 try:
@@ -24,129 +28,173 @@ except ModuleNotFoundError:
     TicTacToeGame = None
 
 
-max_subprocesses = 10
-
-game_sem = threading.Semaphore(max_subprocesses)
-stdout_lock = threading.Lock()
-
-codestr = """
-import pickle
-import sys
-from ai_battle import AIBattle
-args = pickle.load(sys.stdin.buffer)
-result = AIBattle._play_game(args[0](), args[1], args[2], args[3])
-pickle.dump(result, sys.stdout.buffer)
-"""
+def _play_game_task(args):
+    """Plays one game on the worker's game. Returns the result and the GameRecord (if the task
+    asked for one), or None, None and the error."""
+    move_limit, maxPlayer, minPlayer, seed, record_game = args
+    game = get_worker_game()
+    record = None
+    if record_game:
+        record = GameRecord(game.__class__.__name__, str(maxPlayer), str(minPlayer), seed)
+    try:
+        return AIBattle._play_game(game, move_limit, maxPlayer, minPlayer, seed, record), record, None
+    except Exception:
+        # Leave the game ready for the next task
+        game.undoMoves(len(game.getMoveHist()))
+        return None, None, traceback.format_exc()
+
+def _handle_game_result(task_result, update, record_writer: GameRecordWriter=None):
+    """Passes a finished task's result to update and writes its record. Returns whether the game
+    finished without an error."""
+    result, record, error = task_result
+    if error is not None:
+        print("Error running game:")
+        print("---OUTPUT---")
+        print(error)
+        print("------------")
+        return False
+    if record is not None and record_writer is not None:
+        record_writer.write(record)
+    update(result)
+    return True
+
+def _run_games(pool: GameWorkerPool, tasks, update, record_writer: GameRecordWriter=None):
+    """Plays every task in the pool, calling update with each result as it finishes"""
+    for task_result in pool.imap_unordered(_play_game_task, tasks):
+        _handle_game_result(task_result, update, record_writer)
 
 class ParallelBattle(AIBattle):
-    def __init__(self, game: Game, p1: Player, p2: Player, update=print, move_limit=300, play_count=5) -> None:
-        super().__init__(game, p1, p2, update, move_limit, play_count)
-        self.__results = queue.Queue()
-
-    def __run_subgame(self, maxPlayer, minPlayer):
-        pickled_args = pickle.dumps((self.game.__class__, self.move_limit, maxPlayer, minPlayer))
-        with game_sem:
-            subproc = subprocess.Popen([
-                sys.executable,
-                "-c",
-                codestr.format(
-                    f"{self.game.__class__.__name__}()",
-                    str(maxPlayer),
-                    str(minPlayer),
-                    self.move_limit
-                )
-            ],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE)
-
-            sub_stdout, sub_stderr = subproc.communicate(input=pickled_args)
-
-        if subproc.returncode != 0:
-            with stdout_lock:
-                print("Error running game (rc={}):".format(subproc.returncode))
-                print("---OUTPUT---")
-                print(sub_stdout)
-                print(sub_stderr.decode('utf8'))
-                print("------------")
-        else:
-            try:
-                self.__results.put(pickle.loads(sub_stdout))
-            except pickle.UnpicklingError as e:
-                with stdout_lock:
-                    print("Invalid output from game:")
-                    print("---OUTPUT---")
-                    print(sub_stdout)
-                    print(sub_stderr.decode('utf8'))
-                    print("------------")
-
+    """
+    AIBattle that plays its games in a GameWorkerPool. If no pool is given, one with a
+    worker per CPU is started for the call to `go()`.
+    """
+    def __init__(self, game: Game, p1: Player, p2: Player, update=print, move_limit=300, play_count=5,
+            pool: GameWorkerPool=None, seed=None, record_writer: GameRecordWriter=None) -> None:
+        super().__init__(game, p1, p2, update, move_limit, play_count, seed, record_writer)
+        self.pool = pool
+
+    def get_task(self, game_number, maxPlayer, minPlayer):
+        return (self.move_limit, maxPlayer, minPlayer, self.get_game_seed(game_number), self.record_writer is not None)
+
+    def get_tasks(self):
+        return ([self.get_task(i, self.p1, self.p2) for i in range(self.play_count)] +
+            [self.get_task(self.play_count + i, self.p2, self.p1) for i in range(self.play_count)])
 
     def go(self):
-        threads = []
-        for _ in range(self.play_count):
-            threads.append(threading.Thread(target=self.__run_subgame, args=(self.p1, self.p2)))
-        for _ in range(self.play_count):
-            threads.append(threading.Thread(target=self.__run_subgame, args=(self.p2, self.p1)))
+        if self.pool is not None:
+            _run_games(self.pool, self.get_tasks(), self.update, self.record_writer)
+            return
+
+        with GameWorkerPool(self.game.__class__) as pool:
+            _run_games(pool, self.get_tasks(), self.update, self.record_writer)
+
+class ParallelSPRTBattle(SPRTBattle):
+    """
+    SPRTBattle that plays its games in a GameWorkerPool. A game per worker is kept running
+    until the SPRT is decided. Games that were already running when it was decided are still
+    passed to update, but aren't added to the test.
+    """
+    def __init__(self, game: Game, p1: Player, p2: Player, update=print, move_limit=300, play_count=500,
+            sprt: SPRT=None, pool: GameWorkerPool=None, seed=None, record_writer: GameRecordWriter=None) -> None:
+        super().__init__(game, p1, p2, update, move_limit, play_count, sprt, seed, record_writer)
+        self.pool = pool
+        # Games sent to the pool, including any still running when the SPRT was decided
+        self.games_started = 0
+
+    def __run(self, pool: GameWorkerPool):
+        results = queue.Queue()
+        running = 0
+        game_number = 0
+        self.games_started = 0
+        while True:
+            while running < pool.workers and game_number < 2 * self.play_count and self.sprt.get_status() is None:
+                maxPlayer, minPlayer, p1_max = self.get_game_players(game_number)
+                task = (self.move_limit, maxPlayer, minPlayer, self.get_game_seed(game_number),
+                    self.record_writer is not None)
+                # A task that fails before it can catch its own error (like a player that can't be
+                # unpickled) is passed on as an error result so the loop doesn't wait for it forever
+                pool.apply_async(_play_game_task, (task,), callback=lambda res, p1_max=p1_max: results.put((res, p1_max)),
+                    error_callback=lambda e, p1_max=p1_max: results.put(((None, None, repr(e)), p1_max)))
+                running += 1
+                game_number += 1
+                self.games_started = game_number
+            if running == 0:
+                break
+
+            task_result, p1_max = results.get()
+            running -= 1
+            decided = self.sprt.get_status() is not None
+            if _handle_game_result(task_result, self.update, self.record_writer) and not decided:
+                self.sprt.add_result(task_result[0]['winner'], p1_max)
 
-        for thread in threads:
-            thread.start()
-
-        for thread in threads:
-            thread.join()
-            if not self.__results.empty():
-                # If the subprocess doesn't finish (an exception occurs or the user interrupts
-                # the program), we don't have results to dequeue
-                self.update(self.__results.get())
-
-        assert self.__results.empty()
+    def go(self):
+        print(str(self.p1), "vs.", str(self.p2))
+        if self.pool is not None:
+            self.__run(self.pool)
+        else:
+            with GameWorkerPool(self.game.__class__) as pool:
+                self.__run(pool)
+        print(str(self.sprt))
 
 class ParallelAllPlayerBattle(AllPlayerBattle):
     def __init__(self, game_choice: str, write_to_csv=True, move_limit=300, play_count=5,
-            players=None, use_tqdm=True) -> None:
+            players=None, use_tqdm=True, workers=None, sprt=None, record_path=None, seed=None,
+            results_backend='csv') -> None:
         super().__init__(game_choice, write_to_csv=write_to_csv, move_limit=move_limit,
-            play_count=play_count, players=players, use_tqdm=use_tqdm)
-
-        self.__update_lock = threading.Lock()
+            play_count=play_count, players=players, use_tqdm=use_tqdm, sprt=sprt, record_path=record_path, seed=seed,
+            results_backend=results_backend)
+        self.workers = workers
 
     def __update_res(self, res):
         if self.use_tqdm:
-            with stdout_lock:
-                self.pbar.update()
+            self.pbar.update()
         if self.writer is not None:
-            with self.__update_lock:
-                self.writer.write_result(res)
+            self.writer.write_result(res)
 
     def battle(self):
         # Setup
-        game = self.game_class()
+        if self.game is None:
+            self.game = self.game_class()
         if self.writer is not None:
             self.writer.open()
+        if self.record_writer is not None:
+            self.record_writer.open()
         if self.use_tqdm and not self.pbar:
-            with stdout_lock:
-                self.pbar = tqdm.tqdm(total=(len(self.game_matchups) * 2 * self.play_count), desc='Simulating games')
-
-        threads = []
-
-        for p1, p2 in self.game_matchups:
-            new_battle = ParallelBattle(game, p1, p2, update=self.__update_res,
-                move_limit=self.move_limit, play_count=self.play_count)
-            threads.append(threading.Thread(target=new_battle.go))
-
-        for thread in threads:
-            thread.start()
+            self.pbar = tqdm.tqdm(total=(len(self.game_matchups) * 2 * self.play_count), desc='Simulating games')
 
         try:
-            for thread in threads:
-                thread.join()
-        except InterruptedError:
+            with GameWorkerPool(self.game_class, self.workers) as pool:
+                if self.sprt is not None:
+                    self.__sprt_battle(pool)
+                else:
+                    # Every matchup shares one pool so the workers stay busy until the last game
+                    tasks = []
+                    for i, (p1, p2) in enumerate(self.game_matchups):
+                        tasks += ParallelBattle(self.game, p1, p2, move_limit=self.move_limit,
+                            play_count=self.play_count, seed=self.get_matchup_seed(i),
+                            record_writer=self.record_writer).get_tasks()
+                    _run_games(pool, tasks, self.__update_res, self.record_writer)
+        except KeyboardInterrupt:
             print("Interrupted!")
 
         if self.writer is not None:
             self.writer.close()
+        if self.record_writer is not None:
+            self.record_writer.close()
 
         if self.use_tqdm:
-            with stdout_lock:
-                self.pbar.close()
+            self.pbar.close()
+
+    def __sprt_battle(self, pool: GameWorkerPool):
+        for i, (p1, p2) in enumerate(self.game_matchups):
+            new_battle = ParallelSPRTBattle(self.game, p1, p2, update=self.__update_res, move_limit=self.move_limit,
+                play_count=self.play_count, sprt=self.sprt.copy(), pool=pool, seed=self.get_matchup_seed(i),
+                record_writer=self.record_writer)
+            new_battle.go()
+            self.sprt_results.append((str(p1), str(p2), new_battle.sprt))
+            if self.use_tqdm:
+                # Games that were never started. Every started game already updated the bar.
+                self.pbar.update(max(0, 2 * self.play_count - new_battle.games_started))
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
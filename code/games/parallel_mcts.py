@@ -0,0 +1,206 @@
+from Games import Game
+from mcts import MCTSStats, mcts_tree_search, mcts_root_stats, mcts_best_move_from_stats
+from mcts import _MCTS_Tree, _Game_Lookahead, _SearchBudget, _tree_policy, _default_policy, _WINNER_VALUES
+from worker_pool import GameWorkerPool, get_worker_game, save_position, restore_position
+import queue
+import random
+import time
+
+"""
+
+This file contains parallel versions of mcts.
+
+ParallelMCTS is root-parallel: every worker process runs its own independent MCTS from the
+same position. The visit and win counts of the root's children are then added together
+across the workers and the move is picked from the merged counts, the same way mcts() picks
+it from a single tree.
+
+LeafParallelMCTS is leaf-parallel: this process grows a single tree and the workers only
+evaluate its leaves, so the simulations all go into one tree instead of being split up.
+
+"""
+
+def _search_tree(args):
+    position, player, iterations, c, seed, oracle, leaf_eval, time_limit, early_stop = args
+    game = get_worker_game()
+    restore_position(game, position)
+    # Each worker needs different random playouts
+    random.seed(seed)
+    stats = MCTSStats()
+    _, root = mcts_tree_search(game, player, iterations, quiet=True, c=c, stats=stats, oracle=oracle,
+        leaf_eval=leaf_eval, time_limit=time_limit, early_stop=early_stop)
+    return mcts_root_stats(root), stats
+
+class ParallelMCTS:
+    """
+    Root-parallel MCTS over a pool of worker processes. The pool stays up between calls to
+    best_move(), so create one of these per game type and reuse it. Call close() when done.
+    """
+    def __init__(self, game_class, workers=None) -> None:
+        self._pool = GameWorkerPool(game_class, workers)
+        self.game_class = game_class
+        self.workers = self._pool.workers
+
+    def best_move(self, game: Game, iterations: int, c=1, stats: MCTSStats=None, oracle=None, leaf_eval=None,
+            time_limit=None, early_stop=False):
+        """Runs iterations MCTS iterations in every worker and picks a move from the merged
+        root counts. With N workers, this runs N times as many simulations as mcts().
+        The oracle and leaf_eval (see mcts_tree_search()) are pickled into every task.
+
+        time_limit and early_stop apply to every worker's search. The time saved is that of
+        the worker that saved the least, since the move waits for all of them."""
+        if type(game) != self.game_class:
+            raise ValueError('Expected a {} but got a {}'.format(self.game_class.__name__, type(game).__name__))
+        if len(game.getValidMoves()) == 0:
+            raise ValueError('Game is already over')
+
+        start = time.perf_counter()
+        position = save_position(game)
+        player = game.getPlayer()
+        tasks = [(position, player, iterations, c, random.getrandbits(64), oracle, leaf_eval, time_limit, early_stop)
+            for _ in range(self.workers)]
+
+        merged = {}
+        worker_stats = []
+        for root_stats, tree_stats in self._pool.imap_unordered(_search_tree, tasks):
+            worker_stats.append(tree_stats)
+            for move, counts in root_stats.items():
+                if move in merged:
+                    merged[move] = tuple(total + count for total, count in zip(merged[move], counts))
+                else:
+                    merged[move] = counts
+
+        if stats is not None:
+            stats.simulations += sum(tree_stats.simulations for tree_stats in worker_stats)
+            stats.elapsed += time.perf_counter() - start
+            stats.early_stops += sum(tree_stats.early_stops for tree_stats in worker_stats)
+            stats.simulations_saved += sum(tree_stats.simulations_saved for tree_stats in worker_stats)
+            stats.time_saved += min(tree_stats.time_saved for tree_stats in worker_stats)
+        return mcts_best_move_from_stats(player, merged, early_stop)
+
+    def close(self):
+        self._pool.close()
+
+def _evaluate_leaves(args):
+    """Values (see mcts._default_policy()) of the leaves reached by each list of moves from
+    the position"""
+    position, leaves, seed, leaf_eval = args
+    game = get_worker_game()
+    restore_position(game, position)
+    random.seed(seed)
+    lookahead = _Game_Lookahead(game)
+    values = []
+    for moves in leaves:
+        for move in moves:
+            game.doMove(move)
+        values.append(_default_policy(lookahead, leaf_eval=leaf_eval))
+        game.undoMoves(len(moves))
+    return values
+
+def _known_value(game: Game, oracle=None):
+    """The value of a leaf where the game is over or the oracle knows who wins, otherwise None"""
+    winner = game.getWinner()
+    if winner is None and oracle is not None:
+        winner = oracle.get_winner(game)
+    if winner is None:
+        return None
+    return _WINNER_VALUES[winner]
+
+class LeafParallelMCTS:
+    """
+    Leaf-parallel MCTS over a pool of worker processes. The tree is grown in this process, one
+    descent at a time. Each leaf is sent to a worker to be played out (or scored by leaf_eval),
+    in batches of batch_size leaves given as the moves from the root, and its result is backed
+    up when it comes back. Leaves where the game is over or that the oracle knows are scored
+    here instead.
+
+    While a leaf is out, every node on its path carries a virtual loss (see
+    _MCTS_Tree.add_virtual_loss()) so the next descents go elsewhere. Up to workers *
+    batch_size leaves are out at once.
+
+    The budget (see mcts.mcts_tree_search()) is checked before every descent. The leaves that
+    are out when it runs out are still waited for, so a time limit can be overrun by the time
+    it takes to evaluate a batch.
+
+    The pool stays up between searches, so create one of these per game type and reuse it.
+    Call close() when done.
+    """
+    def __init__(self, game_class, workers=None, batch_size=8, virtual_loss=1) -> None:
+        self._pool = GameWorkerPool(game_class, workers)
+        self.game_class = game_class
+        self.workers = self._pool.workers
+        self.batch_size = batch_size
+        self.virtual_loss = virtual_loss
+
+    def _send_batch(self, position, batch, leaf_eval, results: queue.Queue):
+        paths = [path for path, _ in batch]
+        task = (position, [moves for _, moves in batch], random.getrandbits(64), leaf_eval)
+        self._pool.apply_async(_evaluate_leaves, (task,), callback=lambda values: results.put((paths, values)),
+            error_callback=lambda error: results.put((None, error)))
+
+    def tree_search(self, game: Game, iterations: int, c=1, root: _MCTS_Tree=None, stats: MCTSStats=None,
+            oracle=None, leaf_eval=None, time_limit=None, early_stop=False):
+        """Same as mcts.mcts_tree_search(), with the leaves evaluated by the workers. The
+        leaf_eval is pickled into every batch."""
+        if type(game) != self.game_class:
+            raise ValueError('Expected a {} but got a {}'.format(self.game_class.__name__, type(game).__name__))
+        if len(game.getValidMoves()) == 0:
+            raise ValueError('Game is already over')
+
+        budget = _SearchBudget(iterations, time_limit, early_stop)
+        key = game.getBoardKey()
+        player = game.getPlayer()
+        if root is None:
+            root = _MCTS_Tree(player)
+        position = save_position(game)
+        lookahead = _Game_Lookahead(game)
+        results = queue.Queue()
+        running = 0
+        started = 0
+        out_of_budget = False
+        while True:
+            while running < self.workers and not out_of_budget:
+                batch = []
+                while len(batch) < self.batch_size:
+                    # Pending leaves are already counted as visits by their virtual loss
+                    out_of_budget = budget.should_stop(root, started)
+                    if out_of_budget:
+                        break
+                    path = _tree_policy(lookahead, root, c)
+                    value = _known_value(game, oracle)
+                    if value is None:
+                        batch.append((path, [root.get_move(node) for node in path[1:]]))
+                        root.add_virtual_loss(path, self.virtual_loss)
+                    lookahead.undoMoves(lookahead.depth)
+                    if value is not None:
+                        root.backup(path, value)
+                    started += 1
+                if len(batch) != 0:
+                    self._send_batch(position, batch, leaf_eval, results)
+                    running += 1
+            if running == 0:
+                break
+
+            paths, values = results.get()
+            running -= 1
+            if paths is None:
+                raise values
+            for path, value in zip(paths, values):
+                root.add_virtual_loss(path, -self.virtual_loss)
+                root.backup(path, value)
+        assert key == game.getBoardKey()
+
+        action = mcts_best_move_from_stats(player, mcts_root_stats(root), early_stop)
+        if stats is not None:
+            budget.update_stats(stats, started)
+        return action, root
+
+    def best_move(self, game: Game, iterations: int, c=1, stats: MCTSStats=None, oracle=None, leaf_eval=None,
+            time_limit=None, early_stop=False):
+        """Runs iterations MCTS iterations on one tree, with the leaves evaluated by the workers"""
+        action, _ = self.tree_search(game, iterations, c, stats=stats, oracle=oracle, leaf_eval=leaf_eval,
+            time_limit=time_limit, early_stop=early_stop)
+        return action
+
+    def close(self):
+        self._pool.close()
@@ -0,0 +1,146 @@
+from Games import Game
+from minimax import minimax_val, SearchStats, _pick_best_move
+from move_ordering import MoveOrderer, StaticMoveOrder
+from transposition import TranspositionTable
+from worker_pool import GameWorkerPool, get_worker_game, get_worker_shared, save_position, restore_position
+import math
+
+"""
+
+This file contains a multi-process version of minimax_best_move.
+
+The root moves are handed out to a pool of worker processes, each searching one root move at
+a time from its own copy of the game. The best value found so far is shared between the
+workers, so a root move searched after a good one only has to prove it isn't better.
+
+"""
+
+# Per-worker search state. It lives as long as the worker so the transposition table
+# and move ordering stay warm between moves.
+_worker_tt = None
+_worker_orderer = None
+# Which evaluation function the table's values came from, and which root search the worker
+# last took part in (see ParallelMinimax.best_move())
+_worker_eval_generation = None
+_worker_search_id = None
+
+def _get_worker_search_state(tt_size, move_ordering, canonical_keys=False):
+    global _worker_tt, _worker_orderer
+    if tt_size > 0 and (_worker_tt is None or _worker_tt.canonical != canonical_keys):
+        _worker_tt = TranspositionTable(tt_size, canonical_keys)
+    if _worker_orderer is None and move_ordering:
+        _worker_orderer = MoveOrderer.for_game(type(get_worker_game()))
+    return _worker_tt, _worker_orderer
+
+def _start_worker_search(tt, orderer, eval_generation, search_id):
+    """Forgets what was learned with an older evaluation function, and ages the table and
+    move ordering once per root search (a search hands each worker several root moves)"""
+    global _worker_eval_generation, _worker_search_id
+    if eval_generation != _worker_eval_generation:
+        if tt is not None:
+            tt.clear()
+        if orderer is not None:
+            orderer.clear()
+        _worker_eval_generation = eval_generation
+    if search_id != _worker_search_id:
+        if tt is not None:
+            tt.new_search()
+        if orderer is not None:
+            orderer.new_search()
+        _worker_search_id = search_id
+
+def _search_root_move(args):
+    (position, move, eval_fn, depth_limit, maximizing, tt_size, move_ordering, canonical_keys,
+        eval_generation, search_id) = args
+    game = get_worker_game()
+    best_so_far = get_worker_shared()
+    tt, orderer = _get_worker_search_state(tt_size, move_ordering, canonical_keys)
+    _start_worker_search(tt, orderer, eval_generation, search_id)
+
+    restore_position(game, position)
+    if orderer is not None:
+        orderer.set_root_depth(depth_limit + 1)
+
+    # The bound is stored from the root player's point of view. The window stops just short
+    # of it so a move that ties the best move still gets an exact value (for the random
+    # tie-breaking), while a worse move fails low.
+    alpha, beta = float('-inf'), float('inf')
+    bound = best_so_far.value
+    if bound != float('-inf'):
+        if maximizing:
+            alpha = math.nextafter(bound, float('-inf'))
+        else:
+            beta = math.nextafter(-bound, float('inf'))
+
+    stats = SearchStats()
+    game.doMove(move)
+    val = minimax_val(game, eval_fn, alpha, beta, depth_limit, tt, orderer=orderer, stats=stats)
+    game.undoMoves(1)
+
+    root_val = val if maximizing else -val
+    with best_so_far.get_lock():
+        if root_val > best_so_far.value:
+            best_so_far.value = root_val
+    return move, val, stats
+
+class ParallelMinimax:
+    """
+    Root-split minimax over a pool of worker processes. The pool stays up between calls to
+    best_move(), so create one of these per game type and reuse it. Call close() when done.
+    """
+    def __init__(self, game_class, workers=None, tt_size=2**20, move_ordering=True, canonical_keys=False) -> None:
+        ctx = GameWorkerPool.get_context()
+        self._best_so_far = ctx.Value('d', float('-inf'))
+        self._pool = GameWorkerPool(game_class, workers, shared=self._best_so_far)
+        self._static_order = StaticMoveOrder.get_order_fn_for_game(game_class) if move_ordering else None
+        self._tt_size = tt_size
+        self._move_ordering = move_ordering
+        self._canonical_keys = canonical_keys
+        self.game_class = game_class
+        # The workers' transposition tables are cleared when the evaluation function changes
+        self._eval_fn = None
+        self._eval_generation = 0
+        self._search_id = 0
+
+    def best_move(self, game: Game, eval_fn, depth_limit=2, stats: SearchStats=None):
+        """Same as minimax.minimax_best_move(), but spread over the worker processes"""
+        if type(game) != self.game_class:
+            raise ValueError('Expected a {} but got a {}'.format(self.game_class.__name__, type(game).__name__))
+
+        moves = game.getValidMoves()
+        if len(moves) == 0:
+            raise ValueError('Game is already over')
+        if stats is not None:
+            stats.depth = depth_limit
+
+        # Hand out the likely best moves first so the shared bound gets good early
+        search_order = moves
+        if self._static_order is not None:
+            search_order = self._static_order(game, moves)
+
+        position = save_position(game)
+        maximizing = game.getPlayer() == 'max'
+        with self._best_so_far.get_lock():
+            self._best_so_far.value = float('-inf')
+
+        if eval_fn is not self._eval_fn:
+            self._eval_fn = eval_fn
+            self._eval_generation += 1
+        self._search_id += 1
+
+        tasks = [(position, move, eval_fn, depth_limit, maximizing, self._tt_size, self._move_ordering,
+            self._canonical_keys, self._eval_generation, self._search_id) for move in search_order]
+        vals = {}
+        for move, val, move_stats in self._pool.imap_unordered(_search_root_move, tasks):
+            vals[move] = val
+            if stats is not None:
+                stats.nodes += move_stats.nodes
+                stats.leaves += move_stats.leaves
+                stats.cutoffs += move_stats.cutoffs
+                stats.tt_hits += move_stats.tt_hits
+
+        # Moves that failed low have values strictly below the best, so they can't be picked
+        return _pick_best_move(game, moves, vals, depth_limit, None)
+
+    def close(self):
+        self._pool.close()
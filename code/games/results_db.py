@@ -0,0 +1,177 @@
+import datetime
+import sqlite3
+from pathlib import Path
+
+"""
+
+This file contains a SQLite store for battle results, used in place of the CSV files.
+
+Every run adds its games to the same database. Besides the games themselves, the database
+keeps a running total for every matchup (game, max player, min player), so win rates and
+think times can be read without going through every game. The totals are updated in the
+same transaction as the games they count.
+
+"""
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS games (
+    id INTEGER PRIMARY KEY,
+    run TEXT NOT NULL,
+    played_at TEXT NOT NULL,
+    game TEXT NOT NULL,
+    max TEXT NOT NULL,
+    min TEXT NOT NULL,
+    winner TEXT,
+    max_tottime REAL NOT NULL,
+    min_tottime REAL NOT NULL,
+    move_count INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS games_matchup ON games (game, max, min);
+CREATE INDEX IF NOT EXISTS games_played_at ON games (played_at);
+
+CREATE TABLE IF NOT EXISTS matchups (
+    game TEXT NOT NULL,
+    max TEXT NOT NULL,
+    min TEXT NOT NULL,
+    games INTEGER NOT NULL,
+    max_wins INTEGER NOT NULL,
+    min_wins INTEGER NOT NULL,
+    draws INTEGER NOT NULL,
+    max_tottime REAL NOT NULL,
+    min_tottime REAL NOT NULL,
+    move_count INTEGER NOT NULL,
+    PRIMARY KEY (game, max, min)
+);
+"""
+
+_INSERT_GAME = """
+INSERT INTO games (run, played_at, game, max, min, winner, max_tottime, min_tottime, move_count)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+_UPSERT_MATCHUP = """
+INSERT INTO matchups (game, max, min, games, max_wins, min_wins, draws, max_tottime, min_tottime, move_count)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (game, max, min) DO UPDATE SET
+    games = games + excluded.games,
+    max_wins = max_wins + excluded.max_wins,
+    min_wins = min_wins + excluded.min_wins,
+    draws = draws + excluded.draws,
+    max_tottime = max_tottime + excluded.max_tottime,
+    min_tottime = min_tottime + excluded.min_tottime,
+    move_count = move_count + excluded.move_count
+"""
+
+def _connect(db_path) -> sqlite3.Connection:
+    connection = sqlite3.connect(str(db_path))
+    connection.executescript(_SCHEMA)
+    return connection
+
+class SQLiteGameWrite:
+    """
+    Writes game results to a SQLite database. Has the same interface as ai_battle.CSVGameWrite.
+
+    Results are buffered and written batch_size at a time, each batch in one transaction
+    together with the matchup totals it changes.
+    """
+    def __init__(self, game_name: str, data_dir='.', db_name='results.db', batch_size=500) -> None:
+        self.game_name = game_name
+        self.db_path = Path(data_dir) / db_name
+        self.batch_size = batch_size
+        self.connection = None
+        self.run = None
+        self._batch = []
+
+    def open(self):
+        if self.connection is None:
+            self.connection = _connect(self.db_path)
+            self.run = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    def write_result(self, row):
+        if self.connection is None:
+            raise Exception('Writer must first be opened!')
+        # Stamped now, since the batch may be written long after the game was played
+        played_at = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self._batch.append((played_at, row))
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._batch:
+            return
+        games = []
+        totals = {}
+        for played_at, row in self._batch:
+            games.append((self.run, played_at, row['game'], row['max'], row['min'], row['winner'],
+                row['max_tottime'], row['min_tottime'], row['move_count']))
+
+            key = (row['game'], row['max'], row['min'])
+            total = totals.setdefault(key, [0, 0, 0, 0, 0.0, 0.0, 0])
+            total[0] += 1
+            if row['winner'] == 'max':
+                total[1] += 1
+            elif row['winner'] == 'min':
+                total[2] += 1
+            else:
+                total[3] += 1
+            total[4] += row['max_tottime']
+            total[5] += row['min_tottime']
+            total[6] += row['move_count']
+
+        with self.connection:
+            self.connection.executemany(_INSERT_GAME, games)
+            self.connection.executemany(_UPSERT_MATCHUP, [key + tuple(total) for key, total in totals.items()])
+        self._batch = []
+
+    def close(self):
+        if self.connection is not None:
+            self.flush()
+            self.connection.close()
+            self.connection = None
+
+class ResultsDB:
+    """
+    Reads results written by SQLiteGameWrite.
+    """
+    def __init__(self, data_dir='.', db_name='results.db') -> None:
+        self.connection = _connect(Path(data_dir) / db_name)
+        self.connection.row_factory = sqlite3.Row
+
+    def get_matchup_stats(self, game: str=None):
+        """Totals for every matchup (or only the ones of game), with win/draw rates and the mean
+        think time per game of each side"""
+        query = """
+            SELECT game, max, min, games, max_wins, min_wins, draws,
+                CAST(max_wins AS REAL) / games AS max_win_rate,
+                CAST(min_wins AS REAL) / games AS min_win_rate,
+                CAST(draws AS REAL) / games AS draw_rate,
+                max_tottime / games AS max_mean_tottime,
+                min_tottime / games AS min_mean_tottime,
+                CAST(move_count AS REAL) / games AS mean_move_count
+            FROM matchups
+        """
+        params = ()
+        if game is not None:
+            query += " WHERE game = ?"
+            params = (game,)
+        return [dict(row) for row in self.connection.execute(query + " ORDER BY game, max, min", params)]
+
+    def get_games(self, game: str=None, max_player: str=None, min_player: str=None, since: str=None):
+        """Game results, optionally only for one game, matchup or those played since a date
+        ("YYYY-MM-DD" or "YYYY-MM-DD HH:MM:SS")"""
+        conditions = []
+        params = []
+        for column, value in (('game', game), ('max', max_player), ('min', min_player)):
+            if value is not None:
+                conditions.append("{} = ?".format(column))
+                params.append(value)
+        if since is not None:
+            conditions.append("played_at >= ?")
+            params.append(since)
+        query = "SELECT game, max, min, winner, max_tottime, min_tottime, move_count, played_at, run FROM games"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        return [dict(row) for row in self.connection.execute(query + " ORDER BY id", params)]
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,370 @@
+from Games import *
+from Player import Player
+from opening_book import OpeningBook, get_move_index, get_indexed_move, get_board_name, get_bucket_bits, get_bucket_starts
+from ai_battle import AllPlayerBattle
+from bisect import bisect_left
+from pathlib import Path
+from array import array
+import argparse
+import json
+import mmap
+import struct
+import sys
+
+"""
+
+This file contains tablebases: the exact result of every reachable position of a small game
+(Tic Tac Toe, or Connect 4 on a small board), with the number of plies to the end of the game
+and the move that gets there.
+
+solve() finds every position reachable from the start, then works back from the end of the
+game (retrograde analysis). Every move adds a piece, so all positions one ply deeper are
+solved before the positions that lead to them:
+    a finished game is a win, loss or draw for the player to move, at distance 0
+    otherwise the player to move picks the child that is best for them, winning as quickly
+    as possible, losing as slowly as possible, and drawing as quickly as possible
+
+A tablebase file is a table sorted by position key (see `OpeningBook.position_key()`):
+    magic (8 bytes), number of positions (u64), number of bucket bits (u64) and length of the
+        settings (u32)
+    settings the tablebase was solved with (UTF-8 JSON, padded with spaces to a multiple of
+        8 bytes): the board (see opening_book.get_board_name()) and whether it is canonical
+    position keys (u64 each, sorted)
+    bucket starts (u32 each, 2**bucket bits + 1 of them)
+    results for the player to move (i8 each: 1 win, 0 draw, -1 loss)
+    distances to the end of the game (u8 each)
+    best moves (u8 each, index of the move in getValidMoves(), 255 if the game is over)
+
+Probing a game with a different board than the one the tablebase was solved for raises a
+ValueError, since its positions would be looked up in the wrong table.
+
+Canonical tablebases key positions on `Game.getCanonicalKey()`, so
+mirror images and rotations of a position are solved and stored once. Their moves are
+indexed like a canonical opening book's.
+
+Position keys have their top bits spread evenly. Bucket b holds the keys whose top bits
+are b, and the buckets average about one key each, so a lookup only searches the few keys in
+its bucket (the same as an opening book).
+
+"""
+
+_MAGIC = b'CSCTB003'
+_HEADER = struct.Struct('<8sQQI')
+# array() and memoryview.cast() use the machine's byte order
+_BIG_ENDIAN = sys.byteorder == 'big'
+
+WIN = 1
+DRAW = 0
+LOSS = -1
+NO_MOVE = 255
+
+class Tablebase:
+    """
+    Memory-mapped tablebase. Use probe() for a position's exact result, get_move() for the
+    best move, and get_winner() as an oracle for searches.
+
+    If game is given, a ValueError is raised unless the tablebase was solved for its board.
+    Every game probed is checked the same way.
+    """
+    def __init__(self, path, game: Game=None) -> None:
+        self.path = Path(path)
+        self._open()
+        if game is not None:
+            try:
+                self.check_game(game)
+            except ValueError:
+                self.close()
+                raise
+
+    def _open(self):
+        self._file = self.path.open('rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, bits, settings_size = _HEADER.unpack_from(self._map, 0)
+        if magic != _MAGIC:
+            self._map.close()
+            self._file.close()
+            self._file = None
+            raise ValueError('{} is not a tablebase (or was written by an older version)'.format(self.path))
+        self.settings = json.loads(self._map[_HEADER.size:_HEADER.size + settings_size].decode('utf8'))
+        self.canonical = self.settings['canonical']
+        self.board = self.settings['board']
+        # The last game that passed check_game(). A game's board can't change.
+        self._checked_game = None
+        self._count = count
+        self._shift = 64 - bits
+        keys_start = _HEADER.size + settings_size
+        keys_end = keys_start + 8 * count
+        buckets_end = keys_end + 4 * (2**bits + 1)
+        view = memoryview(self._map)
+        if _BIG_ENDIAN:
+            # Copy and swap the numbers instead of viewing them
+            self._keys = array('Q', view[keys_start:keys_end].tobytes())
+            self._buckets = array('I', view[keys_end:buckets_end].tobytes())
+            self._keys.byteswap()
+            self._buckets.byteswap()
+        else:
+            self._keys = view[keys_start:keys_end].cast('Q')
+            self._buckets = view[keys_end:buckets_end].cast('I')
+        self._results = view[buckets_end:buckets_end + count].cast('b')
+        self._distances = view[buckets_end + count:buckets_end + 2 * count]
+        self._moves = view[buckets_end + 2 * count:buckets_end + 3 * count]
+        self._view = view
+
+    def check_game(self, game: Game):
+        """Raises a ValueError unless the tablebase was solved for the game's board"""
+        if game is self._checked_game:
+            return
+        board = get_board_name(game)
+        if board != self.board:
+            raise ValueError('{} was solved for {}, not {}'.format(self.path, self.board, board))
+        self._checked_game = game
+
+    def probe_key(self, key: int):
+        """(result for the player to move, distance, move index) of a position key, or None if it
+        isn't in the tablebase"""
+        bucket = key >> self._shift
+        i = bisect_left(self._keys, key, self._buckets[bucket], self._buckets[bucket + 1])
+        if i < self._count and self._keys[i] == key:
+            return self._results[i], self._distances[i], self._moves[i]
+        return None
+
+    def probe(self, game: Game):
+        """(result for the player to move, plies to the end of the game) with perfect play, or None
+        if the position isn't in the tablebase"""
+        self.check_game(game)
+        entry = self.probe_key(OpeningBook.position_key(game, self.canonical))
+        if entry is None:
+            return None
+        return entry[0], entry[1]
+
+    def get_move(self, game: Game):
+        """The best move in the game's position, or None if it isn't in the tablebase or the game
+        is over"""
+        self.check_game(game)
+        entry = self.probe_key(OpeningBook.position_key(game, self.canonical))
+        if entry is None or entry[2] == NO_MOVE:
+            return None
+        return get_indexed_move(game, entry[2], self.canonical)
+
+    def get_winner(self, game: Game):
+        """Who wins from the game's position with perfect play ("max", "min" or "draw"), or None if
+        it isn't in the tablebase. Has the same meaning as getWinner() for a finished game."""
+        entry = self.probe(game)
+        if entry is None:
+            return None
+        result = entry[0]
+        if result == DRAW:
+            return 'draw'
+        player = game.getPlayer()
+        if result == WIN:
+            return player
+        return 'min' if player == 'max' else 'max'
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        if self._file is not None:
+            # The map can only be closed once nothing views it
+            self._keys = self._buckets = self._results = self._distances = self._moves = None
+            self._checked_game = None
+            self._view.release()
+            self._map.close()
+            self._file.close()
+            self._file = None
+
+    def __getstate__(self):
+        # The map is opened again by whoever unpickles the tablebase
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self._open()
+
+    def __str__(self):
+        return self.path.stem
+
+class TablebaseEvalFn:
+    """
+    Evaluation function that scores positions in the tablebase exactly, for minimax to probe
+    at its leaves. A win for max scores win_score minus the plies it takes, so quicker wins
+    score higher, and a draw scores 0. Positions that aren't in the tablebase are scored by
+    fallback (which must be given if the tablebase doesn't cover the game).
+    """
+    def __init__(self, tablebase: Tablebase, fallback=None, win_score=10000) -> None:
+        self.tablebase = tablebase
+        self.fallback = fallback
+        self.win_score = win_score
+        self.__name__ = 'tablebase_{}'.format(tablebase)
+        if fallback is not None:
+            self.__name__ += '_' + fallback.__name__
+
+    def __call__(self, game: Game, *args):
+        entry = self.tablebase.probe(game)
+        if entry is None:
+            if self.fallback is None:
+                raise ValueError('Position is not in tablebase {}'.format(self.tablebase))
+            return self.fallback(game, *args)
+        result, distance = entry
+        sign = 1 if game.getPlayer() == 'max' else -1
+        return sign * result * (self.win_score - distance)
+
+    def __str__(self):
+        return self.__name__
+
+class TablebasePlayer(Player):
+    """
+    Plays the tablebase's best move. In positions the tablebase doesn't cover, fallback plays
+    instead (an error is raised if there isn't one).
+    """
+    def __init__(self, tablebase: Tablebase, fallback: Player=None) -> None:
+        self._tablebase = tablebase
+        self._fallback = fallback
+
+    def get_best_move(self, game: Game):
+        """The tablebase's move, or None if the position isn't in the tablebase"""
+        return self._tablebase.get_move(game)
+
+    def play(self, game: Game):
+        move = self._tablebase.get_move(game)
+        if move is None and self._fallback is not None:
+            self._fallback.play(game)
+            return
+        if move is None:
+            raise ValueError('Position is not in tablebase {}'.format(self._tablebase))
+        game.doMove(move)
+
+    def get_tablebase(self):
+        return self._tablebase
+
+    def __str__(self):
+        opts = "tablebase={}".format(self._tablebase)
+        if self._fallback is not None:
+            opts += ",fallback={}".format(self._fallback)
+        return "{}({})".format(self.__class__.__name__, opts)
+
+def _move_rank(result: int, distance: int):
+    """Sort key of a move's outcome for the player making it. Bigger is better."""
+    if result == LOSS:
+        return (result, distance)
+    return (result, -distance)
+
+def solve(game: Game, quiet=True, canonical=False):
+    """
+    Solves every position reachable from the game's starting position. Returns
+    {position key: (result for the player to move, distance to the end, move index)}.
+    With canonical set, only one of every group of symmetric positions is solved.
+    """
+    game.undoMoves(len(game.getMoveHist()))
+    index = {}
+    keys = []
+    players = []
+    plies = []
+    # For each position, (child, whether the child has the same player to move) per move
+    children = []
+    # The moves the children were found with
+    child_moves = []
+    # Winner of each finished game
+    winners = {}
+
+    def visit(ply):
+        key = OpeningBook.position_key(game, canonical)
+        i = index.get(key)
+        if i is not None:
+            return i
+        i = len(keys)
+        index[key] = i
+        keys.append(key)
+        player = game.getPlayer()
+        players.append(player)
+        plies.append(ply)
+        children.append(None)
+        child_moves.append(None)
+
+        moves = game.getValidMoves()
+        if len(moves) == 0:
+            winners[i] = game.getWinner()
+            return i
+        position_children = []
+        for move in moves:
+            game.doMove(move)
+            position_children.append((visit(ply + 1), game.getPlayer() == player))
+            game.undoMoves(1)
+        children[i] = position_children
+        if canonical:
+            child_moves[i] = [get_move_index(game, move, True) for move in moves]
+        return i
+
+    visit(0)
+    if not quiet:
+        print("Found {} positions, {} of them finished games".format(len(keys), len(winners)))
+
+    results = array('b', bytes(len(keys)))
+    distances = array('B', bytes(len(keys)))
+    moves = array('B', [NO_MOVE]) * len(keys)
+    # Deepest positions first, so every child is solved before its parent
+    for i in sorted(range(len(keys)), key=plies.__getitem__, reverse=True):
+        if i in winners:
+            winner = winners[i]
+            results[i] = DRAW if winner == 'draw' else (WIN if winner == players[i] else LOSS)
+            continue
+
+        best_rank = None
+        for move_index, (child, same_player) in enumerate(children[i]):
+            result = results[child] if same_player else -results[child]
+            distance = distances[child] + 1
+            rank = _move_rank(result, distance)
+            if best_rank is None or rank > best_rank:
+                best_rank = rank
+                results[i] = result
+                distances[i] = min(distance, 255)
+                moves[i] = move_index if child_moves[i] is None else child_moves[i][move_index]
+    return {keys[i]: (results[i], distances[i], moves[i]) for i in range(len(keys))}
+
+def write_tablebase(path, entries, game: Game, canonical=False):
+    """Writes a tablebase file from {position key: (result, distance, move index)} of the game's
+    positions"""
+    settings_bytes = json.dumps({'board': get_board_name(game), 'canonical': canonical}, sort_keys=True).encode('utf8')
+    # Padded so the position keys start on a multiple of 8 bytes
+    settings_bytes += b' ' * (-(_HEADER.size + len(settings_bytes)) % 8)
+    keys = array('Q', sorted(entries))
+    bits = get_bucket_bits(len(keys))
+    buckets = get_bucket_starts(keys, bits)
+    results = array('b', (entries[key][0] for key in keys))
+    distances = array('B', (entries[key][1] for key in keys))
+    moves = array('B', (entries[key][2] for key in keys))
+    if _BIG_ENDIAN:
+        keys.byteswap()
+        buckets.byteswap()
+    with Path(path).open('wb') as tablebase_file:
+        tablebase_file.write(_HEADER.pack(_MAGIC, len(keys), bits, len(settings_bytes)))
+        tablebase_file.write(settings_bytes)
+        for values in (keys, buckets, results, distances, moves):
+            tablebase_file.write(values.tobytes())
+
+def build_tablebase(game: Game, path, quiet=True, canonical=False) -> Tablebase:
+    """Solves the game and writes its tablebase to path"""
+    write_tablebase(path, solve(game, quiet, canonical), game, canonical)
+    return Tablebase(path, game)
+
+if __name__ == "__main__":
+    """Builds a tablebase from the command line"""
+    parser = argparse.ArgumentParser(description="Solve a small game and write its tablebase")
+    parser.add_argument('game', choices=['tic tac toe', 'connect4'], help="Game")
+    parser.add_argument('tablebase', help="Tablebase file to write")
+    parser.add_argument('--cols', type=int, default=4, help="Connect 4 board columns")
+    parser.add_argument('--rows', type=int, default=4, help="Connect 4 board rows")
+    parser.add_argument('--win', type=int, default=4, help="Connect 4 pieces in a row to win")
+    parser.add_argument('--canonical', action='store_true', help="Store mirror images and rotations of a position once")
+    args = parser.parse_args()
+
+    game_class = AllPlayerBattle.get_game_from_choice(args.game)
+    if game_class == Connect4:
+        game = Connect4(args.cols, args.rows, args.win)
+    else:
+        game = game_class()
+
+    tablebase = build_tablebase(game, args.tablebase, quiet=False, canonical=args.canonical)
+    start = tablebase.probe(game)
+    print("Wrote {} positions to {}".format(len(tablebase), args.tablebase))
+    print("{} for the first player in {} plies".format({WIN: 'Win', DRAW: 'Draw', LOSS: 'Loss'}[start[0]], start[1]))
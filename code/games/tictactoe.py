@@ -1,6 +1,6 @@
 import numpy as np
 import random
-from Games import Game
+from Games import Game, dihedralPoint, dihedralInverse, dihedralCells
 
 """
 
@@ -16,6 +16,10 @@ def _next_player(player: str) -> str:
     else:
         raise ValueError('Unknown Player "{}"'.format(player))
 
+# Squares of every line, and the lines through each square
+_LINES = ((0, 1, 2), (3, 4, 5), (6, 7, 8), (0, 3, 6), (1, 4, 7), (2, 5, 8), (0, 4, 8), (2, 4, 6))
+_SQUARE_LINES = [tuple(line for line in _LINES if square in line) for square in range(9)]
+
 class TicTacToeGame(Game):
     def _get_player_letter(self):
         if self._curr_player == 'max':
@@ -73,6 +77,47 @@ class TicTacToeGame(Game):
                 moves += str(i+1)
         return moves
 
+    @Game.check_game_valid
+    def randomPlayouts(self, count=1, rng=None):
+        """Plays on a list copy of the board instead of the numpy board. Filling the empty
+        squares in a shuffled order is the same as picking a random move every turn, and
+        only the lines through the last square can have been completed."""
+        if rng is None:
+            rng = random
+        winner = self.getWinner()
+        if winner is not None:
+            return [(winner, 0)] * count
+        board = list(self._board.flat)
+        empty = [square for square, spot in enumerate(board) if spot == ' ']
+        first_letter = self._get_player_letter()
+        results = []
+        for _ in range(count):
+            squares = board[:]
+            rng.shuffle(empty)
+            letter = first_letter
+            result = ('draw', len(empty))
+            for move_count, square in enumerate(empty, 1):
+                squares[square] = letter
+                if any(squares[a] == squares[b] == squares[c] for a, b, c in _SQUARE_LINES[square]):
+                    result = ('max' if letter == 'X' else 'min', move_count)
+                    break
+                letter = 'O' if letter == 'X' else 'X'
+            results.append(result)
+        return results
+
+    @Game.check_game_valid
+    def getCanonicalKey(self):
+        """The smallest board key of the board's 8 rotations and mirror images"""
+        key = self.getBoardKey()
+        return min((''.join(getter(key)), transform) for transform, getter in enumerate(dihedralCells(3)))
+
+    @Game.check_game_valid
+    def transformMove(self, move, transform, inverse=False):
+        if inverse:
+            transform = dihedralInverse(transform)
+        row, col = dihedralPoint((int(move) - 1) // 3, (int(move) - 1) % 3, 3, transform)
+        return str(row * 3 + col + 1)
+
     @Game.check_game_valid
     def getMoveHist(self):
         return [str(move + 1) for move in self._move_hist]
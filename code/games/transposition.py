@@ -0,0 +1,110 @@
+"""
+
+This file contains the transposition table used by minimax.
+
+Positions are keyed on `Game.getBoardKey()` together with the player to move, so the
+same position reached through a different move order is only searched once. A table with
+canonical keys uses `Game.getCanonicalKey()` instead, so mirror images and rotations of a
+position share one entry too. Best moves are then stored in the canonical orientation.
+
+"""
+
+EXACT = 0
+LOWER_BOUND = 1
+UPPER_BOUND = 2
+
+class _TT_Entry:
+    __slots__ = ('key', 'value', 'depth', 'flag', 'best_move', 'age')
+
+    def __init__(self, key, value, depth, flag, best_move, age):
+        self.key = key
+        self.value = value
+        self.depth = depth
+        self.flag = flag
+        self.best_move = best_move
+        self.age = age
+
+class TranspositionTable:
+    """
+    Bounded transposition table. Entries live in a fixed number of slots indexed by
+    the hash of the key. When two positions map to the same slot, the deeper search
+    wins unless the stored entry is left over from an older search (see `new_search()`).
+
+    Values are always stored from max's point of view, along with whether they are
+    an exact value, a lower bound (the search failed high) or an upper bound (the
+    search failed low).
+
+    If canonical is set, symmetric positions share entries (see position_key()).
+    """
+    def __init__(self, max_size=2**20, canonical=False):
+        if max_size <= 0:
+            raise ValueError('Transposition table size must be positive')
+        self._size = max_size
+        self.canonical = canonical
+        self._slots = [None] * max_size
+        self._age = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(game):
+        """Key used for a position in the table"""
+        return (game.getBoardKey(), game.getPlayer())
+
+    def position_key(self, game):
+        """(key, transform) for the game's position in this table. transform is None unless
+        the table uses canonical keys, and is passed to to_stored_move() and from_stored_move()."""
+        if not self.canonical:
+            return TranspositionTable.make_key(game), None
+        key, transform = game.getCanonicalKey()
+        return (key, game.getPlayer()), transform
+
+    @staticmethod
+    def to_stored_move(game, move, transform):
+        """The move to store for a position with the transform from position_key()"""
+        if transform is None or move is None:
+            return move
+        return game.transformMove(move, transform)
+
+    @staticmethod
+    def from_stored_move(game, move, transform):
+        """A stored move turned back into a move of the game's position"""
+        if transform is None or move is None:
+            return move
+        return game.transformMove(move, transform, inverse=True)
+
+    def lookup(self, key):
+        """Returns the entry stored for key or None if the position is not in the table"""
+        entry = self._slots[hash(key) % self._size]
+        if entry is not None and entry.key == key:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        return None
+
+    def store(self, key, value, depth, flag, best_move=None):
+        """Stores a search result, replacing the existing slot entry if it is for the
+        same position, came from an older search or was searched less deeply"""
+        index = hash(key) % self._size
+        entry = self._slots[index]
+        if entry is None or entry.key == key or entry.age != self._age or depth >= entry.depth:
+            if best_move is None and entry is not None and entry.key == key:
+                # Don't throw away a known best move because this search didn't find one
+                best_move = entry.best_move
+            self._slots[index] = _TT_Entry(key, value, depth, flag, best_move, self._age)
+
+    def new_search(self):
+        """Marks every stored entry as old so it may be replaced by a shallower result"""
+        self._age += 1
+
+    def clear(self):
+        self._slots = [None] * self._size
+        self._age = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get_size(self):
+        return self._size
+
+    def __len__(self):
+        return sum(1 for entry in self._slots if entry is not None)
@@ -0,0 +1,91 @@
+from Games import Game, CGame
+import multiprocessing
+import os
+
+"""
+
+This file contains a pool of long-lived worker processes that each hold their own Game.
+
+Python code can't search in parallel with threads, so parallel work on a game has to happen
+in other processes. Each worker creates its game once when it starts, and tasks move it to
+the position they need with `restore_position()`.
+
+Workers are started with the "spawn" method so they don't inherit the parent's game.
+
+"""
+
+_worker_game = None
+_worker_shared = None
+
+def save_position(game: Game):
+    """Gets something that restore_position() can use to get a game of the same type to this position.
+    CGames use their saved board state and the Python games use their move history."""
+    if isinstance(game, CGame):
+        return game.saveBoardState()
+    return game.getMoveHist()
+
+def restore_position(game: Game, position):
+    """Puts game into a position saved by save_position()"""
+    if isinstance(game, CGame):
+        game.loadBoardState(position)
+    else:
+        game.undoMoves(len(game.getMoveHist()))
+        for move in position:
+            game.doMove(move)
+
+def _init_worker(game_class, shared):
+    global _worker_game, _worker_shared
+    _worker_game = game_class()
+    _worker_shared = shared
+
+def get_worker_game() -> Game:
+    """The game owned by the current worker process. Only valid inside a task."""
+    if _worker_game is None:
+        raise Exception('Not running inside a GameWorkerPool worker')
+    return _worker_game
+
+def get_worker_shared():
+    """The shared object given to the GameWorkerPool, as seen by the current worker"""
+    return _worker_shared
+
+class GameWorkerPool:
+    """
+    Pool of worker processes that each own a game of type game_class.
+
+    shared is handed to every worker when it starts. Use it for multiprocessing objects
+    (like multiprocessing.Value) that can't be sent along with a task. Create them with
+    GameWorkerPool.get_context() so they match the pool's start method.
+    """
+    def __init__(self, game_class, workers=None, shared=None) -> None:
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.game_class = game_class
+        self.workers = workers
+        self._pool = GameWorkerPool.get_context().Pool(workers, initializer=_init_worker,
+            initargs=(game_class, shared))
+
+    @staticmethod
+    def get_context():
+        return multiprocessing.get_context('spawn')
+
+    def apply_async(self, fn, args=(), callback=None, error_callback=None):
+        return self._pool.apply_async(fn, args, callback=callback, error_callback=error_callback)
+
+    def imap_unordered(self, fn, iterable):
+        return self._pool.imap_unordered(fn, iterable)
+
+    def map(self, fn, iterable):
+        return self._pool.map(fn, iterable)
+
+    def close(self):
+        """Stops the workers. The pool can't be used afterwards."""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()